@@ -0,0 +1,189 @@
+#
+# Reconnect storm: many client threads each run short jobs (connect, one request/response, disconnect)
+# against an echo server, with plain connect() vs. WebsocketClientPool.
+#
+# Then a server restart: the client threads send requests in a loop to a server running in a separate process,
+# which is killed and started again after a downtime. Reports, for clients retrying at a fixed interval and for
+# the pool with its jittered backoff, with the default backoff_max and with backoff_max=1.0:
+#
+#   attempts        - connect attempts from the kill until every client is served again
+#   peak/100ms      - the most attempts in a 100 ms window after the restart: how many clients hit the new
+#                     server process together
+#   spread ms       - standard deviation of the attempt times after the restart
+#   reconnect p50, p99, max
+#                   - from the restart to each client's first served request
+#
+# usage: python benchmarks/client_pool.py [threads [jobs_per_thread [downtime]]]
+#
+
+import sys, time, threading, subprocess, statistics
+from ws import WSApp, WSHandler, ReactorServer, WebsocketClientPool, connect
+from ws.pool import AddressCache
+
+Port = 18890
+URL = f"ws://localhost:{Port}/"
+RestartPort = Port + 1
+RestartURL = f"ws://localhost:{RestartPort}/"
+
+class EchoHandler(WSHandler):
+
+    def on_message(self, ws, message):
+        ws.send(message)
+
+def plain_job():
+    ws = connect(URL, tcp_nodelay=False)        # connect() as it was: fresh lookup, no socket options
+    ws.send("request")
+    ws.recv()
+    ws.close()
+
+def run(job, nthreads, njobs):
+    latencies = []
+    def worker():
+        for _ in range(njobs):
+            t0 = time.perf_counter()
+            job()
+            latencies.append(time.perf_counter() - t0)
+    threads = [threading.Thread(target=worker) for _ in range(nthreads)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    dt = time.perf_counter() - t0
+    latencies.sort()
+    return dt, latencies[len(latencies)//2], latencies[int(len(latencies)*0.99)]
+
+class RecordingResolver(AddressCache):
+
+    # the pool resolves the address before each connect attempt
+
+    def __init__(self, attempts):
+        AddressCache.__init__(self)
+        self.Attempts = attempts
+
+    def resolve(self, host, port):
+        self.Attempts.append(time.monotonic())
+        return AddressCache.resolve(self, host, port)
+
+def start_server():
+    process = subprocess.Popen([sys.executable, __file__, "--serve"])
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            connect(RestartURL).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("Server did not start")
+
+def restart_run(mode, nthreads, downtime, backoff_max=10.0):
+    attempts = []
+    recovered = [None]*nthreads
+    stop = threading.Event()
+    killed = threading.Event()
+    restarted = [None]
+    if mode == "pool":
+        pool = WebsocketClientPool(max_idle=nthreads, retries=20, check_after=0.0, backoff_max=backoff_max)
+        pool.Resolver = RecordingResolver(attempts)
+
+        def request():
+            with pool.connection(RestartURL) as ws:
+                ws.send("request")
+                ws.recv(timeout=5)
+    else:
+        def request():
+            while True:                         # naive client: retries every 100 ms
+                attempts.append(time.monotonic())
+                try:
+                    ws = connect(RestartURL)
+                    break
+                except OSError:
+                    time.sleep(0.1)
+            try:
+                ws.send("request")
+                ws.recv(timeout=5)
+            finally:
+                ws.shutdown()
+
+    def client(i):
+        while not stop.is_set():
+            try:
+                request()
+            except Exception:
+                time.sleep(0.01)                # the pool gave up or the connection broke, next request
+                continue
+            if killed.is_set() and restarted[0] is not None and recovered[i] is None:
+                recovered[i] = time.monotonic()
+            time.sleep(0.01)
+
+    server = start_server()
+    threads = [threading.Thread(target=client, args=(i,), daemon=True) for i in range(nthreads)]
+    for t in threads:
+        t.start()
+    time.sleep(1.0)
+    server.kill()
+    server.wait()
+    t_kill = time.monotonic()
+    killed.set()
+    time.sleep(downtime)
+    server = start_server()
+    restarted[0] = t_up = time.monotonic()
+    deadline = t_up + 30
+    while None in recovered and time.monotonic() < deadline:
+        time.sleep(0.05)
+    stop.set()
+    for t in threads:
+        t.join(6)
+    server.kill()
+    server.wait()
+
+    reconnect = sorted(r - t_up for r in recovered if r is not None)
+    during = [t - t_up for t in attempts if t_kill <= t <= t_up + (reconnect[-1] if reconnect else 0)]
+    after = [t for t in during if t >= 0]
+    windows = {}
+    for t in after:
+        windows[int(t//0.1)] = windows.get(int(t//0.1), 0) + 1
+    return (len(during), max(windows.values()) if windows else 0,
+        statistics.pstdev(after) if len(after) > 1 else 0.0, reconnect, nthreads - len(reconnect))
+
+if len(sys.argv) > 1 and sys.argv[1] == "--serve":
+    server = ReactorServer(RestartPort, WSApp(EchoHandler))
+    server.start()
+    server.join()
+    sys.exit(0)
+
+nthreads = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+njobs = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+downtime = float(sys.argv[3]) if len(sys.argv) > 3 else 1.0
+
+server = ReactorServer(Port, WSApp(EchoHandler))
+server.daemon = True
+server.start()
+time.sleep(0.2)
+
+pool = WebsocketClientPool(max_idle=nthreads)
+
+def pooled_job():
+    with pool.connection(URL) as ws:
+        ws.send("request")
+        ws.recv()
+
+print(f"threads: {nthreads}, jobs per thread: {njobs}")
+print("%-10s %10s %10s %10s %10s" % ("client", "time, s", "jobs/s", "p50 ms", "p99 ms"))
+for name, job in (("connect", plain_job), ("pool", pooled_job)):
+    dt, p50, p99 = run(job, nthreads, njobs)
+    print("%-10s %10.2f %10.0f %10.2f %10.2f" % (name, dt, nthreads*njobs/dt, p50*1000, p99*1000))
+print(pool.stats())
+
+def quantile(values, q):
+    return values[min(len(values) - 1, int(q*len(values)))] if values else float("nan")
+
+print()
+print(f"server restart: {nthreads} clients, {downtime} s downtime")
+print("%-10s %9s %11s %10s %14s %9s %9s %7s" % ("client", "attempts", "peak/100ms", "spread ms", "reconnect p50", "p99", "max", "lost"))
+for name, mode, backoff_max in (("fixed", "fixed", None), ("pool", "pool", 10.0), ("pool/1s", "pool", 1.0)):
+    nattempts, peak, spread, reconnect, lost = restart_run(mode, nthreads, downtime, backoff_max)
+    print("%-10s %9d %11d %10.0f %14.0f %9.0f %9.0f %7d" % (name, nattempts, peak, spread*1000,
+        quantile(reconnect, 0.5)*1000, quantile(reconnect, 0.99)*1000, (reconnect[-1] if reconnect else float("nan"))*1000,
+        lost))
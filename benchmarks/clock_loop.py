@@ -0,0 +1,58 @@
+#
+# Clock-style connections: each server-side peer sends a short message and then skip()s for the interval,
+# like samples/clock/server.py. Clients echo every message back, so the skip() calls also receive data.
+# Reports the process CPU time per connection per second of wall time and per message sent.
+# Keep the load below one core, otherwise the numbers only show the saturated interpreter.
+#
+# usage: python benchmarks/clock_loop.py [connections [interval [duration]]]
+#
+
+import sys, time, threading
+from socket import socketpair
+from ws import WebsocketPeer
+
+Sent = [0]
+
+def server_loop(peer, interval, stop):
+    n = 0
+    while not stop.is_set() and not peer.closed():
+        peer.send(time.ctime())
+        n += 1
+        peer.skip(interval)
+    Sent[0] += n
+
+def client_loop(peer, stop):
+    try:
+        while not stop.is_set():
+            peer.send(peer.recv())
+    except Exception:
+        pass
+
+nconnections = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+interval = float(sys.argv[2]) if len(sys.argv) > 2 else 0.1
+duration = float(sys.argv[3]) if len(sys.argv) > 3 else 5.0
+
+stop = threading.Event()
+threads = []
+peers = []
+for _ in range(nconnections):
+    a, b = socketpair()
+    server, client = WebsocketPeer(a), WebsocketPeer(b, send_masked=True)
+    peers += [server, client]
+    threads.append(threading.Thread(target=server_loop, args=(server, interval, stop), daemon=True))
+    threads.append(threading.Thread(target=client_loop, args=(client, stop), daemon=True))
+
+cpu0 = time.process_time()
+t0 = time.monotonic()
+for t in threads:
+    t.start()
+time.sleep(duration)
+cpu = time.process_time() - cpu0
+wall = time.monotonic() - t0
+stop.set()
+for t in threads[::2]:
+    t.join()
+
+print(f"connections: {nconnections}, interval: {interval}, duration: {duration}")
+print("CPU per connection: %.3f ms/s, per message: %.1f us (total CPU %.2f s in %.2f s, %d messages)" % (
+    cpu/wall/nconnections*1000, cpu/Sent[0]*1e6, cpu, wall, Sent[0]))
@@ -0,0 +1,116 @@
+#
+# Message codecs vs. hand-rolled JSON
+#
+#   point-to-point  - N objects sent over a socket pair and decoded on the other side:
+#                     ws.send(json.dumps(obj)) / json.loads(ws.recv())  vs.  send_obj() / recv_obj()
+#                     with the json codec (orjson if installed) and msgpack (if installed)
+#   fan-out         - one object sent to P peers: json.dumps per peer  vs.  send_obj(Encoded(obj))  vs.
+#                     Broadcaster.publish_obj(), process CPU time per published object, including the threads
+#                     which read the data on the other side of the sockets
+#
+# usage: python benchmarks/codec.py [messages [peers]]
+#
+
+import sys, time, json, threading
+from socket import socketpair
+from ws import WebsocketPeer, Broadcaster, Encoded, codec
+
+Small = {"type": "update", "id": 12345, "user": "alice", "text": "hello, world", "tags": ["a", "b", "c"],
+            "position": {"x": 1.5, "y": -2.25}, "ok": True}
+Large = {"rows": [{"id": i, "name": "item-%d" % i, "price": i*0.25, "flags": [i % 2 == 0, i % 3 == 0]}
+            for i in range(1000)]}
+
+def drain(sock):
+    while sock.recv(1024*1024):
+        pass
+
+def point_to_point(obj, n, mode):
+    a, b = socketpair()
+    sender, receiver = WebsocketPeer(a), WebsocketPeer(b)
+    if mode != "hand-rolled":
+        sender.Codec = receiver.Codec = codec.get_codec(mode)
+    def send():
+        if mode == "hand-rolled":
+            for _ in range(n):
+                sender.send(json.dumps(obj))
+        else:
+            for _ in range(n):
+                sender.send_obj(obj)
+    t0 = time.perf_counter()
+    thread = threading.Thread(target=send)
+    thread.start()
+    if mode == "hand-rolled":
+        for _ in range(n):
+            json.loads(receiver.recv())
+    else:
+        for _ in range(n):
+            receiver.recv_obj()
+    elapsed = time.perf_counter() - t0
+    thread.join()
+    a.close()
+    b.close()
+    return elapsed/n*1e6
+
+def fanout(obj, n, npeers, mode):
+    pairs = [socketpair() for _ in range(npeers)]
+    peers = [WebsocketPeer(a) for a, b in pairs]
+    drainers = [threading.Thread(target=drain, args=(b,), daemon=True) for a, b in pairs]
+    for t in drainers:
+        t.start()
+    hub = None
+    if mode == "broadcaster":
+        hub = Broadcaster(max_pending=1 << 30)
+        hub.start()
+        for p in peers:
+            hub.subscribe(p)
+    t0 = time.process_time()
+    for _ in range(n):
+        if mode == "hand-rolled":
+            for p in peers:
+                p.send(json.dumps(obj))
+        elif mode == "encoded":
+            e = Encoded(obj)
+            for p in peers:
+                p.send_obj(e)
+        else:
+            hub.publish_obj(obj)
+    if hub is not None:
+        while any(s.Pending for s in list(hub.Subscribers.values())):
+            time.sleep(0.001)
+    elapsed = time.process_time() - t0
+    if hub is not None:
+        hub.stop()
+    for a, b in pairs:
+        a.close()
+        b.close()
+    return elapsed/n*1e6
+
+nmessages = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+npeers = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+modes = ["hand-rolled", "json"] + (["msgpack"] if "msgpack" in codec.Codecs else [])
+
+print("json codec: %s, msgpack: %s" % ("orjson" if codec.orjson is not None else "json module",
+    "installed" if codec.msgpack is not None else "not installed"))
+print()
+print("point-to-point, us per message")
+print("%-8s %8s" % ("object", "bytes") + "".join("%14s" % m for m in modes))
+for name, obj in (("small", Small), ("large", Large)):
+    n = nmessages if obj is Small else max(100, nmessages//200)
+    size = len(json.dumps(obj))
+    times = {}
+    for mode in modes * 3:                  # alternated, best of three
+        t = point_to_point(obj, n, mode)
+        times[mode] = min(times.get(mode, t), t)
+    print("%-8s %8d" % (name, size) + "".join("%14.1f" % times[m] for m in modes))
+
+print()
+print(f"fan-out to {npeers} peers, CPU us per published object")
+fanout_modes = ["hand-rolled", "encoded", "broadcaster"]
+print("%-8s" % ("object",) + "".join("%14s" % m for m in fanout_modes))
+for name, obj in (("small", Small), ("large", Large)):
+    n = max(20, nmessages//npeers) if obj is Small else max(5, nmessages//(npeers*50))
+    times = {}
+    for mode in fanout_modes * 3:
+        t = fanout(obj, n, npeers, mode)
+        times[mode] = min(times.get(mode, t), t)
+    print("%-8s" % (name,) + "".join("%14.0f" % times[m] for m in fanout_modes))
@@ -0,0 +1,120 @@
+#
+# Ping round trip time while the server sends large messages
+#
+# A sender thread sends messages of the given size to the client as fast as the client reads them, while the
+# server pings the client every 50 ms the way the HeartbeatManager does. The client answers the pings with pongs as it
+# reads. The round trip time of a ping is how long it waits behind the data sent before it, compared for
+# messages sent in one frame (InterleaveSize=None) and split into fragments with the pings sent between
+# them (InterleaveSize=256K), with and without the write queue. Without interleaving and without the write
+# queue, the pings are starved: the sender takes the send lock again right after each message.
+#
+# The client reads at a limited rate (bandwidth, MB/s), as a remote client on a slow link would, so that the
+# socket buffers stay full.
+#
+# usage: python benchmarks/control_latency.py [seconds [message size MB [bandwidth MB/s]]]
+#
+
+import sys, time, threading, struct
+from socket import socketpair
+from ws import WebsocketPeer
+from ws.heartbeat import HeartbeatManager
+
+class Pinger(HeartbeatManager):
+
+    # sends the pings with HeartbeatManager.send_ping(), every interval seconds regardless of ping_timeout,
+    # and records the round trip times
+
+    def __init__(self):
+        HeartbeatManager.__init__(self)
+        self.Sent = {}              # payload -> time of the first attempt to send the ping
+        self.RTTs = []
+        self.Pings = 0
+
+    def ping_loop(self, peer, interval, stop):
+        counter = 0
+        while not stop.is_set():
+            counter += 1
+            payload = struct.pack("!Q", counter)
+            self.Sent[payload] = time.monotonic()
+            try:
+                while not self.send_ping(peer, payload) and not stop.is_set():
+                    time.sleep(0.001)           # the manager retries every tick
+            except (OSError, AttributeError):
+                break                           # closed
+            time.sleep(interval)
+        self.Pings = counter
+
+    def pong(self, peer, payload):
+        t = self.Sent.pop(payload, None)
+        if t is not None:
+            self.RTTs.append(time.monotonic() - t)
+
+def run(duration, size, bandwidth, interleave, write_queue):
+    a, b = socketpair()
+    server = WebsocketPeer(a, write_queue=write_queue or None)
+    server.InterleaveSize = interleave
+    client = WebsocketPeer(b, send_masked=True)
+    client.Buffer.ChunkSize = 64*1024
+    pinger = Pinger()
+    pinger.register(server)
+    payload = b"x" * size
+    stop = threading.Event()
+
+    def send():
+        try:
+            while not stop.is_set():
+                server.send(payload)
+        except Exception:
+            pass
+
+    def read_pongs():
+        try:
+            while True:
+                server.recv()
+        except Exception:
+            pass
+
+    def read():
+        t0 = time.monotonic()
+        received = 0
+        try:
+            while True:
+                _, _, data = client.recv_fragment()
+                received += len(data)
+                delay = t0 + received/bandwidth - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+        except Exception:
+            pass
+
+    threads = [threading.Thread(target=f, daemon=True) for f in (send, read_pongs, read)]
+    threads.append(threading.Thread(target=pinger.ping_loop, args=(server, 0.05, stop), daemon=True))
+    for t in threads:
+        t.start()
+    time.sleep(duration)
+    stop.set()
+    rtts = sorted(pinger.RTTs)
+    for s in (a, b):
+        try:    s.shutdown(2)
+        except OSError:
+            pass
+    for t in threads:
+        t.join(5)
+    a.close()
+    b.close()
+    return pinger.Pings, rtts
+
+def quantile(values, q):
+    return values[min(len(values) - 1, int(q*len(values)))] if values else float("nan")
+
+duration = float(sys.argv[1]) if len(sys.argv) > 1 else 3.0
+size = int(float(sys.argv[2]) * 1024 * 1024) if len(sys.argv) > 2 else 8*1024*1024
+bandwidth = float(sys.argv[3]) * 1024 * 1024 if len(sys.argv) > 3 else 200*1024*1024
+
+print(f"message size: {size} bytes, client reads at {bandwidth/1024/1024:.0f} MB/s, {duration} seconds per run")
+print("%-12s %-12s %8s %8s %10s %10s %10s" % ("interleave", "write queue", "pings", "pongs", "p50 ms", "p99 ms", "max ms"))
+for write_queue in (False, True):
+    for interleave in (None, 256*1024):
+        pings, rtts = run(duration, size, bandwidth, interleave, write_queue)
+        print("%-12s %-12s %8d %8d %10.1f %10.1f %10.1f" % (interleave or "off", "on" if write_queue else "off", pings, len(rtts),
+            quantile(rtts, 0.5)*1000, quantile(rtts, 0.99)*1000, (rtts[-1] if rtts else float("nan"))*1000))
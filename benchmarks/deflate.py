@@ -0,0 +1,60 @@
+#
+# permessage-deflate: compression ratio and CPU cost per connection for JSON messages echoed over loopback
+#
+# usage: python benchmarks/deflate.py [messages]
+#
+
+import sys, time, json, random
+from ws import WSApp, WSHandler, WebsocketServer, connect
+
+Port = 18880
+
+class EchoHandler(WSHandler):
+
+    def on_message(self, ws, message):
+        ws.send(message)
+
+def make_message(nrecords):
+    return json.dumps([
+        {"id": i, "user": "user%d" % (random.randint(0, 1000),), "score": random.random(), "tags": ["alpha", "beta"]}
+        for i in range(nrecords)
+    ])
+
+nmessages = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+server = WebsocketServer(Port, WSApp(EchoHandler), compression=True)
+server.daemon = True
+server.start()
+time.sleep(0.2)
+
+configs = [
+    ("off", None),
+    ("default", {}),
+    ("threshold=1024", {"threshold": 1024}),
+    ("level=1", {"level": 1}),
+    ("no_context_takeover", {"client_no_context_takeover": True, "server_no_context_takeover": True}),
+    ("window_bits=10", {"client_max_window_bits": 10, "server_max_window_bits": 10}),
+]
+
+print("%-20s %8s %8s %12s %14s %14s" % ("config", "size", "ratio", "msgs/sec", "compress us", "decompress us"))
+for nrecords in (1, 10, 100):
+    messages = [make_message(nrecords) for _ in range(100)]
+    for name, options in configs:
+        client = connect(f"ws://localhost:{Port}/", compression=options)
+        t0 = time.time()
+        for i in range(nmessages):
+            message = messages[i % len(messages)]
+            client.send(message)
+            client.recv()
+        dt = time.time() - t0
+        size = sum(len(m) for m in messages)//len(messages)
+        if client.Deflate is not None:
+            stats = client.Deflate.stats()
+            ratio = "%8.2f" % (stats["sent_ratio"],) if stats["sent_ratio"] else "%8s" % ("-",)
+            compress = stats["compress_cpu_time"]/nmessages*1e6
+            decompress = stats["decompress_cpu_time"]/nmessages*1e6
+        else:
+            ratio, compress, decompress = "%8s" % ("-",), 0.0, 0.0
+        print("%-20s %8d %s %12.0f %14.1f %14.1f" % (name, size, ratio, nmessages/dt, compress, decompress))
+        client.close()
+    print()
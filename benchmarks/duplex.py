@@ -0,0 +1,107 @@
+#
+# Concurrent send + receive on one WebsocketPeer: one reader thread receives messages while several writer
+# threads send, for a fixed time. Reports messages per second in each direction and the number of messages
+# the reader got while the writers were running, with and without the write queue.
+#
+# The other end of the socketpair is driven with prebuilt frames and a plain recv_into() loop, so that it
+# never holds up the peer under test.
+#
+# Given several source trees, imports the ws package from each, like peer_echo.py:
+#
+#   git worktree add /tmp/base HEAD~1
+#   python benchmarks/duplex.py 2 /tmp/base .
+#
+# usage: python benchmarks/duplex.py [seconds [tree ...]]
+#
+
+import sys, time, os, threading, importlib.util
+from socket import socketpair
+
+def load(tree, index):
+    path = os.path.join(tree, "ws", "__init__.py")
+    name = "ws_%d" % (index,)
+    spec = importlib.util.spec_from_file_location(name, path, submodule_search_locations=[os.path.dirname(path)])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def feed(sock, frame, stop):
+    batch = frame * (64*1024//len(frame))
+    try:
+        while not stop.is_set():
+            sock.sendall(batch)
+    except OSError:
+        pass
+
+def drain(sock):
+    buf = bytearray(1024*1024)
+    try:
+        while sock.recv_into(buf):
+            pass
+    except OSError:
+        pass
+
+def run(module, nwriters, write_queue, duration, size=100):
+    a, b = socketpair()
+    peer = module.WebsocketPeer(a, write_queue=True if write_queue else None)
+    mask = os.urandom(4)
+    frame = module.ws.frame_header(True, 2, size, mask) + bytes(module.mask.apply_mask(mask, b"x"*size))
+    stop = threading.Event()
+    received = [0]
+    sent = [0]*nwriters
+
+    def reader():
+        try:
+            while not stop.is_set():
+                peer.recv()
+                received[0] += 1
+        except Exception:
+            pass
+
+    def writer(i):
+        message = b"y"*size
+        try:
+            while not stop.is_set():
+                peer.send(message)
+                sent[i] += 1
+        except Exception:
+            pass
+
+    threads = [threading.Thread(target=feed, args=(b, frame, stop), daemon=True),
+               threading.Thread(target=drain, args=(b,), daemon=True),
+               threading.Thread(target=reader, daemon=True)]
+    threads += [threading.Thread(target=writer, args=(i,), daemon=True) for i in range(nwriters)]
+    for t in threads:
+        t.start()
+    time.sleep(duration)
+    stop.set()
+    nsent, nreceived = sum(sent), received[0]
+    try:    peer.shutdown()
+    except Exception:
+        pass
+    b.close()
+    for t in threads:
+        t.join(2)
+    return nsent/duration, nreceived/duration
+
+duration = float(sys.argv[1]) if len(sys.argv) > 1 else 2.0
+trees = sys.argv[2:]
+if trees:
+    modules = [(tree, load(tree, i)) for i, tree in enumerate(trees)]
+else:
+    import ws, ws.ws, ws.mask
+    modules = [("ws", ws)]
+
+print("%-24s %-6s %8s %14s %14s" % ("tree", "queue", "writers", "sent msgs/s", "recvd msgs/s"))
+for write_queue in (False, True):
+    for nwriters in (1, 2, 4, 8):
+        results = {}
+        for _ in range(2):                  # alternated, best of two
+            for name, module in modules:
+                s, r = run(module, nwriters, write_queue, duration)
+                best = results.get(name, (0, 0))
+                results[name] = (max(best[0], s), max(best[1], r))
+        for name, module in modules:
+            s, r = results[name]
+            print("%-24s %-6s %8d %14.0f %14.0f" % (name[-24:], "on" if write_queue else "off", nwriters, s, r))
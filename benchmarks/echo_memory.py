@@ -0,0 +1,99 @@
+#
+# Memory cost of the receive path: an echo loop over a socketpair, recv() + send() vs. recv_message() + send()
+# with pooled buffers, for several message sizes.
+#
+# The incoming masked frames are prebuilt and written by a feeder thread, the echoed ones are drained into
+# a fixed buffer by another thread, so the allocations measured are those of the echo loop itself.
+# Each mode runs in a fresh process and reports:
+#
+#   us/msg          - time per echoed message
+#   faults/msg      - minor page faults per message. Large buffers are allocated with mmap() and returned
+#                     to the system when freed, so each one costs page faults: this counts the allocation
+#                     churn of large messages, which CPython does not report otherwise
+#   peak traced KB  - peak of the memory allocated by Python while echoing, from tracemalloc in a separate run
+#   max RSS         - peak resident set size of the process
+#
+# usage: python benchmarks/echo_memory.py [messages]
+#
+
+import sys, os, time, threading, subprocess, resource, tracemalloc
+from socket import socketpair
+
+def feed(sock, frame, n):
+    for _ in range(n):
+        sock.sendall(frame)
+
+def drain(sock, nbytes):
+    buf = bytearray(1024*1024)
+    received = 0
+    while received < nbytes:
+        k = sock.recv_into(buf)
+        if not k:
+            break
+        received += k
+
+def echo(mode, size, n, trace):
+    from ws import WebsocketPeer
+    from ws.ws import frame_header
+    from ws.mask import apply_mask
+    mask = os.urandom(4)
+    payload = os.urandom(size)
+    frame = frame_header(True, 2, size, mask) + bytes(apply_mask(mask, payload))
+    in_a, in_b = socketpair()
+    out_a, out_b = socketpair()
+    receiver = WebsocketPeer(in_b)
+    sender = WebsocketPeer(out_a)
+    echoed = len(frame_header(True, 2, size)) + size
+    feeder = threading.Thread(target=feed, args=(in_a, frame, n + 10), daemon=True)
+    drainer = threading.Thread(target=drain, args=(out_b, (n + 10)*echoed), daemon=True)
+    feeder.start()
+    drainer.start()
+
+    def step():
+        if mode == "recv":
+            sender.send(receiver.recv())
+        else:
+            with receiver.recv_message() as message:
+                sender.send(message)
+
+    for _ in range(10):                 # warm up, e.g. the buffer pool
+        step()
+    if trace:
+        tracemalloc.start()
+        for _ in range(n):
+            step()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak,
+    usage0 = resource.getrusage(resource.RUSAGE_SELF)
+    t0 = time.perf_counter()
+    for _ in range(n):
+        step()
+    elapsed = time.perf_counter() - t0
+    usage1 = resource.getrusage(resource.RUSAGE_SELF)
+    drainer.join()
+    return elapsed/n*1e6, (usage1.ru_minflt - usage0.ru_minflt)/n, usage1.ru_maxrss/1024
+
+if len(sys.argv) > 1 and sys.argv[1] == "--run":
+    mode, size, n, trace = sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), sys.argv[5] == "1"
+    print(*echo(mode, size, n, trace))
+    sys.exit(0)
+
+def run(mode, size, n, trace=False):
+    out = subprocess.run([sys.executable, __file__, "--run", mode, str(size), str(n), "1" if trace else "0"],
+        capture_output=True, text=True, check=True).stdout
+    return [float(x) for x in out.split()]
+
+nmessages = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+print("%-8s %-7s %10s %12s %14s %12s" % ("size", "mode", "us/msg", "faults/msg", "peak traced KB", "max RSS MB"))
+for size in (64, 4*1024, 64*1024, 1024*1024):
+    n = max(200, nmessages*64//size) if size > 4096 else nmessages
+    results = {}
+    for mode in ("recv", "pooled") * 4:                # alternated, best of four
+        result = run(mode, size, n)
+        results[mode] = min(results.get(mode, result), result)
+    for mode in ("recv", "pooled"):
+        us, faults, rss = results[mode]
+        peak, = run(mode, size, min(n, 2000), trace=True)
+        print("%-8d %-7s %10.1f %12.2f %14.0f %12.1f" % (size, mode, us, faults, peak/1024, rss))
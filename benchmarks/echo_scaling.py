@@ -0,0 +1,57 @@
+#
+# Echo throughput of WSApp.run_server(workers=N) on loopback, for N = 1 ... max_workers
+#
+# usage: python benchmarks/echo_scaling.py [max_workers [clients [seconds [message_size]]]]
+#
+
+import sys, os, time, signal
+import multiprocessing
+from ws import WSApp, WSHandler, connect
+
+Port = 18870
+
+class EchoHandler(WSHandler):
+
+    def on_message(self, ws, message):
+        ws.send(message)
+
+def run_server(workers):
+    WSApp(EchoHandler).run_server(Port, reactor=True, workers=workers)
+
+def run_client(args):
+    duration, size = args
+    message = b"x" * size
+    for attempt in range(50):
+        try:
+            client = connect(f"ws://localhost:{Port}/echo")
+            break
+        except ConnectionError:
+            time.sleep(0.1)
+    n = 0
+    t1 = time.time() + duration
+    while time.time() < t1:
+        client.send(message)
+        client.recv()
+        n += 1
+    client.close()
+    return n
+
+max_workers = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count()
+nclients = int(sys.argv[2]) if len(sys.argv) > 2 else 2*max_workers
+duration = float(sys.argv[3]) if len(sys.argv) > 3 else 3.0
+size = int(sys.argv[4]) if len(sys.argv) > 4 else 100
+
+print(f"clients: {nclients}, message size: {size}, duration: {duration} sec")
+print("%8s %12s %10s" % ("workers", "msgs/sec", "speedup"))
+base = None
+for workers in range(1, max_workers+1):
+    server = multiprocessing.Process(target=run_server, args=(workers,))
+    server.start()
+    time.sleep(0.5)
+    with multiprocessing.Pool(nclients) as pool:
+        counts = pool.map(run_client, [(duration, size)] * nclients)
+    os.kill(server.pid, signal.SIGTERM)
+    server.join()
+    rate = sum(counts)/duration
+    base = base or rate
+    print("%8d %12.0f %10.2f" % (workers, rate, rate/base))
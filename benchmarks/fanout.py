@@ -0,0 +1,95 @@
+#
+# Fan-out: time to deliver M messages to N subscribers with a per-peer send() loop vs. the Broadcaster
+#
+# Subscribers are server-side WebsocketPeer objects on socketpair() connections. A reader thread drains
+# the other ends. Every subscriber takes 2 file descriptors, so 10000 subscribers need "ulimit -n" > 20000.
+#
+# The "hub+stalled" run adds one subscriber which never reads. The Broadcaster drops messages for it
+# once it has max_pending bytes queued, and the other subscribers are not affected.
+#
+# usage: python benchmarks/fanout.py [messages [message_size [max_pending]]]
+#
+
+import sys, time, selectors, threading, resource
+from socket import socketpair
+from ws import WebsocketPeer, Broadcaster
+
+class Reader(threading.Thread):
+
+    def __init__(self, socks):
+        threading.Thread.__init__(self, daemon=True)
+        self.Selector = selectors.DefaultSelector()
+        for s in socks:
+            s.setblocking(False)
+            self.Selector.register(s, selectors.EVENT_READ)
+        self.Expected = None            # set by the publisher when it is known
+        self.Received = 0
+        self.Done = threading.Event()
+
+    def run(self):
+        while self.Expected is None or self.Received < self.Expected:
+            for key, events in self.Selector.select(0.1):
+                try:    self.Received += len(key.fileobj.recv(1024*1024))
+                except BlockingIOError:
+                    pass
+        self.Done.set()
+
+def frame_size(message):
+    n = len(message)
+    return n + (2 if n < 126 else 4 if n < 65536 else 10)
+
+def run(method, n, message, nmessages, max_pending, stalled=False):
+    pairs = [socketpair() for _ in range(n)]
+    peers = [WebsocketPeer(a) for a, b in pairs]
+    reader = Reader([b for a, b in pairs])
+    reader.start()
+    if stalled:
+        stalled_pair = socketpair()
+        pairs.append(stalled_pair)
+    t0 = time.time()
+    dropped = 0
+    if method == "loop":
+        for _ in range(nmessages):
+            for peer in peers:
+                peer.send(message)
+        delivered = n*nmessages
+    else:
+        broadcaster = Broadcaster(max_pending=max_pending)
+        broadcaster.start()
+        for peer in peers:
+            broadcaster.subscribe(peer)
+        if stalled:
+            stalled_peer = WebsocketPeer(stalled_pair[0])
+            broadcaster.subscribe(stalled_peer)
+        for _ in range(nmessages):
+            broadcaster.publish(message)
+        delivered = sum(broadcaster.Subscribers[peer].Delivered for peer in peers)
+        if stalled:
+            dropped = broadcaster.Subscribers[stalled_peer].Dropped
+    reader.Expected = delivered * frame_size(message)
+    reader.Done.wait()
+    dt = time.time() - t0
+    if method == "hub":
+        broadcaster.stop()
+    for a, b in pairs:
+        a.close()
+        b.close()
+    return delivered/dt, dropped
+
+nmessages = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+size = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+max_pending = int(sys.argv[3]) if len(sys.argv) > 3 else 1024*1024
+message = "x" * size
+max_subscribers = (resource.getrlimit(resource.RLIMIT_NOFILE)[0] - 100)//2
+
+print(f"messages: {nmessages}, message size: {size}, max pending: {max_pending}")
+print("%12s %14s %14s %14s %16s" % ("subscribers", "loop msgs/s", "hub msgs/s", "hub+stalled", "stalled dropped"))
+for n in (1, 10, 100, 1000, 10000):
+    if n > max_subscribers:
+        print("%12d  skipped: not enough file descriptors" % (n,))
+        continue
+    line = "%12d" % (n,)
+    for method, stalled in (("loop", False), ("hub", False), ("hub", True)):
+        rate, dropped = run(method, n, message, nmessages, max_pending, stalled)
+        line += " %14.0f" % (rate,)
+    print(line + " %16d" % (dropped,))
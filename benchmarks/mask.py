@@ -0,0 +1,50 @@
+#
+# Masking throughput, MB/s, for payloads from 16 bytes to 16 MB
+#
+# usage: python benchmarks/mask.py [min_time]
+#
+
+import sys, os, time
+from ws import mask as ws_mask
+
+def mask_legacy(mask, buf):
+    # the original per-byte implementation of WebsocketPeer.mask
+    n = (len(buf)+3)//4
+    mask = (mask*n)[:len(buf)]
+    return bytes([x^m for x, m in zip(buf, mask)])
+
+def mask_inplace(mask, buf):
+    return ws_mask.apply_mask(mask, buf, buf)
+
+def measure(fcn, mask, data, min_time):
+    n = 0
+    t0 = time.perf_counter()
+    t1 = t0
+    while t1 < t0 + min_time:
+        fcn(mask, data)
+        n += 1
+        t1 = time.perf_counter()
+    return len(data) * n / (t1 - t0) / 1e6
+
+min_time = float(sys.argv[1]) if len(sys.argv) > 1 else 0.5
+
+engines = [
+    ("legacy", mask_legacy),
+    ("int", ws_mask.mask_int),
+    ("auto", ws_mask.apply_mask),
+    ("auto-inplace", mask_inplace)
+]
+if ws_mask.numpy is not None:
+    engines.insert(2, ("numpy", ws_mask.mask_numpy))
+
+print("%10s" % ("size",) + "".join("%14s" % (name,) for name, _ in engines) + "    (MB/s)")
+mask = os.urandom(4)
+for size in [16, 256, 4*1024, 64*1024, 1024*1024, 16*1024*1024]:
+    data = bytearray(os.urandom(size))
+    line = "%10d" % (size,)
+    for name, fcn in engines:
+        if name == "legacy" and size > 1024*1024:
+            line += "%14s" % ("-",)
+            continue
+        line += "%14.1f" % (measure(fcn, mask, data, min_time),)
+    print(line)
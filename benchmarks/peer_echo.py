@@ -0,0 +1,62 @@
+#
+# In-process echo round trip time over a socketpair, no network and no threads. Used to measure small
+# per-frame costs, e.g. of the metrics counters, which are hidden by noise in the loopback benchmarks.
+#
+# Given several source trees, imports the ws package from each and runs them in alternating order,
+# so that CPU frequency drift affects all of them alike:
+#
+#   git worktree add /tmp/base HEAD~1
+#   python benchmarks/peer_echo.py /tmp/base .
+#
+# usage: python benchmarks/peer_echo.py [tree ...]       (default: the installed ws package)
+#
+
+import sys, time, os, importlib.util
+from socket import socketpair
+
+Rounds = 40
+Messages = 2000
+
+def load(tree, index):
+    # imports <tree>/ws under a unique name, so several versions can be loaded together
+    path = os.path.join(tree, "ws", "__init__.py")
+    name = "ws_%d" % (index,)
+    spec = importlib.util.spec_from_file_location(name, path, submodule_search_locations=[os.path.dirname(path)])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def run(server, client, n):
+    t0 = time.perf_counter()
+    for _ in range(n):
+        client.send("hello world")
+        server.recv()
+        server.send("hello world")
+        client.recv()
+    return (time.perf_counter() - t0)/n*1e6
+
+trees = sys.argv[1:]
+if trees:
+    modules = [(tree, load(tree, i)) for i, tree in enumerate(trees)]
+else:
+    import ws
+    modules = [("ws", ws)]
+
+pairs = []
+for name, module in modules:
+    a, b = socketpair()
+    pairs.append((name, module.WebsocketPeer(a), module.WebsocketPeer(b, send_masked=True), []))
+
+for r in range(Rounds):
+    k = r % len(pairs)
+    for name, server, client, times in pairs[k:] + pairs[:k]:
+        times.append(run(server, client, Messages))
+
+print("%-30s %12s %12s" % ("tree", "min, us/rt", "median"))
+base = None
+for name, server, client, times in pairs:
+    times.sort()
+    median = times[len(times)//2]
+    base = base or median
+    print("%-30s %12.2f %12.2f %+7.1f%%" % (name, times[0], median, (median/base - 1)*100))
@@ -0,0 +1,136 @@
+#
+# Fairness under abusive clients: a ReactorServer echoes messages after some CPU work, while a few abusive
+# clients flood it and well-behaved clients send a timestamped message every 20 ms. Reports the round trip
+# latency of the well-behaved clients alone, then with the flood and no rate limit, and with the flood and
+# each rate limit policy:
+#
+#   delay   - the flooding connections are taken off the selector while over their limit, TCP backpressure
+#             slows them down
+#   drop    - their messages over the limit are discarded, after being read
+#   close   - they are disconnected with 1008. The abusive clients reconnect and start again
+#
+# The limit is set above the rate of the well-behaved clients, which are never limited. The server and the
+# abusive clients run in separate processes, so that they do not hold up the measuring clients on the GIL.
+#
+# usage: python benchmarks/rate_limit.py [seconds [abusive clients [well-behaved clients]]]
+#
+
+import sys, time, struct, threading, subprocess
+from ws import WSApp, WSHandler, ReactorServer, RateLimit, connect
+
+Port = 18700
+WorkSeconds = 0.0002                # CPU time per message on the server
+Limit = 100                         # messages per second per connection, with a burst of 0.5 s
+Interval = 0.02                     # between messages of the well-behaved clients
+
+class EchoHandler(WSHandler):
+
+    def on_message(self, ws, message):
+        t1 = time.perf_counter() + WorkSeconds
+        while time.perf_counter() < t1:
+            pass
+        ws.send(message)
+
+def serve(policy):
+    limit = None if policy == "none" else RateLimit(messages=Limit, burst=0.5, policy=policy)
+    app = WSApp({"/echo": (EchoHandler, limit)})
+    server = ReactorServer(Port, app, select_timeout=0.1)
+    server.start()
+    server.join()
+
+def abuse(nclients):
+    stop = threading.Event()
+    message = b"x"*100
+
+    def drain(ws):
+        try:
+            while ws.recv() is not None and not ws.closed():
+                pass
+        except Exception:
+            pass
+
+    def flood():
+        while not stop.is_set():
+            try:
+                ws = connect("ws://127.0.0.1:%d/echo" % (Port,))
+            except OSError:
+                time.sleep(0.1)
+                continue
+            threading.Thread(target=drain, args=(ws,), daemon=True).start()
+            try:
+                while not ws.closed():
+                    ws.send(message)
+            except Exception:
+                pass
+            time.sleep(0.1)                 # closed by the server, reconnect
+
+    for _ in range(nclients):
+        threading.Thread(target=flood, daemon=True).start()
+    sys.stdin.read()                        # until the parent closes the pipe
+
+def measure(nclients, duration):
+    latencies = []
+    lock = threading.Lock()
+
+    def client():
+        ws = connect("ws://127.0.0.1:%d/echo" % (Port,))
+        mine = []
+        t_end = time.monotonic() + duration
+        next_send = time.monotonic()
+        while time.monotonic() < t_end:
+            ws.send(struct.pack("!d", time.perf_counter()) + b"y"*92)
+            reply = ws.recv(timeout=10)
+            mine.append(time.perf_counter() - struct.unpack("!d", reply[:8])[0])
+            next_send += Interval
+            delay = next_send - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_send = time.monotonic()
+        ws.close()
+        with lock:
+            latencies.extend(mine)
+
+    threads = [threading.Thread(target=client) for _ in range(nclients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sorted(latencies)
+
+def quantile(values, q):
+    return values[min(len(values) - 1, int(q*len(values)))] if values else float("nan")
+
+def start(*args, **kw):
+    return subprocess.Popen([sys.executable, __file__] + [str(a) for a in args], **kw)
+
+if len(sys.argv) > 1 and sys.argv[1] == "--serve":
+    serve(sys.argv[2])
+    sys.exit(0)
+if len(sys.argv) > 1 and sys.argv[1] == "--abuse":
+    abuse(int(sys.argv[2]))
+    sys.exit(0)
+
+duration = float(sys.argv[1]) if len(sys.argv) > 1 else 5.0
+nabusive = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+ngood = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+print(f"{ngood} clients sending every {Interval*1000:.0f} ms, {nabusive} abusive clients, "
+      f"limit {Limit} msgs/s per connection, {duration} seconds per run")
+print("%-8s %-8s %8s %10s %10s %10s" % ("flood", "policy", "msgs", "p50 ms", "p99 ms", "max ms"))
+for flood, policy in [(False, "none"), (True, "none"), (True, "delay"), (True, "drop"), (True, "close")]:
+    server = start("--serve", policy)
+    time.sleep(1.0)
+    abuser = start("--abuse", nabusive, stdin=subprocess.PIPE) if flood else None
+    try:
+        time.sleep(1.0)                     # let the flood build up
+        latencies = measure(ngood, duration)
+    finally:
+        if abuser is not None:
+            abuser.stdin.close()
+            abuser.kill()
+            abuser.wait()
+        server.kill()
+        server.wait()
+    print("%-8s %-8s %8d %10.2f %10.2f %10.2f" % ("on" if flood else "off", policy, len(latencies),
+        quantile(latencies, 0.5)*1000, quantile(latencies, 0.99)*1000, latencies[-1]*1000 if latencies else float("nan")))
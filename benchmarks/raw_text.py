@@ -0,0 +1,67 @@
+#
+# Raw text relay: a peer receives text messages and sends each one on to another connection, as a relay
+# handler does, with recv() decoding to str and send() re-encoding it (str), vs. recv(raw_text=True)
+# passing the validated UTF-8 bytes through (raw).
+#
+# The incoming frames are prebuilt and written by a feeder thread, the outgoing ones are drained by another
+# thread, so the time measured is mostly the relay loop itself.
+#
+# usage: python benchmarks/raw_text.py [messages]
+#
+
+import sys, time, threading
+from socket import socketpair
+from ws import WebsocketPeer
+from ws.ws import frame_header
+
+def feed(sock, frame, n):
+    batch = frame * max(1, 64*1024//len(frame))
+    per_batch = len(batch)//len(frame)
+    sent = 0
+    while sent < n:
+        k = min(per_batch, n - sent)
+        sock.sendall(batch if k == per_batch else frame*k)
+        sent += k
+
+def drain(sock, nbytes):
+    received = 0
+    while received < nbytes:
+        data = sock.recv(1024*1024)
+        if not data:
+            break
+        received += len(data)
+
+def run(n, payload, raw_text):
+    in_a, in_b = socketpair()
+    out_a, out_b = socketpair()
+    frame = frame_header(True, 1, len(payload)) + payload
+    relay_in = WebsocketPeer(in_b, raw_text=raw_text)
+    relay_out = WebsocketPeer(out_a)
+    feeder = threading.Thread(target=feed, args=(in_a, frame, n), daemon=True)
+    drainer = threading.Thread(target=drain, args=(out_b, n*len(frame)), daemon=True)
+    feeder.start()
+    drainer.start()
+    t0 = time.perf_counter()
+    for _ in range(n):
+        relay_out.send(relay_in.recv())
+    elapsed = time.perf_counter() - t0
+    drainer.join()
+    for s in (in_a, in_b, out_a, out_b):
+        s.close()
+    return n/elapsed, elapsed/n*1e6
+
+nmessages = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+print(f"messages: {nmessages}")
+print("%-8s %10s %12s %12s %12s %12s %8s" % ("text", "size", "str msgs/s", "raw msgs/s", "str us/msg", "raw us/msg", "gain"))
+for kind, unit in (("ascii", "abcdefgh"), ("utf-8", "абвгдежз")):
+    for size in (32, 1024, 64*1024, 1024*1024):
+        payload = (unit * (size//len(unit) + 1)).encode("utf-8")[:size]
+        payload = payload.decode("utf-8", "ignore").encode("utf-8")         # do not cut a character
+        n = max(200, nmessages*32//size) if size > 1024 else nmessages
+        results = {}
+        for mode in ("str", "raw") * 4:                        # alternated, best of four
+            rate, us = run(n, payload, mode == "raw")
+            results[mode] = min(results.get(mode, us), us)
+        print("%-8s %10d %12.0f %12.0f %12.1f %12.1f %7.0f%%" % (kind, size, 1e6/results["str"], 1e6/results["raw"],
+            results["str"], results["raw"], (results["str"]/results["raw"] - 1)*100))
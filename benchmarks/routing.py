@@ -0,0 +1,60 @@
+#
+# Routing: handshake path resolution with the linear fnmatch scan vs. the compiled Router,
+# with and without its LRU cache, for 10, 100 and 1000 routes.
+#
+# usage: python benchmarks/routing.py [lookups]
+#
+
+import sys, time, random, fnmatch
+from ws.router import Router
+
+def make_routes(n):
+    routes = []
+    for i in range(n):
+        kind = i % 3
+        if kind == 0:
+            routes.append(("/service%d/*" % (i,), i))
+        elif kind == 1:
+            routes.append(("/api/v1/item%d/{id}" % (i,), i))
+        else:
+            routes.append(("/static/page%d.html" % (i,), i))
+    routes.append(("*", n))
+    return routes
+
+def make_paths(n, count, distinct):
+    paths = []
+    for i in range(distinct):
+        k = random.randrange(n)
+        kind = k % 3
+        if kind == 0:
+            paths.append("/service%d/x/%d" % (k, i))
+        elif kind == 1:
+            paths.append("/api/v1/item%d/%d" % (k, i))
+        else:
+            paths.append("/static/page%d.html" % (k,))
+    return [random.choice(paths) for _ in range(count)]
+
+def linear(routes, path):
+    for pattern, target in routes:
+        if fnmatch.fnmatch(path, pattern):
+            return target
+
+def run(f, paths):
+    t0 = time.perf_counter()
+    for path in paths:
+        f(path)
+    return len(paths)/(time.perf_counter() - t0)
+
+nlookups = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+print("%8s %16s %16s %16s" % ("routes", "fnmatch/s", "router/s", "router+cache/s"))
+for n in (10, 100, 1000):
+    routes = make_routes(n)
+    paths = make_paths(n, nlookups, 1000)
+    fnmatch_rate = run(lambda path: linear(routes, path), paths[:max(1000, nlookups//n)])
+    router = Router(routes, cache_size=0)
+    router.resolve(paths[0])
+    router_rate = run(router.resolve, paths)
+    cached = Router(routes)
+    cached_rate = run(cached.resolve, paths)
+    print("%8d %16.0f %16.0f %16.0f" % (n, fnmatch_rate, router_rate, cached_rate))
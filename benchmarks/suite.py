@@ -0,0 +1,456 @@
+#
+# Benchmark suite: the ws package over loopback, results as JSON
+#
+#   echo/<size>             - echo round trip latency (p50, p99) and throughput, 16 B ... 16 MB
+#   masked/<size>, unmasked/<size>
+#                           - echo with the client sending masked (RFC 6455) and unmasked frames
+#   whole/<size>, fragmented/<size>/<fragment>
+#                           - echo of large messages sent as one frame or as fragments
+#   handshake               - connect + close rate and connect latency
+#   fanout/<subscribers>    - server sending each published message to N subscribers, messages delivered per second
+#
+# The server runs in a separate process, the clients in this one. If the websockets library is installed,
+# the echo and handshake benchmarks are repeated with a websockets server and client as a reference.
+#
+# usage:
+#   python benchmarks/suite.py [options]                    - benchmark the ws package of this tree
+#   python benchmarks/suite.py --tree DIR [options]         - benchmark DIR/ws, e.g. a git worktree
+#   python benchmarks/suite.py --compare REV1 REV2 [options]
+#                                                           - check out both git revisions into temporary
+#                                                             worktrees, benchmark each, print the comparison
+#   python benchmarks/suite.py --diff OLD.json NEW.json     - compare saved results
+#
+# options:
+#   -o FILE             write the JSON results to FILE (default: stdout)
+#   -d SECONDS          time per measurement, default 1
+#   --quick             sizes up to 1 MB, fewer subscribers
+#   --only a,b,...      run only these groups: echo, masking, fragments, handshake, fanout, reference
+#   --no-reference      skip the websockets reference
+#
+
+import sys, os, time, json, getopt, subprocess, tempfile, socket, selectors, threading, platform, shutil
+
+Sizes = [16, 256, 4096, 65536, 1024*1024, 16*1024*1024]
+QuickSizes = [16, 256, 4096, 65536, 1024*1024]
+MaskingSizes = [1024, 65536, 1024*1024]
+FragmentSize = 4*1024*1024
+Fragments = [4096, 65536]
+Subscribers = [10, 100]
+QuickSubscribers = [10]
+FanoutMessages = 200
+FanoutMessageSize = 100
+Repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+Groups = ["echo", "masking", "fragments", "handshake", "fanout", "reference"]
+
+#
+# Servers, run in a subprocess: suite.py --serve ws|websockets PORT
+#
+
+def serve_ws(port, max_connections):
+    from ws import WSApp, WSHandler
+
+    subscribers = []
+    lock = threading.Lock()
+
+    class Handler(WSHandler):
+
+        # written against the oldest WSHandler interface, so that old revisions can be compared
+
+        def handshake(self, *params):
+            return {}
+
+        def run(self):
+            self.WS.run(self)
+
+    class EchoHandler(Handler):
+
+        def on_message(self, ws, message):
+            ws.send(message)
+
+    class SubscriberHandler(Handler):
+
+        def handshake(self, *params):
+            # registered before the 101 response, so the subscriber is known when its connect() returns
+            with lock:
+                subscribers.append(self.WS)
+            return {}
+
+        def on_message(self, ws, message):
+            pass
+
+        def on_close(self, ws, *params):
+            with lock:
+                if ws in subscribers:
+                    subscribers.remove(ws)
+
+    class PublisherHandler(Handler):
+
+        def on_message(self, ws, message):
+            # "<count> <size>": sends count messages of size bytes to every subscriber
+            count, size = map(int, message.split())
+            payload = b"x" * size
+            with lock:
+                peers = list(subscribers)
+            for _ in range(count):
+                for peer in list(peers):
+                    try:    peer.send(payload)
+                    except Exception:
+                        peers.remove(peer)          # closed by a previous run, not yet unregistered
+            ws.send("done")
+
+    app = WSApp([("/subscribe", SubscriberHandler), ("/publish", PublisherHandler), ("*", EchoHandler)])
+    app.run_server(port, max_connections=max_connections, max_queued=max_connections)
+
+def serve_websockets(port):
+    from websockets.sync.server import serve
+
+    def echo(connection):
+        for message in connection:
+            connection.send(message)
+
+    with serve(echo, "127.0.0.1", port, max_size=None, compression=None) as server:
+        server.serve_forever()
+
+class Server(object):
+
+    def __init__(self, kind, tree, connect, max_connections=10):
+        # connect: client used to check that the server is up, a plain TCP connection would be logged as an error
+        self.Port = free_port()
+        env = dict(os.environ)
+        if tree:
+            env["PYTHONPATH"] = os.pathsep.join([tree] + [p for p in [env.get("PYTHONPATH")] if p])
+        # server errors are seen by the clients and reported in the results, the tracebacks are not needed
+        self.Process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", kind,
+                    str(self.Port), str(max_connections)], env=env, stderr=subprocess.DEVNULL)
+        t1 = time.time() + 10
+        while True:
+            try:
+                connect(self.url()).close()
+                break
+            except OSError:
+                if time.time() > t1 or self.Process.poll() is not None:
+                    self.stop()
+                    raise RuntimeError(f"{kind} server did not start")
+                time.sleep(0.05)
+
+    def url(self, path="/echo"):
+        return f"ws://127.0.0.1:{self.Port}{path}"
+
+    def stop(self):
+        self.Process.terminate()
+        try:    self.Process.wait(5)
+        except subprocess.TimeoutExpired:
+            self.Process.kill()
+            self.Process.wait()
+
+def free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+#
+# Measurements
+#
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q*len(values)))]
+
+def echo(client, message, duration, max_count=100000):
+    # round trips for about duration seconds, at least 3, after 1 warm-up round trip
+    client.send(message)
+    client.recv()
+    times = []
+    t1 = time.perf_counter() + duration
+    while len(times) < max_count:
+        t0 = time.perf_counter()
+        client.send(message)
+        reply = client.recv()
+        t = time.perf_counter()
+        times.append(t - t0)
+        if len(reply) != len(message):
+            raise RuntimeError("echo returned %d bytes instead of %d" % (len(reply), len(message)))
+        if t >= t1 and len(times) >= 3:
+            break
+    total = sum(times)
+    return {
+        "count":        len(times),
+        "p50_us":       percentile(times, 0.5)*1e6,
+        "p99_us":       percentile(times, 0.99)*1e6,
+        "msgs_per_sec": len(times)/total,
+        "mb_per_sec":   len(times)*len(message)/total/1e6
+    }
+
+def size_label(size):
+    for unit, n in (("MB", 1024*1024), ("KB", 1024)):
+        if size >= n and size % n == 0:
+            return "%d%s" % (size//n, unit)
+    return "%dB" % (size,)
+
+def bench_echo(connect, url, sizes, duration, results, prefix="echo"):
+    client = connect(url)
+    for size in sizes:
+        results["%s/%s" % (prefix, size_label(size))] = echo(client, b"x"*size, duration)
+    client.close()
+
+def bench_masking(connect, url, duration, results):
+    client = connect(url)
+    for masked in (True, False):
+        client.SendMasked = masked
+        for size in MaskingSizes:
+            results["%s/%s" % ("masked" if masked else "unmasked", size_label(size))] = \
+                echo(client, b"x"*size, duration)
+    client.close()
+
+def bench_fragments(connect, url, duration, results):
+    message = b"x"*FragmentSize
+    client = connect(url)
+    results["whole/%s" % (size_label(FragmentSize),)] = echo(client, message, duration)
+    client.close()
+    for fragment in Fragments:
+        client = connect(url, max_fragment=fragment)
+        results["fragmented/%s/%s" % (size_label(FragmentSize), size_label(fragment))] = echo(client, message, duration)
+        client.close()
+
+def bench_handshake(connect, url, duration, results, key="handshake"):
+    times = []
+    t0 = time.perf_counter()
+    while time.perf_counter() < t0 + duration or len(times) < 3:
+        t = time.perf_counter()
+        client = connect(url)
+        times.append(time.perf_counter() - t)
+        client.close()
+    results[key] = {
+        "count":                len(times),
+        "p50_us":               percentile(times, 0.5)*1e6,
+        "p99_us":               percentile(times, 0.99)*1e6,
+        "handshakes_per_sec":   len(times)/(time.perf_counter() - t0)
+    }
+
+def frame_size(n):
+    return n + (2 if n < 126 else 4 if n < 65536 else 10)
+
+def bench_fanout(connect, server, counts, results):
+    for n in counts:
+        fanout(connect, server, n, results)
+
+def fanout(connect, server, nsubscribers, results):
+    subscribers = [connect(server.url("/subscribe")) for _ in range(nsubscribers)]
+    socks = [s.Sock for s in subscribers]
+    expected = nsubscribers * FanoutMessages * frame_size(FanoutMessageSize)
+    received = [0]
+    done = threading.Event()
+
+    def reader():
+        selector = selectors.DefaultSelector()
+        for s in socks:
+            s.setblocking(False)
+            selector.register(s, selectors.EVENT_READ)
+        while received[0] < expected:
+            for key, events in selector.select(10):
+                try:    received[0] += len(key.fileobj.recv(1024*1024))
+                except BlockingIOError:
+                    pass
+        done.set()
+
+    publisher = connect(server.url("/publish"))
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    t0 = time.perf_counter()
+    publisher.send("%d %d" % (FanoutMessages, FanoutMessageSize))
+    publisher.recv()
+    if not done.wait(60):
+        raise RuntimeError("fan-out: %d of %d bytes received" % (received[0], expected))
+    dt = time.perf_counter() - t0
+    results["fanout/%d" % (nsubscribers,)] = {
+        "messages":             FanoutMessages,
+        "msgs_per_sec":         nsubscribers*FanoutMessages/dt
+    }
+    publisher.close()
+    for s in socks:
+        s.close()
+
+def run_ws(tree, groups, sizes, subscribers, duration, results, errors):
+    from ws import connect
+    server = Server("ws", tree, connect, max_connections=max(subscribers or [0]) + 10)
+    benchmarks = {
+        "echo":         lambda: bench_echo(connect, server.url(), sizes, duration, results),
+        "masking":      lambda: bench_masking(connect, server.url(), duration, results),
+        "fragments":    lambda: bench_fragments(connect, server.url(), duration, results),
+        "handshake":    lambda: bench_handshake(connect, server.url(), duration, results),
+        "fanout":       lambda: bench_fanout(connect, server, subscribers, results)
+    }
+    try:
+        for group, benchmark in benchmarks.items():
+            if group in groups:
+                try:    benchmark()
+                except Exception as e:
+                    # e.g. a feature missing in an older revision. The other groups still run
+                    errors[group] = "%s: %s" % (e.__class__.__name__, e)
+    finally:
+        server.stop()
+
+class WebsocketsClient(object):
+
+    # the websockets sync client with the recv() returning the message, as ws.connect() does
+
+    def __init__(self, url):
+        from websockets.sync.client import connect
+        self.Connection = connect(url, max_size=None, compression=None).__enter__()
+
+    def send(self, message):
+        self.Connection.send(message)
+
+    def recv(self):
+        return self.Connection.recv()
+
+    def close(self):
+        self.Connection.__exit__(None, None, None)
+
+def run_reference(groups, sizes, duration, results):
+    try:
+        import websockets
+    except ImportError:
+        return None
+    server = Server("websockets", None, WebsocketsClient)
+    try:
+        if "echo" in groups:
+            bench_echo(WebsocketsClient, server.url(), sizes, duration, results)
+        if "handshake" in groups:
+            bench_handshake(WebsocketsClient, server.url(), duration, results)
+    finally:
+        server.stop()
+    return websockets.__version__
+
+def git_revision(tree):
+    try:
+        rev = subprocess.run(["git", "-C", tree, "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                    check=True).stdout.strip()
+        dirty = subprocess.run(["git", "-C", tree, "status", "--porcelain", "--untracked-files=no"],
+                    capture_output=True, text=True).stdout.strip()
+        return rev + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(tree, groups, quick, duration):
+    tree = os.path.abspath(tree)
+    sys.path.insert(0, tree)
+    import ws
+    sizes = QuickSizes if quick else Sizes
+    subscribers = QuickSubscribers if quick else Subscribers
+    out = {
+        "meta": {
+            "tree":         tree,
+            "revision":     git_revision(tree),
+            "python":       platform.python_version(),
+            "platform":     platform.platform(),
+            "cpus":         os.cpu_count(),
+            "time":         time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "duration":     duration,
+            "quick":        quick
+        },
+        "results": {},
+        "errors": {}
+    }
+    socket.setdefaulttimeout(60)            # clients of older revisions could block forever on a failed handshake
+    run_ws(tree, groups, sizes, subscribers, duration, out["results"], out["errors"])
+    if "reference" in groups:
+        reference = {}
+        version = run_reference(groups, sizes, duration, reference)
+        if version is not None:
+            out["reference"] = {"websockets": {"version": version, "results": reference}}
+    return out
+
+#
+# Comparison
+#
+
+HigherIsBetter = ("msgs_per_sec", "handshakes_per_sec")      # mb_per_sec changes with msgs_per_sec
+LowerIsBetter = ("p50_us", "p99_us")
+
+def compare(old, new, file=sys.stdout):
+    def label(data):
+        return data["meta"].get("label") or data["meta"].get("revision") or data["meta"].get("tree")
+    print("%-34s %-18s %14s %14s %9s" % ("benchmark", "metric", label(old)[:14], label(new)[:14], "change"), file=file)
+    for name, new_values in new["results"].items():
+        old_values = old["results"].get(name)
+        if old_values is None:
+            continue
+        for metric in HigherIsBetter + LowerIsBetter:
+            if metric in new_values and metric in old_values and old_values[metric]:
+                a, b = old_values[metric], new_values[metric]
+                change = (b/a - 1)*100
+                better = change > 0 if metric in HigherIsBetter else change < 0
+                print("%-34s %-18s %14.1f %14.1f %+8.1f%% %s" % (name, metric, a, b, change,
+                        "" if abs(change) < 5 else "better" if better else "worse"), file=file)
+    for data in (old, new):
+        for group, error in data.get("errors", {}).items():
+            print(f"{label(data)}: {group} failed: {error}", file=file)
+    for data in (old, new):
+        reference = data.get("reference", {}).get("websockets")
+        if reference:
+            print(f"\nwebsockets {reference['version']} reference, measured with {label(data)}:", file=file)
+            for name, values in reference["results"].items():
+                print("%-34s %s" % (name, "  ".join("%s=%.1f" % (m, values[m]) for m in HigherIsBetter + LowerIsBetter
+                        if m in values)), file=file)
+            break
+
+def run_revision(repo, revision, args):
+    # runs the suite in a subprocess against a temporary worktree of the revision
+    tmp = tempfile.mkdtemp(prefix="ws-bench-")
+    tree = os.path.join(tmp, "tree")
+    subprocess.run(["git", "-C", repo, "worktree", "add", "--detach", tree, revision], check=True,
+                capture_output=True)
+    try:
+        output = os.path.join(tmp, "results.json")
+        subprocess.run([sys.executable, os.path.abspath(__file__), "--tree", tree, "-o", output] + args, check=True)
+        with open(output) as f:
+            data = json.load(f)
+        data["meta"]["label"] = revision
+        return data
+    finally:
+        subprocess.run(["git", "-C", repo, "worktree", "remove", "--force", tree], capture_output=True)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def main():
+    if sys.argv[1:2] == ["--serve"]:
+        kind, port = sys.argv[2], int(sys.argv[3])
+        if kind == "ws":
+            serve_ws(port, int(sys.argv[4]))
+        else:
+            serve_websockets(port)
+        return
+
+    opts, args = getopt.gnu_getopt(sys.argv[1:], "o:d:", ["tree=", "compare", "diff", "quick", "only=", "no-reference"])
+    opts = dict(opts)
+    output = opts.get("-o")
+    passed = [x for o, v in opts.items() if o in ("-d", "--only") for x in (o, v)] + \
+        [o for o in ("--quick", "--no-reference") if o in opts]
+    groups = opts["--only"].split(",") if "--only" in opts else list(Groups)
+    if "--no-reference" in opts and "reference" in groups:
+        groups.remove("reference")
+
+    if "--diff" in opts:
+        old, new = [json.load(open(path)) for path in args]
+        compare(old, new)
+        return
+    if "--compare" in opts:
+        old, new = [run_revision(Repository, revision, passed) for revision in args]
+        if output:
+            with open(output, "w") as f:
+                json.dump({"old": old, "new": new}, f, indent=2)
+        compare(old, new)
+        return
+
+    data = run(opts.get("--tree", Repository), groups, "--quick" in opts, float(opts.get("-d", 1.0)))
+    if output:
+        with open(output, "w") as f:
+            json.dump(data, f, indent=2)
+    else:
+        json.dump(data, sys.stdout, indent=2)
+        print()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#
+# wss:// handshake rate with and without TLS session resumption, over loopback, using a self-signed
+# certificate generated with the openssl command line tool
+#
+#   ws              - plain connections, for reference
+#   full            - every connection makes a full TLS handshake (no client session cache)
+#   resumed         - the client offers the session of the previous connection (tls.SessionCache)
+#
+# for TLS 1.3 and TLS 1.2. Each connection is opened, completes the websocket handshake and is closed.
+#
+# usage: python benchmarks/tls_handshake.py [seconds [key type]]
+#
+#   key type: rsa (2048 bit, default) or ec (P-256). With EC keys the full handshake is cheap, and TLS 1.3
+#   resumption, which still makes a key exchange, gains little on loopback
+#
+
+import sys, os, time, signal, subprocess, tempfile, multiprocessing, ssl
+from ws import WSApp, WSHandler, WebsocketServer, connect, tls
+
+Port = 18871
+PlainPort = 18872
+
+class EchoHandler(WSHandler):
+
+    def on_message(self, ws, message):
+        ws.send(message)
+
+def make_certificate(directory, key_type):
+    cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    key_args = ["-newkey", "rsa:2048"] if key_type == "rsa" else ["-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1"]
+    subprocess.run(["openssl", "req", "-x509"] + key_args + ["-nodes", "-days", "1", "-subj", "/CN=localhost", "-addext", "subjectAltName=DNS:localhost",
+        "-keyout", key, "-out", cert], check=True, capture_output=True)
+    return cert, key
+
+def run_server(port, context):
+    server = WebsocketServer(port, WSApp(EchoHandler), max_connections=20, ssl_context=context)
+    server.start()
+    server.join()
+
+def measure(url, duration, **args):
+    times = []
+    resumed = 0
+    t0 = time.perf_counter()
+    while time.perf_counter() < t0 + duration:
+        t = time.perf_counter()
+        client = connect(url, **args)
+        times.append(time.perf_counter() - t)
+        if url.startswith("wss:"):
+            resumed += client.Sock.session_reused
+        client.close()
+    elapsed = time.perf_counter() - t0
+    times.sort()
+    return len(times)/elapsed, times[len(times)//2]*1e6, times[int(len(times)*0.99)]*1e6, resumed/len(times)
+
+duration = float(sys.argv[1]) if len(sys.argv) > 1 else 3.0
+key_type = sys.argv[2] if len(sys.argv) > 2 else "rsa"
+
+tmp = tempfile.mkdtemp()
+try:
+    cert, key = make_certificate(tmp, key_type)
+except (OSError, subprocess.CalledProcessError) as e:
+    print("Can not create a self-signed certificate with openssl:", e)
+    sys.exit(1)
+
+# the server context is created before the server process is forked, as run_server(workers=N) requires
+server_context = tls.server_context(cert, key)
+servers = [
+    multiprocessing.Process(target=run_server, args=(Port, server_context)),
+    multiprocessing.Process(target=run_server, args=(PlainPort, None))
+]
+for server in servers:
+    server.start()
+time.sleep(1.0)
+
+print(f"duration: {duration} sec, key: {key_type}")
+print("%-8s %-10s %14s %10s %10s %9s" % ("TLS", "mode", "handshakes/s", "p50 us", "p99 us", "resumed"))
+rate, p50, p99, _ = measure(f"ws://localhost:{PlainPort}/", duration)
+print("%-8s %-10s %14.0f %10.0f %10.0f %9s" % ("-", "ws", rate, p50, p99, "-"))
+for version in (ssl.TLSVersion.TLSv1_3, ssl.TLSVersion.TLSv1_2):
+    context = tls.client_context(cafile=cert)
+    context.maximum_version = version
+    url = f"wss://localhost:{Port}/"
+    for mode, cache in (("full", None), ("resumed", tls.SessionCache())):
+        rate, p50, p99, resumed = measure(url, duration, ssl_context=context, tls_session_cache=cache)
+        print("%-8s %-10s %14.0f %10.0f %10.0f %8.0f%%" % (version.name, mode, rate, p50, p99, resumed*100))
+
+for server in servers:
+    os.kill(server.pid, signal.SIGTERM)
+    server.join()
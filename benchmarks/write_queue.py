@@ -0,0 +1,56 @@
+#
+# Write queue: producer throughput for many small messages sent directly vs. through the per-connection
+# write queue, over a loopback TCP connection. The receiving side drains the socket as fast as it can.
+#
+# usage: python benchmarks/write_queue.py [messages [message_size]]
+#
+
+import sys, time, threading
+from socket import socket, AF_INET, SOCK_STREAM
+from ws import WebsocketPeer
+
+def connection_pair():
+    listener = socket(AF_INET, SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    client = socket(AF_INET, SOCK_STREAM)
+    client.connect(listener.getsockname())
+    server, _ = listener.accept()
+    listener.close()
+    return server, client
+
+def drain(sock, nbytes, done):
+    received = 0
+    while received < nbytes:
+        data = sock.recv(1024*1024)
+        if not data:
+            break
+        received += len(data)
+    done.set()
+
+def run(nmessages, message, write_queue):
+    a, b = connection_pair()
+    peer = WebsocketPeer(a, write_queue=write_queue)
+    done = threading.Event()
+    frame = len(message) + (2 if len(message) < 126 else 4)
+    threading.Thread(target=drain, args=(b, nmessages*frame, done), daemon=True).start()
+    t0 = time.time()
+    for _ in range(nmessages):
+        peer.send(message)
+    t_produce = time.time() - t0
+    done.wait()
+    t_total = time.time() - t0
+    syscalls = peer.Writer.Batches if peer.Writer is not None else nmessages
+    peer.shutdown()
+    b.close()
+    return nmessages/t_produce, nmessages/t_total, syscalls
+
+nmessages = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+size = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+message = b"x" * size
+
+print(f"messages: {nmessages}, message size: {size}")
+print("%-24s %16s %16s %12s" % ("mode", "produce msgs/s", "deliver msgs/s", "send calls"))
+for name, write_queue in (("direct", None), ("queue", True), ("queue high=64K", {"high_watermark": 64*1024})):
+    produce, deliver, syscalls = run(nmessages, message, write_queue)
+    print("%-24s %16.0f %16.0f %12d" % (name, produce, deliver, syscalls))
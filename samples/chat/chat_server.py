@@ -1,12 +1,10 @@
-from ws import WSHandler, WSApp
+from ws import WSHandler, WSApp, Broadcaster, RateLimit
 from pythreader import synchronized
 
 class ChatHandler(WSHandler):
     
     def handshake(self, address, request):
-        path = request.Path
-        assert path.startswith("/chat/")
-        self.Name = path[6:]
+        self.Name = self.PathParams["name"]
         self.App.register(self, self.Name)
         
     def run(self):
@@ -24,8 +22,11 @@ class ChatHandler(WSHandler):
 class ChatApp(WSApp):
     
     def __init__(self, handler):
-        WSApp.__init__(self, handler)
+        # a client may send 20 messages per second, in bursts of up to 40, and is slowed down beyond that
+        WSApp.__init__(self, {"/chat/{name}": (handler, RateLimit(messages=20, bytes=64*1024, burst=2.0))})
         self.Clients = {}       # name -> handler
+        self.Hub = Broadcaster(slow_policy="disconnect")
+        self.Hub.start()
         
     @synchronized
     def register(self, handler, name):
@@ -33,12 +34,14 @@ class ChatApp(WSApp):
         if name in self.Clients:
             raise ValueError("Already registered")
         self.Clients[name] = handler
+        self.Hub.subscribe(handler.WS)
         self.send("[chat]", None, "%s connected" % (name,), exclude=name)
         
     @synchronized
     def unregister(self, name):
         print("unregister:", name)
         if name in self.Clients:
+            self.Hub.unsubscribe(self.Clients[name].WS)
             del self.Clients[name]
         self.send("[chat]", None, "%s disconnected" % (name,))
         
@@ -51,11 +54,12 @@ class ChatApp(WSApp):
                 users = self.Clients.keys()
                 reply = "\n - " + "\n - ".join(users)
                 self.Clients[src].say(".", src, reply)
-        else:
-            to = [dst] if dst else list(self.Clients.keys())
-            for name in to:
-                if name in self.Clients and name != src and name != exclude:
-                    self.Clients[name].say(src, dst, text)
+        elif not dst:
+            # broadcast: the frame is encoded once and delivered by the hub thread
+            skip = [self.Clients[name].WS for name in (src, exclude) if name in self.Clients]
+            self.Hub.publish("%s:%s:%s" % (src, "", text), exclude=skip)
+        elif dst in self.Clients and dst != src:
+            self.Clients[dst].say(src, dst, text)
     
 
 app = ChatApp(ChatHandler)
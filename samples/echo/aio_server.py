@@ -0,0 +1,15 @@
+from ws import AsyncWSHandler, WSApp
+
+class EchoHandler(AsyncWSHandler):
+    
+    def handshake(self, address, request):
+        print(f"Server initialized at {request.Path} with headers:")
+        for k, v in request.Headers.items():
+            print(f"   {k}: {v}")
+        
+    async def run(self):
+        async for msg in self.WS:
+            await self.WS.send(msg)
+
+app = WSApp(EchoHandler)
+app.run_async_server(8080)
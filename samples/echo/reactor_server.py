@@ -0,0 +1,15 @@
+from ws import WSHandler, WSApp
+
+class EchoHandler(WSHandler):
+    
+    def handshake(self, address, request):
+        print(f"Server initialized at {request.Path}")
+        
+    def on_message(self, ws, message):
+        ws.send(message)
+        
+    def on_close(self, ws, status):
+        print(f"Closed: {status}")
+
+app = WSApp(EchoHandler)
+app.run_server(8080, reactor=True)
@@ -0,0 +1,59 @@
+import asyncio, os, struct, tracemalloc
+from socket import socketpair
+import pytest
+from ws import WebsocketPeer, AsyncWebsocketPeer
+from ws.ws import EOF
+
+def ping_header(length, fin=True):
+    # masked ping header announcing length bytes of payload, with no payload following
+    return bytes([0x80*fin | 9, 0x80 | 127]) + struct.pack("!Q", length) + os.urandom(4)
+
+def close_code(sock):
+    sock.settimeout(5)
+    data = sock.recv(1024)
+    assert data[0] & 15 == 8
+    return struct.unpack("!H", data[2:4])[0]
+
+@pytest.mark.parametrize("header", [ping_header(2**40), ping_header(200*1024*1024), ping_header(126),
+                                    ping_header(10, fin=False)],
+                         ids=["2**40", "200MB", "126", "fragmented"])
+def test_invalid_control_frame_sync(header):
+    a, b = socketpair()
+    peer = WebsocketPeer(a, max_frame_size=1024)
+    b.sendall(header)
+    tracemalloc.start()
+    try:
+        with pytest.raises(EOF):
+            peer.recv(timeout=5)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < 1024*1024
+    assert close_code(b) == 1002
+    b.close()
+
+def test_invalid_control_frame_ready():
+    # the reactor reads only when fragment_ready(), the header alone must be enough to fail the connection
+    a, b = socketpair()
+    peer = WebsocketPeer(a)
+    b.sendall(ping_header(2**40))
+    peer.Buffer.fill()
+    assert peer.fragment_ready()
+    with pytest.raises(EOF):
+        peer.recv_fragment()
+    assert close_code(b) == 1002
+    a.close()
+    b.close()
+
+def test_invalid_control_frame_async():
+    async def run():
+        a, b = socketpair()
+        reader, writer = await asyncio.open_connection(sock=a)
+        peer = AsyncWebsocketPeer(reader, writer, max_frame_size=1024)
+        b.sendall(ping_header(2**40))
+        with pytest.raises(EOF):
+            await peer.recv(timeout=5)
+        return b
+    b = asyncio.run(run())
+    assert close_code(b) == 1002
+    b.close()
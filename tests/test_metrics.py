@@ -0,0 +1,30 @@
+import time
+import pytest
+from ws import WSApp, WSHandler, WebsocketServer, ReactorServer, connect
+
+class IdleHandler(WSHandler):
+
+    def run(self):
+        time.sleep(0.2)         # the client is gone by now
+
+@pytest.mark.parametrize("server_class, port", [(WebsocketServer, 18971), (ReactorServer, 18972)])
+def test_abrupt_disconnect_closes_metrics(server_class, port):
+    server = server_class(port, WSApp(IdleHandler))
+    server.daemon = True
+    server.start()
+    time.sleep(0.2)
+    try:
+        for _ in range(3):
+            ws = connect("ws://127.0.0.1:%d/" % (port,))
+            ws.Sock.close()                 # no close handshake
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            snapshot = server.metrics()
+            if snapshot["connections_closed"] == 3:
+                break
+            time.sleep(0.05)
+        assert snapshot["connections_opened"] == 3
+        assert snapshot["connections_closed"] == 3
+        assert snapshot["connections_open"] == 0
+    finally:
+        server.stop()
@@ -0,0 +1,27 @@
+import pytest
+from socket import socketpair
+from ws import WebsocketPeer
+from ws.ws import Timeout
+
+def interrupted_text(first, rest):
+    # the server's recv() times out after the first fragment of a text message, the client then sends the rest
+    a, b = socketpair()
+    server = WebsocketPeer(a)
+    client = WebsocketPeer(b, send_masked=True)
+    client.send_fragment(False, 1, True, first)
+    with pytest.raises(Timeout):
+        server.recv(timeout=0.1)
+    assert server.Partial is not None
+    client.send_fragment(True, 0, True, rest)
+    return server
+
+def test_resumed_text_is_validated():
+    server = interrupted_text(b"caf\xc3", b"\x28")          # 0xC3 must be followed by a continuation byte
+    with pytest.raises(UnicodeDecodeError):
+        server.recv_message(timeout=5)
+
+def test_resumed_text_is_returned():
+    server = interrupted_text(b"caf\xc3", b"\xa9 au lait")
+    with server.recv_message(timeout=5) as message:
+        assert not message.Binary
+        assert message.text == "café au lait"
@@ -0,0 +1,29 @@
+import fnmatch
+import pytest
+from ws.router import Router
+
+Patterns = ["/a/[!]", "/[!]]a", "/[]]x", "/[!]a]b", "/x[", "/x[ab", "/[a-c]", "/[!a-c]", "/[c-a]z", "/[a-]", "/[-a]",
+            "/[\\]", "/[a&&b]", "/[^x]", "/[[]", "/[!]", "/*.[ch]"]
+Paths = ["/a/[!]", "/a/x", "/]a", "/xa", "/]x", "/]b", "/ab", "/x[", "/x[ab", "/b", "/d", "/z", "/-", "/\\", "/&", "/^",
+         "/[", "/!", "/f.c", "/f.h", "/f.o", "/a/!"]
+
+@pytest.mark.parametrize("pattern", Patterns)
+def test_sets_match_fnmatch(pattern):
+    router = Router([(pattern, "target")])
+    for path in Paths:
+        expected = "target" if fnmatch.fnmatchcase(path, pattern) else None
+        assert router.resolve(path)[0] == expected, (pattern, path)
+
+def test_unterminated_set_is_literal():
+    router = Router([("/chat/[x", "target")])
+    assert router.resolve("/chat/[x")[0] == "target"
+    assert router.resolve("/chat/x")[0] is None
+
+def test_negated_bracket_set():
+    router = Router([("/[!]]a", "target"), ("*", "fallback")])
+    assert router.resolve("/xa")[0] == "target"
+    assert router.resolve("/]a")[0] == "fallback"
+
+def test_invalid_pattern_fails_at_startup():
+    with pytest.raises(ValueError):
+        Router([("/chat/{na-me}", "target")])
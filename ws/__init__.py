@@ -1,3 +1,11 @@
 from .server import WebsocketServer
-from .app import WSApp, WSHandler
-from .ws import WebsocketPeer, connect
\ No newline at end of file
+from .reactor import ReactorServer
+from .app import WSApp, WSHandler, AsyncWSHandler
+from .ws import WebsocketPeer, connect
+from .broadcast import Broadcaster
+from .text import RawText
+from .codec import Encoded
+from .buffers import BufferPool, PooledMessage
+from .ratelimit import RateLimit
+from .pool import WebsocketClientPool
+from .aio import AsyncWebsocketPeer, AsyncWebsocketServer, connect as async_connect
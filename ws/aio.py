@@ -0,0 +1,434 @@
+import asyncio, struct, os, traceback, inspect, time
+from .ws import EOF, MessageTooBig, RateLimited, Timeout, WebsocketHeader, parse_url, secure_url, format_request, format_response, \
+        frame_header, ConnectionIDs
+from .mask import apply_mask
+from .deflate import client_offer, accept_offer, accept_response
+from .text import RawText, UTF8Validator, validate
+from . import codec
+from . import tls
+
+class AsyncWebsocketPeer(object):
+
+    # asyncio counterpart of WebsocketPeer. A message of up to InterleaveSize bytes is written to the transport
+    # without yielding to the event loop. Larger ones are written fragment by fragment, waiting for the
+    # transport to drain in between, so that pongs and close frames written by recv() are not queued behind
+    # the whole message. The SendLock keeps concurrent senders from interleaving their fragments.
+
+    Tracer = None                           # trace.FrameTrace, set by trace.enable()
+    InterleaveSize = 256*1024               # see WebsocketPeer.InterleaveSize
+
+    def __init__(self, reader, writer, send_masked = False, max_fragment = None, compression = None,
+                max_message_size = None, max_frame_size = None, raw_text = False, codecs = None):
+        self.Reader = reader
+        self.Writer = writer
+        self.Closed = False
+        self.CloseReceived = False
+        self.CloseSent = False
+        self.SendMasked = send_masked
+        self.ClosedCode = None
+        self.ClosedReason = None
+        self.ClosedStatus = ""
+        self.MaxFragment = max_fragment
+        self.RecvLock = asyncio.Lock()
+        self.SendLock = asyncio.Lock()
+        self.RawTextMode = raw_text             # recv() returns text messages as text.RawText, see text.py
+        self.Codecs = codecs                    # codecs to offer or accept as subprotocols, see codec.py
+        self.Codec = codec.DefaultCodec         # used by send_obj() and recv_obj()
+        self.Compression = compression          # permessage-deflate options, see deflate.py
+        self.Deflate = None                     # PerMessageDeflate, if negotiated
+        self.Inflating = False
+        self.MaxMessageSize = max_message_size
+        self.MaxFrameSize = max_frame_size
+        self.MessageSize = 0
+        self.InflatedSize = 0
+        self.ID = next(ConnectionIDs)
+        self.RateLimiter = None                 # ratelimit.RateLimiter, set by WSApp for the route
+        self.ResumeTime = 0
+        self.Partial = None                     # (fragments, binary, validator) of a message interrupted by a recv() timeout
+
+    def peer_address(self):
+        return self.Writer.get_extra_info("peername")
+
+    async def recv_handshake(self):
+        headline = None
+        headers = {}
+        while True:
+            l = await self.Reader.readline()
+            if not l.endswith(b"\n"):
+                raise EOF("Peer disconnected while reading the handshake")
+            l = l.decode("utf-8").strip()
+            if not l:
+                break
+            if headline is None:
+                headline = l
+            else:
+                words = l.split(":", 1)
+                headers[words[0]] = words[1].strip()
+        return WebsocketHeader(headline, headers)
+
+    recv_request = recv_handshake
+    recv_response = recv_handshake
+
+    async def send_response(self, request, headers={}, status="101 Switching Protocols"):
+        if self.Compression is not None and status.startswith("101"):
+            self.Deflate, extension = accept_offer(request.header("Sec-WebSocket-Extensions"), self.Compression)
+            if self.Deflate is not None:
+                headers = dict(headers, **{"Sec-WebSocket-Extensions": extension})
+        if self.Codecs is not None and status.startswith("101") and "Sec-WebSocket-Protocol" not in headers:
+            self.Codec, protocol = codec.accept_offer(request.header("Sec-WebSocket-Protocol"), self.Codecs)
+            if protocol is not None:
+                headers = dict(headers, **{"Sec-WebSocket-Protocol": protocol})
+        self.Writer.write(format_response(request, headers, status))
+        await self.Writer.drain()
+
+    async def send_request(self, uri, host, port, headers={}):
+        if self.Compression is not None:
+            headers = dict(headers, **{"Sec-WebSocket-Extensions": client_offer(self.Compression)})
+        if self.Codecs:
+            headers = dict(headers, **{"Sec-WebSocket-Protocol": codec.client_offer(self.Codecs)})
+        self.Writer.write(format_request(uri, host, port, headers))
+        await self.Writer.drain()
+
+    def write_fragment(self, fin, opcode, data, rsv1=False):
+        # writes the fragment into the transport buffer, does not wait for it to be sent
+        mask = None
+        if self.SendMasked:
+            mask = os.urandom(4)
+            data = apply_mask(mask, data)
+        if self.Tracer is not None:
+            self.Tracer.record(self.ID, "out", opcode, fin, len(data))
+        self.Writer.write(frame_header(fin, opcode, len(data), mask, rsv1))
+        if data:
+            self.Writer.write(data)
+
+    async def send_fragment(self, fin, opcode, data):
+        self.write_fragment(fin, opcode, data)
+        await self.Writer.drain()
+
+    async def recv_fragment(self, timeout=None):
+        # timeout applies to waiting for the beginning of the fragment only
+        if self.CloseReceived:
+            raise EOF("Websocket has been closed")
+        reader = self.Reader
+        try:
+            if timeout is not None:
+                try:    hdr = await asyncio.wait_for(reader.readexactly(2), timeout)
+                except asyncio.TimeoutError:
+                    raise Timeout()
+            else:
+                hdr = await reader.readexactly(2)
+            b0, b1 = hdr
+            fin = (b0 >> 7) & 1
+            rsv1 = (b0 >> 6) & 1
+            opcode = b0 & 15
+            mask_flag = (b1 >> 7) & 1
+            length = b1 & 127
+            if length == 126:
+                length = struct.unpack("!H", await reader.readexactly(2))[0]
+            elif length == 127:
+                length = struct.unpack("!Q", await reader.readexactly(8))[0]
+            mask = await reader.readexactly(4) if mask_flag else None
+            if self.Tracer is not None:
+                self.Tracer.record(self.ID, "in", opcode, fin, length)
+            if opcode < 8:
+                if opcode != 0:
+                    self.MessageSize = 0
+                self.MessageSize += length
+                if self.MaxFrameSize is not None and length > self.MaxFrameSize:
+                    await self.too_big(f"Frame size {length} exceeds the limit {self.MaxFrameSize}")
+                if self.MaxMessageSize is not None and self.MessageSize > self.MaxMessageSize:
+                    await self.too_big(f"Message size exceeds the limit {self.MaxMessageSize}")
+            elif length > 125 or not fin:
+                # RFC 6455 5.5: control frames are not fragmented and carry at most 125 bytes
+                await self.protocol_error(f"Invalid control frame: opcode {opcode}, length {length}, fin {fin}")
+            data = await reader.readexactly(length)
+        except asyncio.IncompleteReadError:
+            raise EOF("Peer disconnected while reading a fragment")
+        if mask:
+            data = apply_mask(mask, data)
+
+        if opcode in (1, 2):
+            self.Inflating = bool(rsv1)
+            self.InflatedSize = 0
+            if rsv1 and self.Deflate is None:
+                raise EOF("Compressed frame received, but permessage-deflate was not negotiated")
+        if self.Inflating and opcode in (0, 1, 2):
+            limit = 0 if self.MaxMessageSize is None else self.MaxMessageSize - self.InflatedSize + 1
+            data = self.Deflate.decompress(data, fin, limit)
+            self.InflatedSize += len(data)
+            if self.MaxMessageSize is not None and self.InflatedSize > self.MaxMessageSize:
+                await self.too_big(f"Decompressed message size exceeds the limit {self.MaxMessageSize}")
+            if fin:
+                self.Inflating = False
+
+        if opcode == 8: # close
+            self.CloseReceived = True
+            if length >= 2:
+                self.ClosedCode = struct.unpack("!H", data[:2])[0]
+                if length > 2:
+                    self.ClosedReason = bytes(data[2:]).decode("utf-8")
+            data = b''
+            await self.send_close()
+        elif opcode == 9: # ping
+            if not self.CloseSent:
+                await self.send_fragment(True, 10, data)
+        return fin, opcode, data
+
+    async def too_big(self, message):
+        await self.send_close(1009, "Message too big")
+        raise MessageTooBig(message)
+
+    async def admit(self, nbytes):
+        # see WebsocketPeer.admit()
+        limiter = self.RateLimiter
+        if limiter is None:
+            return True
+        wait = limiter.admit(nbytes)
+        if wait <= 0 or limiter.Policy == "delay":
+            if wait > 0:
+                self.ResumeTime = time.monotonic() + wait
+            return True
+        if limiter.Policy == "drop":
+            return False
+        await self.send_close(1008, "Rate limit exceeded")
+        await self.shutdown("Rate limit exceeded")
+        raise RateLimited("Rate limit exceeded")
+
+    async def protocol_error(self, message):
+        await self.send_close(1002, "Protocol error")
+        await self.shutdown(message)
+        raise EOF(message)
+
+    async def send_close(self, code=None, reason=None):
+        if not self.CloseSent:
+            body = b''
+            if code is not None:
+                body = struct.pack('!H', code)
+                if reason:
+                    body = body + reason.encode("utf-8")
+            self.CloseSent = True
+            try:    await self.send_fragment(True, 8, body)
+            except (ConnectionError, OSError):
+                pass
+
+    async def recv(self, timeout=None, raw_text=None):
+        # timeout applies to the whole message. If it expires in the middle of a fragmented message,
+        # the fragments received so far are kept for the next recv() call
+        # raw_text: return a text message as RawText, validated but not decoded. None: as set for the peer
+        if raw_text is None:
+            raw_text = self.RawTextMode
+        async with self.RecvLock:
+            if self.closed():
+                raise EOF("Websocket has been closed")
+            loop = asyncio.get_running_loop()
+            t1 = None if timeout is None else loop.time() + timeout
+            delay = self.ResumeTime - time.monotonic()
+            if delay > 0:
+                if timeout is not None and delay > timeout:
+                    await asyncio.sleep(timeout)
+                    raise Timeout()
+                await asyncio.sleep(delay)
+            while True:
+                fragments, binary, validator = self.Partial or ([], None, None)
+                self.Partial = None
+                eof = False
+                while not eof:
+                    dt = None if t1 is None else max(0.0, t1 - loop.time())
+                    try:    final, opcode, fragment = await self.recv_fragment(dt)
+                    except Timeout:
+                        if binary is not None:
+                            self.Partial = (fragments, binary, validator)
+                        raise
+                    except EOF as e:
+                        await self.shutdown(str(e))
+                        raise
+                    if opcode in (9, 10):
+                        continue            # ping/pong, handled by recv_fragment
+                    if opcode in (1, 2) and binary is not None:
+                        await self.protocol_error("New message started before the previous one was finished")
+                    if binary is None and opcode != 8:
+                        if opcode == 0:
+                            await self.protocol_error("Continuation frame without a message to continue")
+                        binary = opcode == 2
+                        if raw_text and not binary and not final:
+                            validator = UTF8Validator()
+                    if validator is not None and opcode != 8:
+                        validator.feed(fragment, final)
+                    if fragment:
+                        fragments.append(fragment)
+                    eof = opcode == 8
+                    if final:
+                        break
+                if eof or await self.admit(sum(len(f) for f in fragments)):
+                    break                   # otherwise dropped by the rate limit
+        data = b''.join(fragments)
+        if not binary:
+            if not raw_text or eof:
+                data = data.decode("utf-8")
+            else:
+                data = RawText(data, None if validator is not None else validate(data))
+        if eof:
+            await self.close()
+        return data
+
+    async def send(self, message):
+        if self.CloseReceived or self.Closed or self.CloseSent:
+            return
+        binary = isinstance(message, (bytes, bytearray, memoryview))
+        if isinstance(message, RawText):
+            message = message.Data              # already UTF-8
+        elif not binary:
+            message = message.encode("utf-8")
+        compressed = self.Deflate is not None and self.Deflate.should_compress(message)
+        if compressed:
+            message = self.Deflate.compress(message)
+        view = memoryview(message).cast("B")
+        n = len(view)
+        step = min(self.MaxFragment or n, self.InterleaveSize or n) or 1
+        interleave = self.InterleaveSize and n > self.InterleaveSize
+        opcode = 2 if binary else 1
+        i = 0
+        async with self.SendLock:
+            while not self.CloseSent:                   # the close frame may be sent between two fragments
+                fragment = view[i:i+step]
+                i += len(fragment)
+                self.write_fragment(i >= n, opcode, fragment, compressed and opcode != 0)
+                opcode = 0
+                if i >= n:
+                    break
+                if interleave:
+                    await self.Writer.drain()
+            await self.Writer.drain()
+
+    async def shutdown(self, status=""):
+        if not self.Closed:
+            self.Closed = True
+            self.ClosedStatus = status
+            self.Writer.close()
+            try:    await self.Writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    async def close(self, code=1000, reason=None, timeout=None):
+        if not self.Closed:
+            await self.send_close(code, reason)
+            try:
+                async with self.RecvLock:
+                    while not self.CloseReceived:
+                        await self.recv_fragment(timeout)
+            except (EOF, Timeout, ConnectionError, OSError):
+                pass
+            await self.shutdown()
+
+    def closed(self):
+        return self.CloseReceived or self.Closed
+
+    async def send_obj(self, obj):
+        # obj: object to encode with the connection's codec, or codec.Encoded
+        if isinstance(obj, codec.Encoded):
+            await self.send(obj.payload(self.Codec))
+        else:
+            await self.send(self.Codec.encode(obj))
+
+    async def recv_obj(self, timeout=None):
+        # receives and decodes the next message. Raises EOF if the connection closes instead
+        message = await self.recv(timeout, raw_text=True)
+        if not message and self.closed():
+            raise EOF("Websocket has been closed")
+        return self.Codec.decode(message)
+
+    async def objects(self):
+        while not self.closed():
+            try:    obj = await self.recv_obj()
+            except EOF as e:
+                self.ClosedStatus = e.Message
+                break
+            yield obj
+
+    async def messages(self):
+        while not self.closed():
+            try:    msg = await self.recv()
+            except EOF as e:
+                self.ClosedStatus = e.Message
+                break
+            if msg:
+                yield msg
+
+    def __aiter__(self):
+        return self.messages()
+
+class AsyncWebsocketServer(object):
+
+    def __init__(self, port, app, host="", backlog=100, ssl_context=None, **ws_args):
+        # ssl_context: serve wss:// connections, see tls.server_context()
+        self.Port = port
+        self.SSLContext = ssl_context
+        self.Host = host
+        self.Backlog = backlog
+        self.App = app
+        self.WSArgs = ws_args
+        self.Server = None
+
+    async def handle_connection(self, reader, writer):
+        address = writer.get_extra_info("peername")
+        ws = AsyncWebsocketPeer(reader, writer, **self.WSArgs)
+        try:
+            request = await ws.recv_request()
+            handler = self.App.createHandler(ws, request)
+            if handler is None:
+                await ws.send_response(request, status="404 Not found")
+                await ws.shutdown()
+            else:
+                headers = handler.handshake(address, request)
+                if inspect.isawaitable(headers):
+                    headers = await headers
+                await ws.send_response(request, headers=headers or {})
+                await handler.run()
+        except (EOF, ConnectionError):
+            pass
+        except:
+            traceback.print_exc()
+        finally:
+            await ws.close(timeout=5.0)
+
+    async def start(self):
+        self.Server = await asyncio.start_server(self.handle_connection, self.Host or None, self.Port,
+                reuse_address=True, backlog=self.Backlog, ssl=self.SSLContext)
+        return self.Server
+
+    async def serve_forever(self):
+        if self.Server is None:
+            await self.start()
+        async with self.Server:
+            await self.Server.serve_forever()
+
+    def close(self):
+        if self.Server is not None:
+            self.Server.close()
+
+async def connect(url, headers = {}, compression = None, ssl_context = None, **args):
+    # wss:// URLs: ssl_context defaults to tls.default_client_context(). asyncio has no way to offer
+    # a cached TLS session, so these connections always make a full handshake
+    host, port, uri = parse_url(url)
+    ssl_context = (ssl_context or tls.default_client_context()) if secure_url(url) else None
+    reader, writer = await asyncio.open_connection(host, port, ssl=ssl_context)
+    ws = AsyncWebsocketPeer(reader, writer, send_masked = True, compression = compression, **args)
+    await ws.send_request(uri, host, port, headers)
+
+    response = await ws.recv_response()
+
+    if response.Status == 101:
+        if compression is not None:
+            ws.Deflate = accept_response(response.header("Sec-WebSocket-Extensions"), compression)
+        if ws.Codecs:
+            try:    ws.Codec = codec.accept_response(response.header("Sec-WebSocket-Protocol"), ws.Codecs)
+            except ValueError:
+                await ws.shutdown()
+                raise
+        ws.Protocol = response.Protocol
+        ws.ConnectMessage = response.Message
+        ws.ResponseHeaders = response.Headers
+        return ws
+    else:
+        await ws.shutdown()
+        raise ConnectionError(response.Status, response.Message)
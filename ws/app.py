@@ -1,22 +1,67 @@
-import fnmatch
+import asyncio
 from pythreader import Primitive
 from .server import WebsocketServer
+from .reactor import ReactorServer
+from .workers import WorkerSupervisor
+from .aio import AsyncWebsocketServer
+from .router import Router
 
 class WSHandler(object):
     
+    PathParams = {}         # path parameters extracted by the route pattern, e.g. {"name": ...} for "/chat/{name}"
+    Codecs = None           # codecs accepted by the route as subprotocols, e.g. ["msgpack", "json"], see codec.py
+    RateLimit = None        # ratelimit.RateLimit for the received messages, unless set in the handler map
+    
     def __init__(self, app, ws):
         #Primitive.__init__(self)
         self.App = app
         self.WS = ws
         
-    def handshake(self, client_address, path, request_headers):
+    def handshake(self, client_address, request):
         self.ClientAddress = client_address
-        self.Path = path
-        self.RequestHeaders = request_headers
+        self.Path = request.Path
+        self.RequestHeaders = request.Headers
         return {}
         
     def run(self):
-        self.WS.close()
+        if hasattr(self, "on_message"):
+            # event-style handler
+            self.WS.run(self)
+        else:
+            self.WS.close()
+            
+    def send_obj(self, obj):
+        self.WS.send_obj(obj)
+        
+    def recv_obj(self, timeout=None):
+        return self.WS.recv_obj(timeout)
+        
+class AsyncWSHandler(object):
+    
+    # handler base class for AsyncWebsocketServer. handshake() may be a plain method or a coroutine
+    
+    PathParams = {}
+    Codecs = None
+    RateLimit = None
+    
+    def __init__(self, app, ws):
+        self.App = app
+        self.WS = ws
+        
+    def handshake(self, client_address, request):
+        self.ClientAddress = client_address
+        self.Path = request.Path
+        self.RequestHeaders = request.Headers
+        return {}
+        
+    async def run(self):
+        await self.WS.close()
+        
+    async def send_obj(self, obj):
+        await self.WS.send_obj(obj)
+        
+    async def recv_obj(self, timeout=None):
+        return await self.WS.recv_obj(timeout)
         
 class WSApp(Primitive):
     
@@ -27,6 +72,10 @@ class WSApp(Primitive):
         #   - [(pattern, class), ...]
         #.  - {pattern:class, ...}
         #
+        # patterns are fnmatch-style and may contain path parameters: "/chat/{name}", see router.py
+        # class may also be (class, RateLimit) to limit the rate of the messages received by the route,
+        # see ratelimit.py
+        #
         Primitive.__init__(self)
         self.Map = []
         if isinstance(handler_map, list):
@@ -35,18 +84,42 @@ class WSApp(Primitive):
             self.Map = list(handler_map.items())
         else:
             self.Map = [('*',handler_map)]
+        self.Router = Router(self.Map)
             
     def createHandler(self, ws, request):
-        path = request.Path
-        for pattern, clas in self.Map:
-            if fnmatch.fnmatch(path, pattern):
-                return clas(self, ws)
-        else:
+        clas, params = self.Router.resolve(request.Path)
+        if clas is None:
             return None
+        limit = None
+        if isinstance(clas, tuple):
+            clas, limit = clas
+        limit = limit or clas.RateLimit
+        handler = clas(self, ws)
+        handler.PathParams = dict(params)
+        if clas.Codecs is not None:
+            ws.Codecs = clas.Codecs         # negotiated when the handshake response is sent
+        if limit is not None:
+            ws.RateLimiter = limit.limiter()
+        return handler
         
-    def run_server(self, port, **args):
-        server = WebsocketServer(port, self, **args)
-        server.start()
-        server.join()
+    def run_server(self, port, reactor=False, workers=None, **args):
+        # reactor=True: serve all connections from one thread using ReactorServer
+        # workers=N: fork N processes, each with its own SO_REUSEPORT listening socket. Crashed workers are restarted
+        server_class = ReactorServer if reactor else WebsocketServer
+        if workers:
+            def run_worker(index):
+                server = server_class(port, self, reuse_port=True, **args)
+                server.start()
+                server.join()
+            WorkerSupervisor(workers, run_worker).run()
+        else:
+            server = server_class(port, self, **args)
+            server.start()
+            server.join()
+
+    def run_async_server(self, port, **args):
+        # runs AsyncWebsocketServer in the current thread, dispatching to AsyncWSHandler subclasses
+        server = AsyncWebsocketServer(port, self, **args)
+        asyncio.run(server.serve_forever())
 
 
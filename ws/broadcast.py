@@ -0,0 +1,259 @@
+from socket import *
+import selectors, os
+from collections import deque
+from pythreader import PyThread, synchronized
+from .ws import frame_header, send_nonblocking
+from .mask import apply_mask
+from .text import RawText
+from .buffers import PooledMessage
+from .codec import Encoded
+
+#
+# Broadcaster: topic based fan-out of messages to many peers.
+#
+# Each published message is encoded into a wire frame once and the same bytes are queued to every subscriber.
+# A single writer thread sends queued frames with non-blocking send() calls and waits for writability
+# of slow sockets with a selector, so one slow subscriber does not delay the others.
+#
+# Subscribers which have more than max_pending bytes queued are handled according to the slow_policy:
+#
+#   "drop"          - new messages for the subscriber are dropped until its queue drains below the limit
+#   "disconnect"    - the subscriber is unsubscribed and its connection is shut down
+#
+
+class Subscriber(object):
+
+    def __init__(self, peer):
+        self.Peer = peer
+        self.Topics = set()
+        self.Queue = deque()        # memoryviews of frames
+        self.Pending = 0            # bytes queued
+        self.Locked = False         # holding peer.SendLock while a frame is partially sent
+        self.Waiting = False        # registered with the selector for EVENT_WRITE
+        self.Removed = False        # to be cleaned up by the writer thread
+        self.Delivered = 0
+        self.Dropped = 0
+
+    def flush(self):
+        # returns "done", "blocked" (socket buffer full), "busy" (another thread is sending to the peer)
+        # or "closed" (the peer sent or received a close frame, no data frames may follow it)
+        peer = self.Peer
+        while self.Queue:
+            if not self.Locked:
+                if not peer.SendLock.acquire(blocking=False):
+                    return "busy"
+                if peer.State != peer.OPEN:
+                    peer.SendLock.release()
+                    return "closed"
+                self.Locked = True
+            frame = self.Queue[0]
+            try:
+                n = send_nonblocking(peer.Sock, frame)
+            except BlockingIOError:
+                return "blocked"
+            self.Pending -= n
+            if n < len(frame):
+                self.Queue[0] = frame[n:]
+                return "blocked"
+            self.Queue.popleft()
+            self.Locked = False
+            peer.SendLock.release()
+        return "done"
+
+    def release(self):
+        if self.Locked:
+            self.Locked = False
+            self.Peer.SendLock.release()
+
+class Broadcaster(PyThread):
+
+    def __init__(self, max_pending=1024*1024, slow_policy="drop", poll_interval=0.01):
+        assert slow_policy in ("drop", "disconnect")
+        PyThread.__init__(self, daemon=True)
+        self.MaxPending = max_pending
+        self.SlowPolicy = slow_policy
+        self.PollInterval = poll_interval       # retry interval for subscribers busy sending on their own
+        self.Topics = {}                        # topic -> set of Subscribers
+        self.Subscribers = {}                   # peer -> Subscriber
+        self.Ready = set()                      # subscribers with queued frames, not waiting for writability
+        self.Selector = selectors.DefaultSelector()
+        self.WakeupRead, self.WakeupWrite = socketpair()
+        self.WakeupRead.setblocking(False)
+        self.WakeupWrite.setblocking(False)
+        self.Selector.register(self.WakeupRead, selectors.EVENT_READ, None)
+        self.Stop = False
+
+        # statistics
+        self.Published = 0
+        self.Delivered = 0
+        self.Dropped = 0
+        self.Disconnected = 0
+
+    @synchronized
+    def subscribe(self, peer, topic=""):
+        subscriber = self.Subscribers.get(peer)
+        if subscriber is None:
+            subscriber = self.Subscribers[peer] = Subscriber(peer)
+        subscriber.Topics.add(topic)
+        self.Topics.setdefault(topic, set()).add(subscriber)
+
+    @synchronized
+    def unsubscribe(self, peer, topic=None):
+        # topic=None: unsubscribe from all topics
+        subscriber = self.Subscribers.get(peer)
+        if subscriber is None:
+            return
+        topics = list(subscriber.Topics) if topic is None else [topic]
+        for t in topics:
+            subscriber.Topics.discard(t)
+            subscribers = self.Topics.get(t)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self.Topics[t]
+        if not subscriber.Topics:
+            del self.Subscribers[peer]
+
+    def subscribers(self, topic=""):
+        return [s.Peer for s in self.Topics.get(topic, ())]
+
+    def encode(self, message):
+        # returns (frame, opcode, payload). The frame is shared by all unmasked peers
+        binary = isinstance(message, (bytes, bytearray, memoryview))
+        if isinstance(message, RawText):
+            payload = message.Data
+        elif isinstance(message, PooledMessage):
+            binary = message.Binary
+            payload = bytes(message.View)       # it may be released before the frame is sent
+        else:
+            payload = message if binary else message.encode("utf-8")
+        opcode = 2 if binary else 1
+        return frame_header(True, opcode, len(payload)) + payload, opcode, payload
+
+    def publish(self, message, topic="", exclude=()):
+        # message: str, bytes, RawText, buffers.PooledMessage or codec.Encoded. An Encoded object is encoded into one frame for each
+        # codec used by the subscribers
+        if isinstance(message, Encoded):
+            frames = {}                 # codec -> (opcode, payload, shared frame)
+        else:
+            frames = None
+            frame, opcode, payload = self.encode(message)
+            shared = memoryview(frame)
+        with self:
+            self.Published += 1
+            for subscriber in list(self.Topics.get(topic, ())):       # _remove() changes the set
+                peer = subscriber.Peer
+                if peer in exclude:
+                    continue
+                if peer.State != peer.OPEN or peer.Sock is None:
+                    self._remove(subscriber)
+                    continue
+                if subscriber.Pending > self.MaxPending:
+                    if self.SlowPolicy == "drop":
+                        subscriber.Dropped += 1
+                        self.Dropped += 1
+                    else:
+                        self._disconnect(subscriber)
+                    continue
+                if frames is not None:
+                    entry = frames.get(peer.Codec)
+                    if entry is None:
+                        frame, opcode, payload = self.encode(message.payload(peer.Codec))
+                        entry = frames[peer.Codec] = (opcode, payload, memoryview(frame))
+                    opcode, payload, shared = entry
+                if peer.SendMasked:
+                    mask = os.urandom(4)
+                    data = memoryview(frame_header(True, opcode, len(payload), mask) + apply_mask(mask, payload))
+                else:
+                    data = shared
+                subscriber.Queue.append(data)
+                subscriber.Pending += len(data)
+                subscriber.Delivered += 1
+                self.Delivered += 1
+                if not subscriber.Waiting:
+                    self.Ready.add(subscriber)
+        self.wakeup()
+
+    def publish_obj(self, obj, topic="", exclude=()):
+        # sends the object to each subscriber, encoded with the subscriber's codec
+        self.publish(obj if isinstance(obj, Encoded) else Encoded(obj), topic, exclude)
+
+    def wakeup(self):
+        try:    self.WakeupWrite.send(b"x")
+        except BlockingIOError:
+            pass                # already signalled
+
+    def _remove(self, subscriber):
+        # called with the Broadcaster locked. The SendLock and the selector belong to the writer thread,
+        # so the rest of the cleanup is done there
+        self.unsubscribe(subscriber.Peer)
+        subscriber.Removed = True
+        subscriber.Queue.clear()
+        subscriber.Pending = 0
+        self.Ready.add(subscriber)
+
+    def _disconnect(self, subscriber):
+        self._remove(subscriber)
+        self.Disconnected += 1
+        try:    subscriber.Peer.Sock.shutdown(SHUT_RDWR)       # the peer's reader will see EOF and clean up
+        except (OSError, AttributeError):
+            pass
+
+    def _cleanup(self, subscriber):
+        # writer thread only
+        subscriber.release()
+        self.Ready.discard(subscriber)
+        if subscriber.Waiting:
+            try:    self.Selector.unregister(subscriber.Peer.Sock)
+            except (KeyError, ValueError, AttributeError):
+                pass
+            subscriber.Waiting = False
+
+    def stop(self):
+        self.Stop = True
+        self.wakeup()
+
+    def run(self):
+        while not self.Stop:
+            with self:
+                timeout = None if not self.Ready else self.PollInterval
+            for key, events in self.Selector.select(timeout):
+                subscriber = key.data
+                if subscriber is None:
+                    try:
+                        while self.WakeupRead.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    with self:
+                        self.Selector.unregister(key.fileobj)
+                        subscriber.Waiting = False
+                        self.Ready.add(subscriber)
+            with self:
+                for subscriber in list(self.Ready):
+                    if subscriber.Removed:
+                        self._cleanup(subscriber)
+                        continue
+                    try:
+                        status = subscriber.flush()
+                    except (OSError, AttributeError):     # AttributeError: the peer has been shut down
+                        self._remove(subscriber)
+                        self._cleanup(subscriber)
+                        continue
+                    if status == "closed":
+                        self._remove(subscriber)
+                        self._cleanup(subscriber)
+                    elif status == "done":
+                        self.Ready.discard(subscriber)
+                    elif status == "blocked":
+                        self.Ready.discard(subscriber)
+                        subscriber.Waiting = True
+                        try:    self.Selector.register(subscriber.Peer.Sock, selectors.EVENT_WRITE, subscriber)
+                        except (ValueError, KeyError, AttributeError):
+                            self._remove(subscriber)        # peer has been closed
+                            self._cleanup(subscriber)
+                    # "busy": stays in Ready, retried after PollInterval
+        with self:
+            for subscriber in list(self.Subscribers.values()):
+                subscriber.release()
@@ -0,0 +1,142 @@
+#
+# Pooled receive buffers
+#
+# WebsocketPeer.recv_message() receives the payload of a message into a bytearray taken from a BufferPool:
+# frame bodies are read from the socket with recv_into() and unmasked in place, so a message costs no
+# allocations once the pool is warm. The message is returned as a PooledMessage, which holds a memoryview
+# of the payload and returns the buffer to the pool when released:
+#
+#   with ws.recv_message() as message:
+#       process(message.View)
+#
+# or message.release(). Views taken from message.View must not be used after the release. A buffer is put
+# back into the pool only if no such views are left, otherwise it is dropped and freed by the garbage collector.
+#
+# Buffer sizes are rounded up to size classes, powers of 2 from MinSize to MaxSize. Larger buffers are
+# allocated for each message and not pooled.
+#
+# The gain is for large messages, which recv() allocates with mmap() two or three times each. Small ones are
+# cheap to allocate, CPython keeps its own pools of small blocks, and recv() is slightly faster for them.
+#
+
+class BufferPool(object):
+
+    # Thread-safe without a lock: the free lists are only changed with list.pop() and list.append(), which are
+    # atomic. The statistics may miss concurrent updates
+
+    MinSize = 256
+    MaxSize = 4*1024*1024
+    ClassBytes = 4*1024*1024        # free buffers kept per size class, in bytes. At least one buffer is kept
+
+    def __init__(self, max_size=None, class_bytes=None):
+        if max_size is not None:
+            self.MaxSize = max_size
+        if class_bytes is not None:
+            self.ClassBytes = class_bytes
+        self.Free = {}              # size class -> list of bytearrays
+        size = self.MinSize
+        while size <= self.MaxSize:
+            self.Free[size] = []
+            size *= 2
+
+        # statistics
+        self.Acquired = 0
+        self.Reused = 0
+        self.Released = 0
+        self.Dropped = 0            # not returned to the pool: class full, or views still exported
+
+    def size_class(self, n):
+        # returns the size of buffers allocated for n bytes, None if they are not pooled
+        if n <= self.MinSize:
+            return self.MinSize
+        if n > self.MaxSize:
+            return None
+        return 1 << (n-1).bit_length()
+
+    def acquire(self, n):
+        # returns a bytearray of at least n bytes
+        self.Acquired += 1
+        size = self.size_class(n)
+        if size is None:
+            return bytearray(n)
+        try:    buf = self.Free[size].pop()
+        except IndexError:
+            return bytearray(size)
+        self.Reused += 1
+        return buf
+
+    def release(self, buf):
+        free = self.Free.get(len(buf))
+        if free is None:
+            return                  # not pooled
+        try:
+            buf.append(0)           # fails if views of the buffer are still exported
+            buf.pop()
+        except BufferError:
+            self.Dropped += 1
+            return
+        if not free or len(free) * len(buf) < self.ClassBytes:
+            free.append(buf)
+            self.Released += 1
+        else:
+            self.Dropped += 1
+
+    def grow(self, buf, size, n):
+        # returns a buffer of at least n bytes holding the first size bytes of buf, releases buf
+        if n <= len(buf):
+            return buf
+        new = self.acquire(max(n, 2*len(buf)))
+        new[:size] = memoryview(buf)[:size]
+        self.release(buf)
+        return new
+
+    def stats(self):
+        return {
+            "acquired":     self.Acquired,
+            "reused":       self.Reused,
+            "released":     self.Released,
+            "dropped":      self.Dropped,
+            "free_buffers": sum(len(free) for free in self.Free.values()),
+            "free_bytes":   sum(size*len(free) for size, free in list(self.Free.items()))
+        }
+
+DefaultPool = BufferPool()
+
+class PooledMessage(object):
+
+    __slots__ = ("View", "Binary", "Buffer", "Pool")
+
+    def __init__(self, pool, buffer, size, binary):
+        # text messages hold valid UTF-8
+        self.Pool = pool
+        self.Buffer = buffer
+        self.View = memoryview(buffer)[:size]
+        self.Binary = binary
+
+    def release(self):
+        # the View becomes unusable. Can be called more than once
+        buffer = self.Buffer
+        if buffer is not None:
+            self.Buffer = None
+            self.View.release()
+            self.Pool.release(buffer)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *params):
+        self.release()
+
+    def __len__(self):
+        return len(self.View)
+
+    def __bytes__(self):
+        return self.View.tobytes()
+
+    @property
+    def text(self):
+        return str(self.View, "utf-8")
+
+    def __repr__(self):
+        state = "released" if self.Buffer is None else "%d bytes" % (len(self.View),)
+        return "PooledMessage(%s, %s)" % ("binary" if self.Binary else "text", state)
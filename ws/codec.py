@@ -0,0 +1,131 @@
+import json
+from .text import RawText
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+#
+# Message codecs for WebsocketPeer.send_obj() and recv_obj()
+#
+#   json        - text frames. Uses orjson when it is installed, otherwise the json module
+#   msgpack     - binary frames. Available when msgpack is installed
+#
+# The codec of a connection is negotiated as the WebSocket subprotocol (Sec-WebSocket-Protocol).
+# A route lists the codecs it accepts, in order of preference, in its handler class:
+#
+#   class Handler(WSHandler):
+#       Codecs = ["msgpack", "json"]
+#
+# and a client offers its codecs with connect(url, codecs=["msgpack", "json"]). Names of codecs which are
+# not available are skipped. If the two sides have no codec in common, or the client offers no subprotocol,
+# the connection uses JSON.
+#
+# Encoded(obj) wraps an object sent to many peers: it is encoded once for each codec in use, instead of once
+# per peer. WebsocketPeer.send_obj() and Broadcaster.publish() accept Encoded objects.
+#
+
+class JSONCodec(object):
+
+    Name = "json"
+
+    def __init__(self, use_orjson=True):
+        self.ORJSON = orjson if use_orjson else None
+
+    def encode(self, obj):
+        # returns RawText, so that send() does not encode the text again
+        if self.ORJSON is not None:
+            try:    return RawText(self.ORJSON.dumps(obj))
+            except TypeError:
+                pass            # e.g. non-str dict keys, which orjson rejects and the json module converts
+        return RawText(json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8"))
+
+    def decode(self, message):
+        if isinstance(message, RawText):
+            message = message.Data
+        if self.ORJSON is not None:
+            return self.ORJSON.loads(message)
+        return json.loads(message)
+
+class MsgpackCodec(object):
+
+    Name = "msgpack"
+
+    def encode(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, message):
+        if isinstance(message, RawText):
+            message = message.Data
+        return msgpack.unpackb(message, raw=False)
+
+Codecs = {}                 # name -> codec
+
+def register(codec):
+    # codec: object with Name, encode(obj) and decode(message). encode() returns str or RawText for text frames,
+    # bytes for binary frames
+    Codecs[codec.Name] = codec
+
+register(JSONCodec())
+if msgpack is not None:
+    register(MsgpackCodec())
+
+DefaultCodec = Codecs["json"]
+
+def get_codec(codec):
+    # codec: name or codec object
+    if not isinstance(codec, str):
+        return codec
+    try:    return Codecs[codec]
+    except KeyError:
+        raise ValueError("Unknown or unavailable codec: %s" % (codec,))
+
+def available(codecs):
+    # codec objects for the names and objects in the list, skipping unavailable names
+    return [Codecs[c] if isinstance(c, str) else c for c in codecs if not isinstance(c, str) or c in Codecs]
+
+def client_offer(codecs):
+    # Sec-WebSocket-Protocol header value
+    return ", ".join(c.Name for c in available(codecs))
+
+def accept_offer(header, codecs):
+    # server side. codecs: accepted by the route, in order of preference.
+    # Returns (codec, response header value) or (DefaultCodec, None) if there is no codec in common
+    offered = {p.strip() for p in (header or "").split(",")}
+    for codec in available(codecs):
+        if codec.Name in offered:
+            return codec, codec.Name
+    return DefaultCodec, None
+
+def accept_response(header, codecs):
+    # client side. Returns the codec selected by the server, DefaultCodec if the server did not select any
+    protocol = (header or "").strip()
+    if not protocol:
+        return DefaultCodec
+    for codec in available(codecs):
+        if codec.Name == protocol:
+            return codec
+    raise ValueError("The server selected a subprotocol which was not offered: %s" % (protocol,))
+
+class Encoded(object):
+
+    # An object to be sent to many peers, encoded on first use with each codec
+
+    __slots__ = ("Object", "Payloads")
+
+    def __init__(self, obj):
+        self.Object = obj
+        self.Payloads = {}          # codec -> encoded message
+
+    def payload(self, codec):
+        # concurrent senders may both encode it, which is harmless
+        payload = self.Payloads.get(codec)
+        if payload is None:
+            payload = self.Payloads[codec] = codec.encode(self.Object)
+        return payload
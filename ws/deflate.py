@@ -0,0 +1,182 @@
+#
+# permessage-deflate extension, RFC 7692
+#
+# Compression options are passed to WebsocketPeer, connect() and the servers as compression=<dict> or compression=True.
+# Recognized options:
+#
+#   threshold                       - messages shorter than this are sent uncompressed, default 64 bytes
+#   level                           - zlib compression level, default 6
+#   mem_level                       - zlib memory level, default 8
+#   server_no_context_takeover      - request/accept that the server resets its compressor after each message
+#   client_no_context_takeover      - request/accept that the client resets its compressor after each message
+#   server_max_window_bits          - limit server compressor window, 9...15
+#   client_max_window_bits          - limit client compressor window, 9...15
+#
+
+import zlib, time
+
+ExtensionName = "permessage-deflate"
+Tail = b"\x00\x00\xff\xff"
+
+def _options(options):
+    return {} if options is True or options is None else options
+
+def parse_extensions(header):
+    # "ext; p1; p2=v, ext2" -> [("ext", {"p1":None, "p2":"v"}), ("ext2", {})]
+    out = []
+    if not header:
+        return out
+    for item in header.split(","):
+        words = [w.strip() for w in item.split(";")]
+        if not words[0]:
+            continue
+        params = {}
+        for word in words[1:]:
+            if not word:
+                continue
+            if "=" in word:
+                name, value = word.split("=", 1)
+                params[name.strip()] = value.strip().strip('"')
+            else:
+                params[word] = None
+        out.append((words[0], params))
+    return out
+
+def format_extension(params):
+    words = [ExtensionName]
+    for name, value in params.items():
+        words.append(name if value is None else f"{name}={value}")
+    return "; ".join(words)
+
+def client_offer(options):
+    options = _options(options)
+    params = {}
+    for name in ("server_no_context_takeover", "client_no_context_takeover"):
+        if options.get(name):
+            params[name] = None
+    if options.get("server_max_window_bits"):
+        params["server_max_window_bits"] = options["server_max_window_bits"]
+    params["client_max_window_bits"] = options.get("client_max_window_bits")
+    return format_extension(params)
+
+def accept_offer(header, options):
+    # server side. Returns (PerMessageDeflate, response header value) or (None, None) if not offered
+    options = _options(options)
+    for name, offer in parse_extensions(header):
+        if name != ExtensionName:
+            continue
+        if set(offer) - {"server_no_context_takeover", "client_no_context_takeover",
+                                "server_max_window_bits", "client_max_window_bits"}:
+            continue
+        try:
+            params = {}
+            server_no_context = "server_no_context_takeover" in offer or bool(options.get("server_no_context_takeover"))
+            client_no_context = "client_no_context_takeover" in offer or bool(options.get("client_no_context_takeover"))
+            if server_no_context:
+                params["server_no_context_takeover"] = None
+            if client_no_context:
+                params["client_no_context_takeover"] = None
+            server_bits = min(int(offer.get("server_max_window_bits") or 15), options.get("server_max_window_bits") or 15)
+            if "server_max_window_bits" in offer or server_bits < 15:
+                params["server_max_window_bits"] = server_bits
+            client_bits = 15
+            if "client_max_window_bits" in offer:
+                client_bits = min(int(offer["client_max_window_bits"] or 15), options.get("client_max_window_bits") or 15)
+                if client_bits < 15 or offer["client_max_window_bits"]:
+                    params["client_max_window_bits"] = client_bits
+        except ValueError:
+            continue
+        if not (9 <= server_bits <= 15 and 9 <= client_bits <= 15):       # zlib does not support 8-bit raw deflate window
+            continue
+        deflate = PerMessageDeflate(True, server_no_context, client_no_context, server_bits, client_bits, options)
+        return deflate, format_extension(params)
+    return None, None
+
+def accept_response(header, options):
+    # client side. Returns PerMessageDeflate or None if the server did not accept the offer
+    options = _options(options)
+    for name, params in parse_extensions(header):
+        if name == ExtensionName:
+            return PerMessageDeflate(False,
+                "server_no_context_takeover" in params,
+                "client_no_context_takeover" in params,
+                int(params.get("server_max_window_bits") or 15),
+                int(params.get("client_max_window_bits") or 15),
+                options)
+    return None
+
+class PerMessageDeflate(object):
+
+    def __init__(self, server, server_no_context_takeover, client_no_context_takeover,
+                server_max_window_bits, client_max_window_bits, options={}):
+        if server:
+            self.LocalContextTakeover = not server_no_context_takeover
+            self.RemoteContextTakeover = not client_no_context_takeover
+            self.LocalWindowBits = server_max_window_bits
+        else:
+            self.LocalContextTakeover = not client_no_context_takeover
+            self.RemoteContextTakeover = not server_no_context_takeover
+            self.LocalWindowBits = client_max_window_bits
+        self.LocalWindowBits = max(9, self.LocalWindowBits)
+        self.Threshold = options.get("threshold", 64)
+        self.Level = options.get("level", 6)
+        self.MemLevel = options.get("mem_level", 8)
+        self.Compressor = None
+        self.Decompressor = None
+
+        # statistics
+        self.MessagesCompressed = 0
+        self.MessagesSkipped = 0
+        self.BytesBeforeCompression = 0
+        self.BytesAfterCompression = 0
+        self.BytesBeforeDecompression = 0
+        self.BytesAfterDecompression = 0
+        self.CompressTime = 0.0
+        self.DecompressTime = 0.0
+
+    def should_compress(self, data):
+        if len(data) < self.Threshold:
+            self.MessagesSkipped += 1
+            return False
+        return True
+
+    def compress(self, data):
+        t0 = time.thread_time()
+        if self.Compressor is None or not self.LocalContextTakeover:
+            self.Compressor = zlib.compressobj(self.Level, zlib.DEFLATED, -self.LocalWindowBits, self.MemLevel)
+        out = self.Compressor.compress(data) + self.Compressor.flush(zlib.Z_SYNC_FLUSH)
+        if out.endswith(Tail):
+            out = out[:-4]
+        self.CompressTime += time.thread_time() - t0
+        self.MessagesCompressed += 1
+        self.BytesBeforeCompression += len(data)
+        self.BytesAfterCompression += len(out)
+        return out
+
+    def decompress(self, data, fin, max_length=0):
+        # called for each fragment of a compressed message
+        # max_length: if not 0, the output of each decompression call is truncated to this length
+        t0 = time.thread_time()
+        if self.Decompressor is None:
+            self.Decompressor = zlib.decompressobj(-15)
+        out = self.Decompressor.decompress(data, max_length)
+        if fin:
+            out += self.Decompressor.decompress(Tail, max_length)
+            if not self.RemoteContextTakeover:
+                self.Decompressor = None
+        self.DecompressTime += time.thread_time() - t0
+        self.BytesBeforeDecompression += len(data)
+        self.BytesAfterDecompression += len(out)
+        return out
+
+    def stats(self):
+        sent_ratio = self.BytesBeforeCompression/self.BytesAfterCompression if self.BytesAfterCompression else None
+        recv_ratio = self.BytesAfterDecompression/self.BytesBeforeDecompression if self.BytesBeforeDecompression else None
+        return {
+            "messages_compressed":      self.MessagesCompressed,
+            "messages_skipped":         self.MessagesSkipped,
+            "sent_ratio":               sent_ratio,
+            "received_ratio":           recv_ratio,
+            "compress_cpu_time":        self.CompressTime,
+            "decompress_cpu_time":      self.DecompressTime
+        }
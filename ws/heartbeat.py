@@ -0,0 +1,201 @@
+from socket import *
+import time, struct
+from pythreader import PyThread, synchronized
+from .ws import send_nonblocking
+
+#
+# HeartbeatManager: server-wide pings, RTT measurement and idle timeouts for all connections.
+#
+# Each registered peer has one timer in a hashed timer wheel. Every tick, the manager only looks at
+# the timers in the current wheel slot, so the cost per tick does not depend on the number of connections.
+#
+#   ping_interval   - seconds between pings sent to each peer
+#   ping_timeout    - the peer is disconnected if the pong does not arrive within this time
+#   idle_timeout    - the peer is disconnected if it does not send any data frames for this long. None: no limit
+#   tick            - timer resolution, seconds
+#
+# Disconnecting shuts the socket down. The thread reading from the peer then sees EOF and cleans up as usual.
+#
+
+class TimerWheel(object):
+
+    # not thread-safe, used by the HeartbeatManager under its lock
+
+    def __init__(self, tick, nslots=512):
+        self.Tick = tick
+        self.Slots = [[] for _ in range(nslots)]
+        self.Current = 0                # ticks elapsed
+
+    def schedule(self, delay, item):
+        due = self.Current + max(1, int(delay/self.Tick + 0.999))
+        self.Slots[due % len(self.Slots)].append((due, item))
+
+    def advance(self):
+        # moves to the next tick, returns the items due
+        self.Current += 1
+        index = self.Current % len(self.Slots)
+        slot = self.Slots[index]
+        if not slot:
+            return []
+        due = [item for t, item in slot if t <= self.Current]
+        if len(due) < len(slot):
+            self.Slots[index] = [(t, item) for t, item in slot if t > self.Current]     # later rounds of the wheel
+        else:
+            self.Slots[index] = []
+        return due
+
+class PeerState(object):
+
+    def __init__(self, peer):
+        self.Peer = peer
+        self.LastPing = time.monotonic()
+        self.PingTime = None        # when the current ping became due, None if not waiting for a pong
+        self.PingSent = False
+        self.Payload = None
+        self.RTT = None             # last measured round trip time
+        self.Pongs = 0
+
+class HeartbeatManager(PyThread):
+
+    def __init__(self, ping_interval=20.0, ping_timeout=20.0, idle_timeout=None, tick=0.5, nslots=512):
+        PyThread.__init__(self, daemon=True)
+        self.PingInterval = ping_interval
+        self.PingTimeout = ping_timeout
+        self.IdleTimeout = idle_timeout
+        self.Wheel = TimerWheel(tick, nslots)
+        self.States = {}            # peer -> PeerState
+        self.Counter = 0
+        self.Stop = False
+
+        # statistics
+        self.PingsSent = 0
+        self.PongsReceived = 0
+        self.TimedOut = 0
+        self.IdleClosed = 0
+
+    @synchronized
+    def register(self, peer):
+        if peer not in self.States:
+            self.States[peer] = PeerState(peer)
+            peer.Heartbeat = self
+            self.Wheel.schedule(self.PingInterval, peer)
+
+    @synchronized
+    def unregister(self, peer):
+        # the timer is dropped when it fires
+        self.States.pop(peer, None)
+        peer.Heartbeat = None
+
+    @synchronized
+    def pong(self, peer, payload):
+        # called by the peer when a pong arrives
+        state = self.States.get(peer)
+        if state is not None and state.PingTime is not None and payload == state.Payload:
+            state.RTT = time.monotonic() - state.PingTime
+            peer.Stats.RTT.observe(state.RTT)
+            state.PingTime = None
+            state.Pongs += 1
+            self.PongsReceived += 1
+
+    def rtt(self, peer):
+        state = self.States.get(peer)
+        return None if state is None else state.RTT
+
+    @synchronized
+    def stats(self):
+        rtts = [s.RTT for s in self.States.values() if s.RTT is not None]
+        return {
+            "peers":            len(self.States),
+            "pings_sent":       self.PingsSent,
+            "pongs_received":   self.PongsReceived,
+            "timed_out":        self.TimedOut,
+            "idle_closed":      self.IdleClosed,
+            "rtt_avg":          sum(rtts)/len(rtts) if rtts else None,
+            "rtt_max":          max(rtts) if rtts else None
+        }
+
+    def send_ping(self, peer, payload):
+        # never blocks the manager thread. Returns False if the ping could not be sent now
+        if peer.Writer is not None:
+            peer.Writer.put(lambda: [peer.encode_fragment(True, 9, peer.SendMasked, payload)], force=True, urgent=True)
+            return True
+        frame = b''.join(peer.encode_fragment(True, 9, peer.SendMasked, payload))
+        if not peer.SendLock.acquire(blocking=False):
+            # another thread is sending to the peer. If it is sending a fragmented message,
+            # it sends the ping after its current fragment
+            return peer.queue_control([frame])
+        try:
+            n = send_nonblocking(peer.Sock, frame)
+            if n < len(frame):
+                peer.Sock.sendall(frame[n:])        # rare, the frame must not be left incomplete
+            return True
+        except BlockingIOError:
+            return False                # socket buffer is full
+        finally:
+            peer.SendLock.release()
+
+    def disconnect(self, peer):
+        self.unregister(peer)
+        try:    peer.Sock.shutdown(SHUT_RDWR)
+        except (OSError, AttributeError):
+            pass
+
+    def check(self, peer, now):
+        # called by the manager thread when the peer's timer fires. Returns the delay for the next check or None
+        state = self.States.get(peer)
+        if state is None:
+            return None
+        if peer.Closed or peer.Sock is None:
+            self.unregister(peer)
+            return None
+        if self.IdleTimeout is not None and now - peer.LastRecv >= self.IdleTimeout:
+            self.IdleClosed += 1
+            self.disconnect(peer)
+            return None
+        if state.PingTime is not None:
+            if now - state.PingTime >= self.PingTimeout:
+                self.TimedOut += 1
+                self.disconnect(peer)
+                return None
+        elif now - state.LastPing < self.PingInterval - self.Wheel.Tick/2:
+            delay = state.LastPing + self.PingInterval - now
+            if self.IdleTimeout is not None:
+                delay = min(delay, peer.LastRecv + self.IdleTimeout - now)
+            return delay
+        else:
+            self.Counter += 1
+            state.LastPing = now
+            state.PingTime = now
+            state.PingSent = False
+            state.Payload = struct.pack("!Q", self.Counter)
+        if not state.PingSent:
+            try:    state.PingSent = self.send_ping(peer, state.Payload)
+            except (OSError, AttributeError):
+                self.disconnect(peer)
+                return None
+            if state.PingSent:
+                self.PingsSent += 1
+        if state.PingSent:
+            delay = state.PingTime + self.PingTimeout - now
+        else:
+            delay = self.Wheel.Tick         # retry soon, the timeout counts from the first attempt
+        if self.IdleTimeout is not None:
+            delay = min(delay, peer.LastRecv + self.IdleTimeout - now)
+        return delay
+
+    def stop(self):
+        self.Stop = True
+
+    def run(self):
+        tick = self.Wheel.Tick
+        t0 = time.monotonic()
+        while not self.Stop:
+            target = int((time.monotonic() - t0)/tick)
+            while self.Wheel.Current < target:
+                with self:
+                    now = time.monotonic()
+                    for peer in self.Wheel.advance():
+                        delay = self.check(peer, now)
+                        if delay is not None:
+                            self.Wheel.schedule(delay, peer)
+            time.sleep(max(0.0, t0 + (self.Wheel.Current + 1)*tick - time.monotonic()))
@@ -0,0 +1,50 @@
+#
+# Websocket payload masking (RFC 6455, section 5.3)
+#
+# Two engines are available:
+#   mask_int    - XORs the whole buffer as one Python integer, no per-byte Python code
+#   mask_numpy  - XORs 32-bit words with NumPy, used for large buffers when NumPy is installed
+#
+# apply_mask() selects the engine automatically based on the buffer size.
+#
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+NumpyThreshold = 2048           # buffers of this size and larger are masked with NumPy, if available
+
+def mask_int(mask, data, out=None):
+    # mask: bytes(4)
+    # data: bytes-like
+    # out: writable bytes-like of the same length (may be data itself) or None
+    # returns out, or new bytes object if out is None
+    n = len(data)
+    if n == 0:
+        return b'' if out is None else out
+    key = (mask * ((n+3)//4))[:n]
+    masked = (int.from_bytes(data, "little") ^ int.from_bytes(key, "little")).to_bytes(n, "little")
+    if out is None:
+        return masked
+    out[:n] = masked
+    return out
+
+def mask_numpy(mask, data, out=None):
+    n = len(data)
+    if out is None:
+        out = bytearray(n)
+    nwords = n//4
+    if nwords:
+        key = numpy.frombuffer(mask, dtype=numpy.uint32)[0]
+        numpy.bitwise_xor(numpy.frombuffer(data, dtype=numpy.uint32, count=nwords), key,
+            out=numpy.frombuffer(out, dtype=numpy.uint32, count=nwords))
+    for i in range(nwords*4, n):
+        out[i] = data[i] ^ mask[i & 3]
+    return out
+
+def apply_mask(mask, data, out=None):
+    if numpy is not None and len(data) >= NumpyThreshold:
+        return mask_numpy(mask, data, out)
+    else:
+        return mask_int(mask, data, out)
@@ -0,0 +1,197 @@
+from bisect import bisect_left
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from pythreader import Primitive, PyThread, synchronized
+
+#
+# Metrics: counters and histograms for peers and servers.
+#
+# Every WebsocketPeer keeps a PeerStats object, updated with plain attribute increments on the send and
+# receive paths. Servers keep a ServerMetrics object, which tracks the open connections and adds their
+# stats to its totals when they close. snapshot() returns a dict, prometheus() the Prometheus text format.
+#
+# Counters are not locked. Each peer is normally updated by one receiving and one sending thread,
+# and reading a snapshot while they run gives values which may be a few events behind.
+#
+
+TimeBounds = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+OpcodeNames = {1: "text", 2: "binary", 8: "close", 9: "ping", 10: "pong"}
+
+class Histogram(object):
+
+    def __init__(self, bounds=TimeBounds):
+        self.Bounds = bounds
+        self.Counts = [0]*(len(bounds) + 1)     # the last bucket is +Inf
+        self.Sum = 0.0
+        self.Count = 0
+
+    def observe(self, value):
+        self.Counts[bisect_left(self.Bounds, value)] += 1
+        self.Sum += value
+        self.Count += 1
+
+    def merge(self, other):
+        for i, n in enumerate(other.Counts):
+            self.Counts[i] += n
+        self.Sum += other.Sum
+        self.Count += other.Count
+
+    def quantile(self, q):
+        # upper bound of the bucket containing the q-quantile
+        if not self.Count:
+            return None
+        target = q*self.Count
+        n = 0
+        for i, c in enumerate(self.Counts):
+            n += c
+            if n >= target:
+                return self.Bounds[i] if i < len(self.Bounds) else float("inf")
+
+    def snapshot(self):
+        return {
+            "count":    self.Count,
+            "sum":      self.Sum,
+            "p50":      self.quantile(0.5),
+            "p99":      self.quantile(0.99),
+            "buckets":  list(zip(self.Bounds + (float("inf"),), self.Counts))
+        }
+
+class PeerStats(object):
+
+    def __init__(self):
+        self.FramesIn = [0]*16                  # by opcode. Continuation frames are counted at 0, the others are messages
+        self.FramesOut = [0]*16
+        self.BytesIn = 0
+        self.BytesOut = 0
+        self.SendTime = Histogram()             # time blocked sending a frame, including waiting for the SendLock. Sampled
+        self.RTT = Histogram()                  # ping round trip times
+        self.RateLimited = 0                    # received messages over the rate limit, see ratelimit.py
+        self.CloseCode = None
+
+    def merge(self, other):
+        self.BytesIn += other.BytesIn
+        self.BytesOut += other.BytesOut
+        self.RateLimited += other.RateLimited
+        for i in range(16):
+            self.FramesIn[i] += other.FramesIn[i]
+            self.FramesOut[i] += other.FramesOut[i]
+        self.SendTime.merge(other.SendTime)
+        self.RTT.merge(other.RTT)
+
+    def snapshot(self):
+        return {
+            "frames_in":        sum(self.FramesIn),
+            "frames_out":       sum(self.FramesOut),
+            "bytes_in":         self.BytesIn,
+            "bytes_out":        self.BytesOut,
+            "messages_in":      {OpcodeNames.get(op, str(op)): n for op, n in enumerate(self.FramesIn) if op and n},
+            "messages_out":     {OpcodeNames.get(op, str(op)): n for op, n in enumerate(self.FramesOut) if op and n},
+            "send_time":        self.SendTime.snapshot(),
+            "ping_rtt":         self.RTT.snapshot(),
+            "rate_limited":     self.RateLimited,
+            "close_code":       self.CloseCode
+        }
+
+class ServerMetrics(Primitive):
+
+    def __init__(self):
+        Primitive.__init__(self)
+        self.Totals = PeerStats()           # closed connections
+        self.Peers = set()                  # open connections
+        self.HandshakeTime = Histogram()    # from accept to the 101 response
+        self.CloseCodes = {}
+        self.Opened = 0
+        self.Closed = 0
+
+    @synchronized
+    def opened(self, peer, handshake_time):
+        self.Peers.add(peer)
+        self.Opened += 1
+        self.HandshakeTime.observe(handshake_time)
+
+    @synchronized
+    def closed(self, peer):
+        if peer in self.Peers:
+            self.Peers.remove(peer)
+            self.Closed += 1
+            self.Totals.merge(peer.Stats)
+            code = peer.ClosedCode
+            self.CloseCodes[code] = self.CloseCodes.get(code, 0) + 1
+
+    def peer_totals(self):
+        with self:
+            totals = PeerStats()
+            totals.merge(self.Totals)
+            for peer in self.Peers:
+                totals.merge(peer.Stats)
+        return totals
+
+    def snapshot(self, **gauges):
+        # gauges: additional server values, e.g. accepted/rejected counters and queue depth
+        out = self.peer_totals().snapshot()
+        del out["close_code"]
+        with self:
+            out.update({
+                "connections_open":     len(self.Peers),
+                "connections_opened":   self.Opened,
+                "connections_closed":   self.Closed,
+                "close_codes":          {str(code): n for code, n in self.CloseCodes.items()},
+                "handshake_time":       self.HandshakeTime.snapshot()
+            })
+        out.update(gauges)
+        return out
+
+def prometheus(snapshot, prefix="ws"):
+    # formats a ServerMetrics snapshot as Prometheus text exposition
+    lines = []
+    def histogram(name, h):
+        lines.append(f"# TYPE {prefix}_{name} histogram")
+        n = 0
+        for bound, count in h["buckets"]:
+            n += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f'{prefix}_{name}_bucket{{le="{le}"}} {n}')
+        lines.append(f"{prefix}_{name}_sum {h['sum']}")
+        lines.append(f"{prefix}_{name}_count {h['count']}")
+    for name, value in snapshot.items():
+        if isinstance(value, dict) and "buckets" in value:
+            histogram(name + "_seconds", value)
+        elif name in ("messages_in", "messages_out"):
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            for opcode, n in value.items():
+                lines.append(f'{prefix}_{name}_total{{opcode="{opcode}"}} {n}')
+        elif name == "close_codes":
+            lines.append(f"# TYPE {prefix}_close_codes_total counter")
+            for code, n in value.items():
+                lines.append(f'{prefix}_close_codes_total{{code="{code}"}} {n}')
+        elif isinstance(value, dict):
+            for key, v in value.items():            # nested gauges, e.g. heartbeat stats
+                if isinstance(v, (int, float)) and not isinstance(v, bool):
+                    lines.append(f"{prefix}_{name}_{key} {v}")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            lines.append(f"{prefix}_{name} {value}")
+    return "\n".join(lines) + "\n"
+
+class MetricsHTTPServer(PyThread):
+
+    # serves GET /metrics in Prometheus text format on a side port. source: callable returning the text
+
+    def __init__(self, port, source, host=""):
+        PyThread.__init__(self, daemon=True)
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = source().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *params):
+                pass
+        self.HTTPServer = HTTPServer((host, port), Handler)
+
+    def stop(self):
+        self.HTTPServer.shutdown()
+
+    def run(self):
+        self.HTTPServer.serve_forever()
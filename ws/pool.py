@@ -0,0 +1,206 @@
+from socket import *
+import time, random, struct
+from collections import deque
+from contextlib import contextmanager
+from pythreader import Primitive, synchronized
+from .ws import EOF, parse_url, connect
+
+#
+# WebsocketClientPool: reuses client connections per URL.
+#
+#   ws = pool.acquire(url)          - idle connection to the URL or a new one
+#   pool.release(ws)                - returns the connection to the pool
+#
+#   with pool.connection(url) as ws:
+#       ...                         - released on exit, discarded if the block raises
+#
+# Pooled connections are meant for request/response use: a connection is returned idle, with no messages
+# pending. Before reuse, a connection idle for more than check_after seconds is checked with a ping.
+# Connections with unread data or a close from the server are discarded.
+#
+# New connections use cached address resolution, TCP_NODELAY and optional socket buffer sizes. Failed connects
+# are retried with exponential backoff with full jitter, so a fleet of clients reconnecting after a server
+# restart spreads out instead of arriving together.
+#
+
+class AddressCache(Primitive):
+
+    def __init__(self, ttl=60.0):
+        Primitive.__init__(self)
+        self.TTL = ttl
+        self.Cache = {}             # (host, port) -> (address, expiration time)
+
+    def resolve(self, host, port):
+        now = time.monotonic()
+        with self:
+            entry = self.Cache.get((host, port))
+            if entry is not None and entry[1] > now:
+                return entry[0]
+        address = getaddrinfo(host, port, AF_INET, SOCK_STREAM)[0][4]
+        with self:
+            self.Cache[(host, port)] = (address, now + self.TTL)
+        return address
+
+    @synchronized
+    def invalidate(self, host, port):
+        self.Cache.pop((host, port), None)
+
+class WebsocketClientPool(Primitive):
+
+    def __init__(self, max_idle=10, max_idle_time=300.0, check_after=5.0, ping_timeout=5.0,
+                retries=5, backoff_base=0.1, backoff_max=10.0, dns_ttl=60.0,
+                tcp_nodelay=True, sndbuf=None, rcvbuf=None, connect_timeout=10.0, **ws_args):
+        #
+        # max_idle      - idle connections kept per URL
+        # max_idle_time - idle connections older than this are closed instead of reused
+        # check_after   - ping connections idle for longer than this before reuse
+        # retries       - connect attempts after the first one fails
+        # backoff_base, backoff_max - the delay before retry n is random between 0 and min(backoff_max, backoff_base * 2**n)
+        # ws_args       - passed to connect(), e.g. compression, max_fragment
+        #
+        Primitive.__init__(self)
+        self.MaxIdle = max_idle
+        self.MaxIdleTime = max_idle_time
+        self.CheckAfter = check_after
+        self.PingTimeout = ping_timeout
+        self.Retries = retries
+        self.BackoffBase = backoff_base
+        self.BackoffMax = backoff_max
+        self.Resolver = AddressCache(dns_ttl)
+        self.ConnectArgs = dict(tcp_nodelay=tcp_nodelay, sndbuf=sndbuf, rcvbuf=rcvbuf, connect_timeout=connect_timeout,
+                **ws_args)
+        self.Idle = {}              # key -> deque of (ws, idle since)
+        self.Keys = {}              # ws -> key, for connections handed out by the pool
+        self.PingCounter = 0
+
+        # statistics
+        self.Created = 0
+        self.Reused = 0
+        self.Failed = 0             # failed connect attempts
+        self.Discarded = 0          # idle connections found broken
+
+    def key(self, url, headers):
+        return (url, tuple(sorted(headers.items())))
+
+    def acquire(self, url, headers={}):
+        key = self.key(url, headers)
+        now = time.monotonic()
+        while True:
+            with self:
+                idle = self.Idle.get(key)
+                if not idle:
+                    break
+                ws, since = idle.pop()              # most recently used first
+            if now - since > self.MaxIdleTime:
+                self.discard(ws)
+                continue
+            if self.healthy(ws, now - since):
+                with self:
+                    self.Keys[ws] = key
+                    self.Reused += 1
+                return ws
+            with self:
+                self.Discarded += 1
+            self.discard(ws)
+        ws = self.connect(url, headers)
+        with self:
+            self.Keys[ws] = key
+        return ws
+
+    def release(self, ws):
+        with self:
+            key = self.Keys.pop(ws, None)
+            if key is not None and not ws.closed() and ws.Sock is not None:
+                idle = self.Idle.setdefault(key, deque())
+                if len(idle) < self.MaxIdle:
+                    idle.append((ws, time.monotonic()))
+                    return
+        self.discard(ws)
+
+    def discard(self, ws):
+        with self:
+            self.Keys.pop(ws, None)
+        try:    ws.shutdown()
+        except OSError:
+            pass
+
+    @contextmanager
+    def connection(self, url, headers={}):
+        ws = self.acquire(url, headers)
+        try:
+            yield ws
+        except:
+            self.discard(ws)
+            raise
+        else:
+            self.release(ws)
+
+    def healthy(self, ws, idle_time):
+        # an idle connection must have nothing to read. If it was idle long enough, it must also answer a ping
+        try:
+            with ws.RecvLock:
+                if ws.closed() or ws.Sock is None or ws.Buffer.ready() or ws.Buffer.wait(0):
+                    return False
+                if idle_time < self.CheckAfter:
+                    return True
+                with self:
+                    self.PingCounter += 1
+                    payload = struct.pack("!Q", self.PingCounter)
+                ws.send_ping(payload)
+                deadline = time.monotonic() + self.PingTimeout
+                while ws.wait_fragment(deadline):
+                    fin, opcode, data = ws.recv_fragment()
+                    if opcode != 10:
+                        return False
+                    if data == payload:
+                        return True
+                return False
+        except (EOF, OSError):
+            return False
+
+    def connect(self, url, headers={}):
+        host, port, uri = parse_url(url)
+        delay = self.BackoffBase
+        attempt = 0
+        while True:
+            try:
+                address = self.Resolver.resolve(host, port)
+                ws = connect(url, headers, address=address, **self.ConnectArgs)
+                with self:
+                    self.Created += 1
+                return ws
+            except (OSError, EOF) as e:
+                with self:
+                    self.Failed += 1
+                if isinstance(e, ConnectionError) and isinstance(e.errno, int) and 400 <= e.errno < 500:
+                    raise               # rejected by the server, retrying will not help
+                self.Resolver.invalidate(host, port)
+                if attempt >= self.Retries:
+                    raise
+                attempt += 1
+                pause = random.uniform(0, min(self.BackoffMax, delay))
+                retry_after = getattr(e, "Headers", {}).get("Retry-After")
+                if retry_after and retry_after.isdigit():
+                    pause = max(pause, random.uniform(int(retry_after), 2*int(retry_after)))      # 503 from an overloaded server
+                time.sleep(pause)
+                delay *= 2
+
+    def close(self):
+        with self:
+            idle = [ws for connections in self.Idle.values() for ws, since in connections]
+            self.Idle = {}
+        for ws in idle:
+            try:    ws.close()
+            except (EOF, OSError):
+                ws.shutdown()
+
+    def stats(self):
+        with self:
+            return {
+                "idle":         sum(len(connections) for connections in self.Idle.values()),
+                "in_use":       len(self.Keys),
+                "created":      self.Created,
+                "reused":       self.Reused,
+                "failed":       self.Failed,
+                "discarded":    self.Discarded
+            }
@@ -0,0 +1,104 @@
+import time
+from threading import Lock
+
+#
+# Inbound rate limits
+#
+# A RateLimit is set per route, in the WSApp handler map:
+#
+#   WSApp({
+#       "/chat/{name}":     (ChatHandler, RateLimit(messages=20, bytes=64*1024, policy="delay")),
+#       "/feed":            FeedHandler
+#   })
+#
+# or as the RateLimit class attribute of the handler. Each connection of the route gets its own token buckets,
+# refilled at messages/s and bytes/s, holding up to burst seconds worth of tokens. route_messages and route_bytes
+# limit the total rate of all connections of the route, with buckets shared by them.
+#
+# Received messages over the limit are handled according to the policy:
+#
+#   delay   - the message is delivered, and the connection is not read from until the tokens it used are
+#             replenished. The client is slowed down by TCP backpressure
+#   drop    - the message is discarded
+#   close   - the connection is closed with status 1008 (policy violation), recv() raises RateLimited
+#
+# Limits apply to the messages received with WebsocketPeer.recv(), recv_message() and recv_obj(), by
+# ReactorServer handlers and by AsyncWebsocketPeer.recv(). Control frames are not counted.
+#
+
+class TokenBucket(object):
+
+    # not thread-safe, used under the lock of its RateLimiter or RateLimit
+
+    def __init__(self, rate, burst):
+        self.Rate = float(rate)
+        self.Burst = float(burst)
+        self.Tokens = self.Burst
+        self.Time = time.monotonic()
+
+    def refill(self, now):
+        self.Tokens = min(self.Burst, self.Tokens + (now - self.Time)*self.Rate)
+        self.Time = now
+
+    def shortage(self, n):
+        # returns the seconds until n tokens are available, 0.0 if they are.
+        # A request larger than the bucket passes when the bucket is full
+        missing = min(n, self.Burst) - self.Tokens
+        return missing/self.Rate if missing > 0 else 0.0
+
+    def take(self, n):
+        # returns the seconds until the bucket is out of debt
+        self.Tokens -= n
+        return -self.Tokens/self.Rate if self.Tokens < 0 else 0.0
+
+class RateLimit(object):
+
+    Policies = ("delay", "drop", "close")
+
+    def __init__(self, messages=None, bytes=None, burst=1.0, policy="delay", route_messages=None, route_bytes=None):
+        # messages, bytes: per connection, per second. None: no limit
+        # burst: bucket size, in seconds of the rate
+        if policy not in self.Policies:
+            raise ValueError("Unknown rate limit policy: %s" % (policy,))
+        self.Messages = messages
+        self.Bytes = bytes
+        self.Burst = burst
+        self.Policy = policy
+        self.Lock = Lock()
+        self.RouteBuckets = []          # [(bucket, True if it counts messages, False if bytes)]
+        if route_messages:
+            self.RouteBuckets.append((TokenBucket(route_messages, route_messages*burst), True))
+        if route_bytes:
+            self.RouteBuckets.append((TokenBucket(route_bytes, route_bytes*burst), False))
+
+    def limiter(self):
+        # per-connection state
+        return RateLimiter(self)
+
+class RateLimiter(object):
+
+    def __init__(self, limit):
+        self.Limit = limit
+        self.Policy = limit.Policy
+        self.Buckets = []
+        if limit.Messages:
+            self.Buckets.append((TokenBucket(limit.Messages, limit.Messages*limit.Burst), True))
+        if limit.Bytes:
+            self.Buckets.append((TokenBucket(limit.Bytes, limit.Bytes*limit.Burst), False))
+        self.Lock = limit.Lock if limit.RouteBuckets else Lock()
+        self.Buckets += limit.RouteBuckets
+
+    def admit(self, nbytes):
+        # called for each received message. Returns 0.0 if it is within the limits. Otherwise, with the delay policy,
+        # the seconds to wait before reading on, and with drop and close, the seconds until it would have been
+        # within the limits. Over the limit, drop and close do not count the message
+        now = time.monotonic()
+        with self.Lock:
+            for bucket, per_message in self.Buckets:
+                bucket.refill(now)
+            if self.Policy != "delay":
+                shortage = max([bucket.shortage(1 if per_message else nbytes) for bucket, per_message in self.Buckets]
+                                or [0.0])
+                if shortage > 0:
+                    return shortage
+            return max([bucket.take(1 if per_message else nbytes) for bucket, per_message in self.Buckets] or [0.0])
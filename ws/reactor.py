@@ -0,0 +1,295 @@
+from socket import *
+import selectors, traceback, time, heapq, itertools
+from pythreader import TaskQueue, Task, PyThread
+from .ws import WebsocketPeer, EOF
+from .server import listening_socket, heartbeat_manager, overloaded_response
+from .metrics import ServerMetrics, MetricsHTTPServer, prometheus
+from .text import RawText, validate
+
+#
+# Reactor server: one thread multiplexes all connections with the selectors module.
+#
+# Handlers are created by WSApp.createHandler as usual. Event-style handlers define
+#
+#   on_open(ws)                 - optional, called after the handshake
+#   on_message(ws, message)     - called for each complete message. Return "stop" to close the connection
+#   on_close(ws, status)        - optional, called once the connection is closed
+#
+# which is the same delegate protocol used by WebsocketPeer.run(). These callbacks run in the reactor thread
+# and must not block. Handlers without on_message() are handed over to a worker thread, which calls handler.run()
+# as WebsocketServer does.
+#
+# With the delay rate limit policy, see ratelimit.py, a connection over its limit is taken off the selector
+# until its ResumeTime: its data stays in the socket buffers and the client is slowed down by TCP backpressure
+# while the other connections are served.
+#
+
+class _HandlerTask(Task):
+
+    # runs a blocking handler in a worker thread. The handshake response is sent from the task, once the
+    # handler queue has accepted it
+
+    def __init__(self, handler, ws, request, headers, server, accept_time):
+        Task.__init__(self)
+        self.Handler = handler
+        self.WS = ws
+        self.Request = request
+        self.Headers = headers
+        self.Server = server
+        self.AcceptTime = accept_time
+
+    def run(self):
+        ws = self.WS
+        metrics = self.Server.Metrics
+        try:
+            ws.send_response(self.Request, headers=self.Headers)
+        except OSError:
+            ws.shutdown()
+            return
+        metrics.opened(ws, time.monotonic() - self.AcceptTime)
+        if self.Server.Heartbeat is not None:
+            self.Server.Heartbeat.register(ws)
+        try:
+            self.Handler.run()
+        except:
+            traceback.print_exc()
+            raise
+        finally:
+            try:    ws.close()
+            except (EOF, OSError):          # the client went away without the close handshake
+                ws.shutdown()
+            finally:
+                metrics.closed(ws)
+
+class ReactorConnection(object):
+
+    def __init__(self, server, sock, address, ws_args):
+        self.Server = server
+        self.Sock = sock
+        self.Address = address
+        self.WS = WebsocketPeer(sock, **ws_args)
+        self.Handler = None
+        self.Fragments = []
+        self.Binary = None
+        self.Closed = False
+        self.Paused = False
+        self.AcceptTime = time.monotonic()
+
+    def readable(self):
+        ws = self.WS
+        buf = ws.Buffer
+        try:
+            buf.fill()
+        except OSError as e:
+            self.close(str(e))
+            return
+        if self.Handler is None:
+            if not buf.headers_ready():
+                if buf.EOF:
+                    self.close("Peer disconnected while sending the handshake")
+                return
+            if not self.handshake():
+                return
+        self.process()
+
+    def process(self):
+        # handles the buffered frames, until the connection is paused by the rate limit
+        ws = self.WS
+        try:
+            while not self.Closed and not self.Paused and ws.fragment_ready():
+                self.fragment(*ws.recv_fragment())
+        except EOF as e:
+            self.close(str(e))
+            return
+        if ws.Buffer.EOF and not self.Closed and not self.Paused:
+            self.close("Peer disconnected")
+
+    def handshake(self):
+        ws = self.WS
+        request = ws.recv_request()
+        handler = self.Server.App.createHandler(ws, request)
+        if handler is None:
+            ws.send_response(request, status="404 Not found")
+            self.close("Not found")
+            return False
+        headers = handler.handshake(self.Address, request) or {}
+        if not hasattr(handler, "on_message"):
+            # blocking handler, give it a thread. The reactor thread must not wait for a free one
+            self.Server.detach(self)
+            try:
+                self.Server.HandlerQueue.addTask(_HandlerTask(handler, ws, request, headers, self.Server,
+                    self.AcceptTime), timeout=0)
+            except RuntimeError:
+                # queue is full
+                self.Server.Rejected += 1
+                try:    self.Sock.send(self.Server.OverloadedResponse)
+                except OSError:
+                    pass
+                ws.shutdown("Server overloaded")
+            return False
+        ws.send_response(request, headers=headers)
+        self.Server.Metrics.opened(ws, time.monotonic() - self.AcceptTime)
+        if self.Server.Heartbeat is not None:
+            self.Server.Heartbeat.register(ws)
+        self.Handler = handler
+        if hasattr(handler, "on_open"):
+            handler.on_open(ws)
+        return True
+
+    def fragment(self, fin, opcode, data):
+        if opcode in (9, 10):           # ping/pong, answered by recv_fragment
+            return
+        if opcode == 8:
+            self.close("Closed by peer")
+            return
+        if self.Binary is None:
+            self.Binary = opcode == 2
+        if data:
+            self.Fragments.append(data)
+        if fin:
+            ws = self.WS
+            message = b''.join(self.Fragments)
+            binary = self.Binary
+            self.Fragments = []
+            self.Binary = None
+            if not ws.admit(len(message)):
+                return                  # dropped by the rate limit
+            if not binary:
+                if ws.RawTextMode:
+                    message = RawText(message, validate(message))
+                else:
+                    message = message.decode("utf-8")
+            if self.Handler.on_message(ws, message) == "stop":
+                self.close("Stopped by handler")
+            elif ws.RateLimiter is not None and ws.ResumeTime > time.monotonic():
+                self.Server.pause(self, ws.ResumeTime)
+
+    def close(self, status=""):
+        if not self.Closed:
+            self.Closed = True
+            self.Server.detach(self)
+            ws = self.WS
+            if not ws.Closed:
+                try:    ws.send_close(1000)
+                except OSError:
+                    pass
+                ws.shutdown(status)
+            ws.ClosedStatus = status
+            self.Server.Metrics.closed(ws)
+            if self.Handler is not None and hasattr(self.Handler, "on_close"):
+                self.Handler.on_close(ws, status)
+
+class ReactorServer(PyThread):
+
+    def __init__(self, port, app, max_workers=10, max_queued=30, select_timeout=1.0, reuse_port=False,
+                heartbeat=None, backlog=128, accept_batch=32, retry_after=1, metrics_port=None, ssl_context=None,
+                **ws_args):
+        # retry_after: Retry-After value of the 503 response sent to connections for blocking handlers when
+        # max_workers of them are running and max_queued are waiting
+        if ssl_context is not None:
+            # readiness of the selector does not account for data buffered inside the TLS layer
+            raise ValueError("ReactorServer does not support TLS, use WebsocketServer")
+        PyThread.__init__(self)
+        self.Heartbeat = heartbeat_manager(heartbeat)
+        self.Port = port
+        self.ReusePort = reuse_port
+        self.Backlog = backlog
+        self.AcceptBatch = accept_batch
+        self.App = app
+        self.WSArgs = ws_args
+        # the TaskQueue capacity counts running tasks too
+        self.HandlerQueue = TaskQueue(max_workers, capacity=max_workers + max_queued)
+        self.OverloadedResponse = overloaded_response(retry_after)
+        self.Selector = selectors.DefaultSelector()
+        self.SelectTimeout = select_timeout
+        self.Stop = False
+        self.Accepted = 0
+        self.Rejected = 0
+        self.Metrics = ServerMetrics()
+        self.MetricsPort = metrics_port
+        self.Paused = []                    # heap of (resume time, sequence, connection) paused by the rate limit
+        self.PauseSequence = itertools.count()
+        
+    def metrics(self):
+        gauges = dict(
+            accepted = self.Accepted,
+            rejected = self.Rejected,
+            handlers_running = self.HandlerQueue.nrunning(),
+            handlers_waiting = len(self.HandlerQueue.waitingTasks())
+        )
+        if self.Heartbeat is not None:
+            gauges["heartbeat"] = self.Heartbeat.stats()
+        return self.Metrics.snapshot(**gauges)
+
+    def detach(self, connection):
+        try:    self.Selector.unregister(connection.Sock)
+        except (KeyError, ValueError):
+            pass
+
+    def pause(self, connection, until):
+        connection.Paused = True
+        self.detach(connection)
+        heapq.heappush(self.Paused, (until, next(self.PauseSequence), connection))
+
+    def resume_paused(self):
+        now = time.monotonic()
+        while self.Paused and self.Paused[0][0] <= now:
+            _, _, connection = heapq.heappop(self.Paused)
+            if connection.Closed:
+                continue
+            connection.Paused = False
+            self.Selector.register(connection.Sock, selectors.EVENT_READ, connection)
+            try:
+                connection.process()        # frames already buffered, the selector would not report them
+            except:
+                traceback.print_exc()
+                connection.close("Handler error")
+
+    def accept(self, srv_sock):
+        for _ in range(self.AcceptBatch):
+            try:
+                sock, address = srv_sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            sock.setblocking(True)          # readable sockets never block on recv, sends stay blocking
+            connection = ReactorConnection(self, sock, address, self.WSArgs)
+            self.Selector.register(sock, selectors.EVENT_READ, connection)
+            self.Accepted += 1
+
+    def stop(self):
+        self.Stop = True
+
+    def connections(self):
+        return [key.data for key in self.Selector.get_map().values() if key.data is not None] + \
+            [connection for _, _, connection in self.Paused if not connection.Closed]
+
+    def run(self):
+        srv_sock = listening_socket(self.Port, self.Backlog, self.ReusePort)
+        srv_sock.setblocking(False)
+        self.Selector.register(srv_sock, selectors.EVENT_READ, None)
+        if self.Heartbeat is not None and not self.Heartbeat.is_alive():
+            self.Heartbeat.start()
+        if self.MetricsPort is not None:
+            MetricsHTTPServer(self.MetricsPort, lambda: prometheus(self.metrics())).start()
+
+        while not self.Stop:
+            timeout = self.SelectTimeout
+            if self.Paused:
+                timeout = max(0.0, min(timeout, self.Paused[0][0] - time.monotonic()))
+            for key, events in self.Selector.select(timeout):
+                connection = key.data
+                if connection is None:
+                    self.accept(srv_sock)
+                else:
+                    try:
+                        connection.readable()
+                    except:
+                        traceback.print_exc()
+                        connection.close("Handler error")
+            if self.Paused:
+                self.resume_paused()
+
+        for connection in self.connections():
+            connection.close("Server stopped")
+        self.Selector.close()
+        srv_sock.close()
@@ -0,0 +1,158 @@
+import re
+from functools import lru_cache
+
+#
+# Router: maps request paths to handler classes using fnmatch-style patterns, checked in order,
+# first match wins. Patterns may also contain path parameters:
+#
+#   "/chat/{name}"      - {name} matches one path segment, returned as params["name"]
+#
+# Resolution does not test the patterns one by one. A trie of literal pattern prefixes selects
+# the candidate routes for the path. The candidates are tested with a single combined regex, compiled
+# once per candidate set, and resolved paths are kept in an LRU cache.
+#
+
+def translate(pattern, index):
+    # returns (regex, [param names]) for the pattern. Parameter groups are named "p<index>_<name>"
+    i, n = 0, len(pattern)
+    out = []
+    params = []
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == "*":
+            out.append(".*")
+        elif c == "?":
+            out.append(".")
+        elif c == "[":
+            regex, i = translate_set(pattern, i)
+            out.append(regex)
+        elif c == "{":
+            j = pattern.find("}", i)
+            name = pattern[i:j] if j > i else ""
+            if not name.isidentifier():
+                raise ValueError("Invalid path parameter in route pattern: %s" % (pattern,))
+            params.append(name)
+            out.append("(?P<p%d_%s>[^/]+)" % (index, name))
+            i = j + 1
+        else:
+            out.append(re.escape(c))
+    return "".join(out), params
+
+def translate_set(pattern, i):
+    # translates the [...] set starting at pattern[i], after the "[", the way fnmatch.translate() does.
+    # Returns (regex, index after the set)
+    n = len(pattern)
+    j = i
+    if j < n and pattern[j] == "!":
+        j += 1
+    if j < n and pattern[j] == "]":
+        j += 1
+    while j < n and pattern[j] != "]":
+        j += 1
+    if j >= n:
+        return "\\[", i                  # unterminated, a literal "["
+    stuff = pattern[i:j]
+    if "-" not in stuff:
+        stuff = stuff.replace("\\", "\\\\")
+    else:
+        chunks = []
+        k = i + 2 if pattern[i] == "!" else i + 1
+        start = i
+        while True:
+            k = pattern.find("-", k, j)
+            if k < 0:
+                break
+            chunks.append(pattern[start:k])
+            start = k + 1
+            k += 3
+        chunk = pattern[start:j]
+        if chunk:
+            chunks.append(chunk)
+        else:
+            chunks[-1] += "-"
+        for k in range(len(chunks) - 1, 0, -1):         # remove empty ranges, invalid in a regex
+            if chunks[k-1][-1] > chunks[k][0]:
+                chunks[k-1] = chunks[k-1][:-1] + chunks[k][1:]
+                del chunks[k]
+        # escape backslashes and the hyphens which are not ranges
+        stuff = "-".join(chunk.replace("\\", "\\\\").replace("-", "\\-") for chunk in chunks)
+    stuff = re.sub(r"([&~|])", r"\\\1", stuff)         # set operations
+    if not stuff:
+        return "(?!)", j + 1                # empty set, never matches
+    if stuff == "!":
+        return ".", j + 1                   # negated empty set, any character
+    if stuff[0] == "!":
+        stuff = "^" + stuff[1:]
+    elif stuff[0] in ("^", "["):
+        stuff = "\\" + stuff
+    return "[%s]" % (stuff,), j + 1
+
+def literal_prefix(pattern):
+    for i, c in enumerate(pattern):
+        if c in "*?[{":
+            return pattern[:i]
+    return pattern
+
+class TrieNode(object):
+
+    def __init__(self):
+        self.Children = {}
+        self.Routes = []            # indexes of the routes whose literal prefix ends here
+
+class Router(object):
+
+    def __init__(self, routes, cache_size=4096):
+        # routes: [(pattern, target), ...]
+        self.Routes = []            # [(pattern, target, regex, params)]
+        self.Root = TrieNode()
+        for index, (pattern, target) in enumerate(routes):
+            regex, params = translate(pattern, index)
+            try:    re.compile(regex)       # combined lazily by matcher(), a bad pattern must fail here
+            except re.error as e:
+                raise ValueError("Invalid route pattern %s: %s" % (pattern, e))
+            self.Routes.append((pattern, target, regex, params))
+            node = self.Root
+            for c in literal_prefix(pattern):
+                node = node.Children.setdefault(c, TrieNode())
+            node.Routes.append(index)
+        self.Matchers = {}          # candidate tuple -> (compiled regex, {group index: route index})
+        self.resolve = lru_cache(maxsize=cache_size)(self.resolve_uncached)
+
+    def candidates(self, path):
+        # indexes of the routes whose literal prefix is a prefix of the path, in route order
+        found = []
+        node = self.Root
+        found += node.Routes
+        for c in path:
+            node = node.Children.get(c)
+            if node is None:
+                break
+            found += node.Routes
+        return tuple(sorted(found))
+
+    def matcher(self, candidates):
+        matcher = self.Matchers.get(candidates)
+        if matcher is None:
+            regex = re.compile("|".join("(%s)\\Z" % (self.Routes[i][2],) for i in candidates), re.DOTALL)
+            # each alternative is an outer group closing after its parameter groups, so lastindex identifies it
+            groups = {}
+            group = 1
+            for i in candidates:
+                groups[group] = i
+                group += 1 + len(self.Routes[i][3])
+            matcher = self.Matchers[candidates] = (regex, groups)
+        return matcher
+
+    def resolve_uncached(self, path):
+        # returns (target, params) or (None, None)
+        candidates = self.candidates(path)
+        if not candidates:
+            return None, None
+        regex, groups = self.matcher(candidates)
+        m = regex.match(path)
+        if m is None:
+            return None, None
+        index = groups[m.lastindex]
+        pattern, target, _, params = self.Routes[index]
+        return target, {name: m.group("p%d_%s" % (index, name)) for name in params}
@@ -1,23 +1,116 @@
 from socket import *
+import selectors, time
 from pythreader import TaskQueue, Task, PyThread
-from .ws import WebsocketPeer, WebsocketRequest
+from .ws import WebsocketPeer, EOF
+from .heartbeat import HeartbeatManager
+from .metrics import ServerMetrics, MetricsHTTPServer, prometheus
+from . import tls
 import traceback
+
+def listening_socket(port, backlog=5, reuse_port=False):
+    srv_sock = socket(AF_INET, SOCK_STREAM)
+    srv_sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    if reuse_port:
+        # several processes can bind the same port, the kernel balances accepted connections between them
+        srv_sock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+    srv_sock.bind(("", port))
+    srv_sock.listen(backlog)
+    return srv_sock
+    
+def overloaded_response(retry_after):
+    # prebuilt, sent to rejected connections without reading their handshake
+    return ("HTTP/1.1 503 Service Unavailable\r\n"
+            "Retry-After: %d\r\n"
+            "Content-Length: 0\r\n"
+            "Connection: close\r\n\r\n" % (retry_after,)).encode("ascii")
+
+class Rejector(object):
+    
+    # Sends the 503 response to rejected connections and closes them once the client has sent its request
+    # or after linger seconds. Closing a socket with unread data makes the kernel send a reset, which
+    # could destroy the response before the client reads it.
+    
+    MaxLingering = 1000
+    
+    def __init__(self, selector, retry_after=1, linger=1.0):
+        self.Selector = selector
+        self.Response = overloaded_response(retry_after)
+        self.Linger = linger
+        self.Lingering = {}             # sock -> close time
+        
+    def reject(self, sock):
+        try:
+            sock.setblocking(False)
+            sock.send(self.Response)
+            sock.shutdown(SHUT_WR)
+        except OSError:
+            sock.close()
+            return
+        if len(self.Lingering) >= self.MaxLingering:
+            sock.close()
+            return
+        self.Lingering[sock] = time.monotonic() + self.Linger
+        self.Selector.register(sock, selectors.EVENT_READ, self)
+        
+    def readable(self, sock):
+        try:
+            while sock.recv(4096):
+                pass
+        except BlockingIOError:
+            return
+        except OSError:
+            pass
+        self.close(sock)
+        
+    def close(self, sock):
+        self.Lingering.pop(sock, None)
+        try:    self.Selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+        sock.close()
+        
+    def expire(self):
+        if self.Lingering:
+            now = time.monotonic()
+            for sock, t in list(self.Lingering.items()):
+                if t <= now:
+                    self.close(sock)
+
+def heartbeat_manager(heartbeat):
+    # heartbeat: None, True, dict of HeartbeatManager arguments or a HeartbeatManager shared by several servers
+    if heartbeat is None or heartbeat is False:
+        return None
+    if isinstance(heartbeat, HeartbeatManager):
+        return heartbeat
+    return HeartbeatManager(**(heartbeat if isinstance(heartbeat, dict) else {}))
                 
 class WebsocketClientConnection(Task):
 
-    def __init__(self, app, sock, address, ws_args):
+    def __init__(self, app, sock, address, ws_args, heartbeat=None, metrics=None, ssl_context=None, tls_timeout=None):
         Task.__init__(self)
         self.Sock = sock
+        self.SSLContext = ssl_context
+        self.TLSTimeout = tls_timeout
         self.Address = address
         self.WSArgs = ws_args
         self.App = app
+        self.Heartbeat = heartbeat
+        self.Metrics = metrics
+        self.AcceptTime = time.monotonic()
         
     def run(self):
+        sock = self.Sock
+        if self.SSLContext is not None:
+            # in the handler thread, so that slow TLS clients do not hold up the accept loop
+            try:    sock = tls.wrap_server(sock, self.SSLContext, self.TLSTimeout)
+            except OSError:         # failed, timed out or abandoned TLS handshake
+                sock.close()
+                return
         try:
             #
             # Handshake
             #
-            ws = WebsocketPeer(self.Sock, **self.WSArgs)
+            ws = WebsocketPeer(sock, **self.WSArgs)
             request = ws.recv_request()
             
             handler = self.App.createHandler(ws, request)
@@ -26,33 +119,112 @@ class WebsocketClientConnection(Task):
             else:
                 headers = handler.handshake(self.Address, request) or {}
                 ws.send_response(request, headers=headers)
+                if self.Metrics is not None:
+                    self.Metrics.opened(ws, time.monotonic() - self.AcceptTime)
+                if self.Heartbeat is not None:
+                    self.Heartbeat.register(ws)
                 handler.run()
         except:
             traceback.print_exc()
             raise
         finally:
-            ws.close()
+            try:    ws.close()
+            except (EOF, OSError):          # the client went away without the close handshake
+                ws.shutdown()
+            finally:
+                if self.Metrics is not None:
+                    self.Metrics.closed(ws)
 
 class WebsocketServer(PyThread):
     
-    def __init__(self, port, app, max_connections=10, max_queued=30, **ws_args):
+    def __init__(self, port, app, max_connections=10, max_queued=30, reuse_port=False, heartbeat=None,
+                backlog=128, accept_batch=32, retry_after=1, metrics_port=None, ssl_context=None, tls_timeout=10.0,
+                **ws_args):
+        #
+        # ssl_context   - serve wss:// connections, see tls.server_context()
+        # tls_timeout   - time limit for the TLS handshake
+        # metrics_port  - serve the metrics in Prometheus text format on this port
+        # backlog       - listen() backlog
+        # accept_batch  - connections accepted per wakeup of the accept loop
+        # retry_after   - Retry-After value of the 503 response sent when max_connections handlers are busy
+        #                 and max_queued connections are waiting
+        #
         PyThread.__init__(self)
+        self.Heartbeat = heartbeat_manager(heartbeat)
         self.Port = port
-        self.HandlerQueue = TaskQueue(max_connections, capacity=max_queued)
+        self.ReusePort = reuse_port
+        self.Backlog = backlog
+        self.AcceptBatch = accept_batch
+        self.RetryAfter = retry_after
+        # the TaskQueue capacity counts running tasks too
+        self.HandlerQueue = TaskQueue(max_connections, capacity=max_connections + max_queued)
         self.App = app
         self.WSArgs = ws_args
+        self.Stop = False
+        self.Metrics = ServerMetrics()
+        self.MetricsPort = metrics_port
+        self.SSLContext = ssl_context
+        self.TLSTimeout = tls_timeout
         
-    def run(self):
-        srv_sock = socket(AF_INET, SOCK_STREAM)
-        srv_sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-        srv_sock.bind(("", self.Port))
-        srv_sock.listen(5)
-        
-        while True:
-            sock, address = srv_sock.accept()
-            receiver = WebsocketClientConnection(self.App, sock, address, self.WSArgs)
+        # statistics
+        self.Accepted = 0
+        self.Rejected = 0
+        
+    def metrics(self):
+        queue = self.HandlerQueue
+        gauges = dict(
+            accepted = self.Accepted,
+            rejected = self.Rejected,
+            handlers_running = queue.nrunning(),
+            handlers_waiting = len(queue.waitingTasks())
+        )
+        if self.Heartbeat is not None:
+            gauges["heartbeat"] = self.Heartbeat.stats()
+        if self.SSLContext is not None:
+            gauges["tls"] = tls.server_stats(self.SSLContext)
+        return self.Metrics.snapshot(**gauges)
+        
+    def stop(self):
+        self.Stop = True
+        
+    def accept(self, srv_sock, rejector):
+        for _ in range(self.AcceptBatch):
             try:
-                self.HandlerQueue.addTask(receiver)
-            except:
-                # ws response here !
-                sock.close()
+                sock, address = srv_sock.accept()
+            except (BlockingIOError, InterruptedError):
+                break
+            sock.setblocking(True)
+            receiver = WebsocketClientConnection(self.App, sock, address, self.WSArgs, self.Heartbeat, self.Metrics,
+                self.SSLContext, self.TLSTimeout)
+            try:
+                self.HandlerQueue.addTask(receiver, timeout=0)
+            except RuntimeError:
+                # queue is full
+                self.Rejected += 1
+                if self.SSLContext is None:
+                    rejector.reject(sock)
+                else:
+                    sock.close()        # the 503 response would need a TLS handshake first
+            else:
+                self.Accepted += 1
+        
+    def run(self):
+        srv_sock = listening_socket(self.Port, self.Backlog, self.ReusePort)
+        srv_sock.setblocking(False)
+        if self.Heartbeat is not None and not self.Heartbeat.is_alive():
+            self.Heartbeat.start()
+        if self.MetricsPort is not None:
+            MetricsHTTPServer(self.MetricsPort, lambda: prometheus(self.metrics())).start()
+        selector = selectors.DefaultSelector()
+        selector.register(srv_sock, selectors.EVENT_READ, None)
+        rejector = Rejector(selector, self.RetryAfter)
+        
+        while not self.Stop:
+            for key, events in selector.select(1.0):
+                if key.data is None:
+                    self.accept(srv_sock, rejector)
+                else:
+                    key.data.readable(key.fileobj)
+            rejector.expire()
+        selector.close()
+        srv_sock.close()
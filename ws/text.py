@@ -0,0 +1,104 @@
+from codecs import utf_8_decode
+
+#
+# Raw text messages, for handlers which relay text without looking at it
+#
+# With raw_text=True, WebsocketPeer.recv() returns text messages as RawText objects holding the received
+# UTF-8 bytes instead of str. The bytes are validated as they arrive, fragment by fragment, but not decoded.
+# send(), Broadcaster.publish() and AsyncWebsocketPeer.send() send a RawText as a text frame without
+# re-encoding it. str(message) or message.text decodes it on first use.
+#
+# Validation: pure ASCII data, the common case, is checked with bytes.isascii(). Other data goes through
+# the UTF-8 decoder in slices of ChunkSize bytes, and the decoded text is dropped, except for single-frame
+# messages up to ChunkSize bytes, where it is kept in the RawText.
+#
+
+class UTF8Validator(object):
+
+    # Incremental: a multi-byte sequence may be split between fragments
+
+    ChunkSize = 64*1024         # non-ASCII data is validated in slices, bounding the size of the temporary str. At least 4
+
+    def __init__(self):
+        self.Tail = b''         # incomplete sequence at the end of the data fed so far
+
+    def feed(self, data, final=False):
+        # data: bytes, bytearray or memoryview. A memoryview has no isascii() and is always decoded in slices.
+        # final: data is the end of the message. Raises UnicodeDecodeError
+        if not self.Tail and not isinstance(data, memoryview) and data.isascii():
+            return
+        view = memoryview(data)
+        if self.Tail:
+            # complete the pending sequence with the first bytes of data
+            tail = self.Tail
+            head = tail + bytes(view[:4-len(tail)])
+            _, n = utf_8_decode(head, "strict", final and len(head) - len(tail) == len(view))
+            if n == 0:
+                self.Tail = head            # data was too short to complete it
+                return
+            view = view[n-len(tail):]
+            self.Tail = b''
+        i, n = 0, len(view)
+        while i < n:
+            chunk = view[i:i+self.ChunkSize]
+            last = i + len(chunk) >= n
+            _, consumed = utf_8_decode(chunk, "strict", final and last)
+            if last:
+                self.Tail = bytes(chunk[consumed:])
+                break
+            i += consumed
+        if final and self.Tail:
+            utf_8_decode(self.Tail, "strict", True)     # raises
+
+def validate(data):
+    # raises UnicodeDecodeError if data is not valid UTF-8. Returns the text if it had to be decoded,
+    # i.e. for non-ASCII data up to ChunkSize bytes, otherwise None
+    if data.isascii():
+        return None
+    if len(data) <= UTF8Validator.ChunkSize:
+        return data.decode("utf-8")
+    UTF8Validator().feed(data, True)
+    return None
+
+class RawText(object):
+
+    __slots__ = ("Data", "Text")
+
+    def __init__(self, data, text=None):
+        # data: valid UTF-8 bytes
+        self.Data = data
+        self.Text = text                # decoded text, cached
+
+    @staticmethod
+    def from_str(text):
+        # to send the same text several times without encoding it every time
+        return RawText(text.encode("utf-8"), text)
+
+    @property
+    def text(self):
+        if self.Text is None:
+            self.Text = self.Data.decode("utf-8")
+        return self.Text
+
+    def __str__(self):
+        return self.text
+
+    def __bytes__(self):
+        return bytes(self.Data)
+
+    def __len__(self):
+        # size in bytes, not in characters
+        return len(self.Data)
+
+    def __eq__(self, other):
+        if isinstance(other, RawText):
+            return self.Data == other.Data
+        if isinstance(other, str):
+            return self.text == other
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.text)          # equal to the hash of the equal str
+
+    def __repr__(self):
+        return "RawText(%r)" % (self.text,)
@@ -0,0 +1,128 @@
+import ssl, time, socket
+from pythreader import Primitive, synchronized
+
+#
+# TLS for wss:// connections
+#
+# Server side: server_context() returns an SSLContext which issues session tickets, so returning clients can
+# resume their session with an abbreviated handshake. The ticket keys belong to the context, so with
+# run_server(workers=N) the context must be created before the workers are forked, and all workers then
+# accept each other's tickets.
+#
+# Client side: connect() keeps the TLS session of every wss:// connection in a SessionCache, keyed by host
+# and port. The next connection to the same server offers the cached session. A session can only be used
+# with the SSLContext which created it, so the cache stores the context with the session, and connect()
+# uses one shared default client context unless given another one.
+#
+
+def server_context(certfile, keyfile=None, password=None, session_tickets=2):
+    # session_tickets: number of TLS 1.3 tickets sent after a full handshake, 0 disables tickets
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile, keyfile, password)
+    if session_tickets:
+        context.num_tickets = session_tickets
+    else:
+        context.options |= ssl.OP_NO_TICKET
+        context.num_tickets = 0
+    return context
+
+def client_context(cafile=None, verify=True):
+    # verify=False: accept any certificate, e.g. self-signed ones in tests
+    context = ssl.create_default_context(cafile=cafile)
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+DefaultClientContext = None
+
+def default_client_context():
+    global DefaultClientContext
+    if DefaultClientContext is None:
+        DefaultClientContext = client_context()
+    return DefaultClientContext
+
+class SessionCache(Primitive):
+
+    def __init__(self, max_size=1000):
+        Primitive.__init__(self)
+        self.MaxSize = max_size
+        self.Sessions = {}          # (host, port) -> (context, session)
+
+        # statistics
+        self.Offered = 0            # connections offered a cached session
+        self.Reused = 0             # connections which resumed it
+
+    @synchronized
+    def get(self, host, port, context):
+        entry = self.Sessions.get((host, port))
+        if entry is None:
+            return None
+        cached_context, session = entry
+        if cached_context is not context or session.time + session.timeout < time.time():
+            del self.Sessions[(host, port)]
+            return None
+        return session
+
+    @synchronized
+    def put(self, host, port, context, session):
+        if session is None or not session.has_ticket and not session.id:
+            return
+        if (host, port) not in self.Sessions and len(self.Sessions) >= self.MaxSize:
+            del self.Sessions[next(iter(self.Sessions))]        # oldest entry
+        self.Sessions[(host, port)] = (context, session)
+
+    @synchronized
+    def invalidate(self, host, port):
+        self.Sessions.pop((host, port), None)
+
+    @synchronized
+    def stats(self):
+        return {
+            "sessions":     len(self.Sessions),
+            "offered":      self.Offered,
+            "reused":       self.Reused
+        }
+
+DefaultSessionCache = SessionCache()
+
+def wrap_client(sock, host, port, context=None, cache=DefaultSessionCache):
+    # TLS client handshake on the connected socket, offering the cached session if any
+    context = context or default_client_context()
+    session = None if cache is None else cache.get(host, port, context)
+    try:
+        tls = context.wrap_socket(sock, server_hostname=host, session=session)
+    except ssl.SSLError:
+        if cache is not None:
+            cache.invalidate(host, port)
+        raise
+    if session is not None:
+        with cache:
+            cache.Offered += 1
+            cache.Reused += tls.session_reused
+    return tls
+
+def save_session(tls, host, port, cache=DefaultSessionCache):
+    # called once some data has been received: TLS 1.3 tickets arrive after the handshake
+    if cache is not None:
+        cache.put(host, port, tls.context, tls.session)
+
+def wrap_server(sock, context, timeout=None):
+    # TLS server handshake, timeout in seconds. The returned socket is in blocking mode
+    # The session tickets and the 101 response are separate small writes, which Nagle's algorithm would delay
+    # until the client acknowledges the previous ones
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.settimeout(timeout)
+    tls = context.wrap_socket(sock, server_side=True)
+    tls.settimeout(None)
+    return tls
+
+def server_stats(context):
+    # session cache and ticket counters of a server context
+    stats = context.session_stats()
+    return {
+        "handshakes":       stats["accept"],
+        "resumed":          stats["hits"],
+        "cache_misses":     stats["misses"],
+        "cache_size":       stats["number"]
+    }
@@ -0,0 +1,149 @@
+import sys, os, time, signal, getopt, tempfile
+from collections import deque
+
+#
+# Frame tracing: a process-wide ring buffer of frame events
+#
+#   (monotonic time, connection id, direction, opcode, fin, payload length)
+#
+# Events are recorded by WebsocketPeer and AsyncWebsocketPeer when a frame header is received ("in")
+# and when a frame is encoded for sending ("out"). When tracing is disabled, the cost is one attribute
+# check per frame.
+#
+#   trace.enable(size=65536)        - start recording, keeping the last size events
+#   trace.disable()
+#   trace.dump(path)                - write the recorded events to a file
+#   trace.install_signal_handlers() - SIGUSR2 toggles tracing, SIGUSR1 dumps it to a new file in the temp directory,
+#                                     so a running server can be traced without a restart
+#
+#   python -m ws.trace [-c <conn id>] [-g <gap ms>] <dump file>
+#                                   - prints the dump as a timeline per connection, marking gaps longer than
+#                                     the given time (default 10 ms) between consecutive frames
+#
+
+OpcodeNames = {0: "cont", 1: "text", 2: "binary", 8: "close", 9: "ping", 10: "pong"}
+
+class FrameTrace(object):
+
+    def __init__(self, size=65536):
+        self.Size = size
+        self.Events = deque(maxlen=size)    # appending is atomic, no lock needed
+        self.Recorded = 0
+        self.Started = time.time()
+
+    def record(self, conn, direction, opcode, fin, length):
+        self.Events.append((time.monotonic(), conn, direction, opcode, fin, length))
+        self.Recorded += 1                  # approximate with concurrent threads, used only for the dump header
+
+    def events(self):
+        return list(self.Events)            # a single C call, other threads can not append in the middle
+
+    def dump(self, f):
+        events = self.events()
+        f.write("# ws frame trace: pid %d, started %s, %d events recorded, last %d kept\n" % (
+            os.getpid(), time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.Started)), self.Recorded, len(events)))
+        f.write("# time conn direction opcode fin length\n")
+        for t, conn, direction, opcode, fin, length in events:
+            f.write("%.6f %d %s %d %d %d\n" % (t, conn, direction, opcode, fin, length))
+        return len(events)
+
+Tracer = None
+
+def enable(size=65536):
+    global Tracer
+    from .ws import WebsocketPeer
+    from .aio import AsyncWebsocketPeer
+    if Tracer is None or Tracer.Size != size:
+        Tracer = FrameTrace(size)
+    WebsocketPeer.Tracer = AsyncWebsocketPeer.Tracer = Tracer
+    return Tracer
+
+def disable():
+    # stops recording. The events recorded so far can still be dumped
+    from .ws import WebsocketPeer
+    from .aio import AsyncWebsocketPeer
+    WebsocketPeer.Tracer = AsyncWebsocketPeer.Tracer = None
+
+def enabled():
+    from .ws import WebsocketPeer
+    return WebsocketPeer.Tracer is not None
+
+def dump(path):
+    # returns the number of events written
+    if Tracer is None:
+        raise RuntimeError("Frame tracing has not been enabled")
+    with open(path, "w") as f:
+        return Tracer.dump(f)
+
+def install_signal_handlers(dump_signal=signal.SIGUSR1, toggle_signal=signal.SIGUSR2, directory=None, size=65536):
+    # must be called from the main thread. Dumps go to <directory>/ws-trace-<pid>-<time>.txt
+    directory = directory or tempfile.gettempdir()
+
+    def on_dump(signum, frame):
+        if Tracer is None:
+            return
+        path = os.path.join(directory, "ws-trace-%d-%s.txt" % (os.getpid(), time.strftime("%Y%m%d-%H%M%S")))
+        n = dump(path)
+        print("ws.trace: %d frame events written to %s" % (n, path), file=sys.stderr)
+
+    def on_toggle(signum, frame):
+        if enabled():
+            disable()
+        else:
+            enable(size)
+        print("ws.trace: frame tracing", "enabled" if enabled() else "disabled", file=sys.stderr)
+
+    if dump_signal is not None:
+        signal.signal(dump_signal, on_dump)
+    if toggle_signal is not None:
+        signal.signal(toggle_signal, on_toggle)
+
+#
+# Timeline tool
+#
+
+def read_dump(f):
+    events = []
+    for line in f:
+        if line.startswith("#") or not line.strip():
+            continue
+        t, conn, direction, opcode, fin, length = line.split()
+        events.append((float(t), int(conn), direction, int(opcode), int(fin), int(length)))
+    return events
+
+def timeline(events, conn=None, gap=0.010, out=sys.stdout):
+    by_conn = {}
+    for event in events:
+        if conn is None or event[1] == conn:
+            by_conn.setdefault(event[1], []).append(event)
+    if not by_conn:
+        return
+    t0 = min(e[0] for e in events)
+    for c, conn_events in sorted(by_conn.items()):
+        conn_events.sort()
+        nin = sum(1 for e in conn_events if e[2] == "in")
+        nbytes = sum(e[5] for e in conn_events)
+        print("connection %d: %d frames (%d in, %d out), %d payload bytes, %.3f sec" % (c, len(conn_events), nin,
+            len(conn_events) - nin, nbytes, conn_events[-1][0] - conn_events[0][0]), file=out)
+        previous = None
+        for t, _, direction, opcode, fin, length in conn_events:
+            delta = 0.0 if previous is None else t - previous
+            print("  %12.6f %+11.3fms  %-3s %-6s %s %10d%s" % (t - t0, delta*1000, direction,
+                OpcodeNames.get(opcode, str(opcode)), "fin" if fin else "   ", length,
+                "   <-- gap" if previous is not None and delta >= gap else ""), file=out)
+            previous = t
+        print(file=out)
+
+def main():
+    opts, args = getopt.getopt(sys.argv[1:], "c:g:")
+    opts = dict(opts)
+    if len(args) != 1:
+        print("usage: python -m ws.trace [-c <conn id>] [-g <gap ms>] <dump file>")
+        sys.exit(2)
+    with open(args[0]) as f:
+        events = read_dump(f)
+    conn = int(opts["-c"]) if "-c" in opts else None
+    timeline(events, conn, float(opts.get("-g", 10))/1000)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import os, sys, signal, time, traceback
+
+class WorkerSupervisor(object):
+
+    # Forks N worker processes, each running target(index), and restarts workers which exit
+    # until the supervisor receives SIGTERM or SIGINT. Then it terminates the workers and returns.
+
+    def __init__(self, nworkers, target, restart_delay=1.0):
+        self.NWorkers = nworkers
+        self.Target = target
+        self.RestartDelay = restart_delay
+        self.Workers = {}           # pid -> worker index
+        self.Stop = False
+
+    def spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                self.Target(index)
+            except:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit(status)
+        self.Workers[pid] = index
+        return pid
+
+    def terminate(self, signum=None, frame=None):
+        self.Stop = True
+        for pid in list(self.Workers):
+            try:    os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        saved_handlers = {
+            signum: signal.signal(signum, self.terminate)
+            for signum in (signal.SIGTERM, signal.SIGINT)
+        }
+        try:
+            for index in range(self.NWorkers):
+                self.spawn(index)
+            while self.Workers:
+                try:    pid, status = os.wait()
+                except ChildProcessError:
+                    break
+                index = self.Workers.pop(pid, None)
+                if index is None or self.Stop:
+                    continue
+                print(f"worker {index} (pid {pid}) exited with status {status}, restarting", file=sys.stderr)
+                time.sleep(self.RestartDelay)
+                if not self.Stop:
+                    self.spawn(index)
+        finally:
+            for signum, handler in saved_handlers.items():
+                signal.signal(signum, handler)
@@ -0,0 +1,143 @@
+import time
+from collections import deque
+from pythreader import PyThread, synchronized
+
+#
+# WriteQueue: optional outbound queue of a WebsocketPeer, drained by a dedicated writer thread.
+#
+# Application threads encode frames into the queue and return without waiting for the network.
+# The writer sends everything queued so far with one sendmsg() call, so bursts of small messages share
+# system calls and TCP segments.
+#
+# Backpressure: once more than high_watermark bytes are queued, the queue is paused. send() blocks and
+# send_nowait() raises QueueFull until the writer drains the queue below low_watermark.
+#
+# Pings and pongs are queued in a separate urgent lane. The writer sends them first in each batch, so they
+# wait at most for one batch, up to MaxBatchBytes, not for everything queued before them. Large messages are
+# queued as several fragments (WebsocketPeer.InterleaveSize), and a control frame never splits a frame.
+# Close frames keep their place in the data queue, after the messages sent before close().
+#
+
+class QueueFull(Exception):
+    pass
+
+class WriteQueue(PyThread):
+
+    MaxBatch = 512              # buffers per sendmsg() call, below IOV_MAX
+    MaxBatchBytes = 256*1024    # data bytes per batch, bounding the wait of urgent frames. The first frame is always sent
+
+    def __init__(self, peer, high_watermark=1024*1024, low_watermark=None):
+        PyThread.__init__(self, daemon=True)
+        self.Peer = peer
+        self.HighWatermark = high_watermark
+        self.LowWatermark = high_watermark//4 if low_watermark is None else low_watermark
+        self.Queue = deque()        # frames: (size, buffers)
+        self.Urgent = deque()       # control frames sent before the data frames
+        self.Pending = 0            # bytes queued or being sent
+        self.Paused = False         # above the high watermark, not yet drained to the low one
+        self.Error = None
+        self.Stop = False
+        self.Idle = False           # the writer is waiting for data
+        self.Waiters = 0            # senders waiting for the queue to drain
+
+        # statistics
+        self.Batches = 0
+        self.Buffers = 0
+        self.BytesSent = 0
+
+    def put(self, encode, block=True, timeout=None, force=False, urgent=False):
+        # encode: callable returning the list of frames to queue, each a list of buffers. It is called with
+        # the queue locked, so the frames of concurrent senders are encoded and queued in the same order.
+        # force: ignore the watermarks, used for control frames. urgent: queue in the urgent lane
+        with self:
+            if not force:
+                if self.Paused and not block:
+                    raise QueueFull()
+                t1 = None if timeout is None else time.monotonic() + timeout
+                while self.Paused and self.Error is None and not self.Stop:
+                    dt = None if t1 is None else t1 - time.monotonic()
+                    if dt is not None and dt <= 0:
+                        raise QueueFull()
+                    self.wait(dt)
+            if self.Error is not None:
+                raise self.Error
+            queue = self.Urgent if urgent else self.Queue
+            for frame in encode():
+                buffers = [b for b in frame if len(b)]
+                size = sum(len(b) for b in buffers)
+                queue.append((size, buffers))
+                self.Pending += size
+            if self.Pending > self.HighWatermark:
+                self.Paused = True
+            if self.Idle:
+                self.wakeup()
+            
+    def wait(self, timeout):
+        # called with the queue locked
+        self.Waiters += 1
+        try:    self.sleep(timeout)
+        finally:
+            self.Waiters -= 1
+
+    def drain(self, timeout=None):
+        # waits until all queued data has been sent. Returns False on timeout, raises the writer error if any
+        t1 = None if timeout is None else time.monotonic() + timeout
+        with self:
+            while self.Pending > 0 and self.Error is None and not self.Stop:
+                dt = None if t1 is None else t1 - time.monotonic()
+                if dt is not None and dt <= 0:
+                    break
+                self.wait(dt)
+            if self.Error is not None:
+                raise self.Error
+            return self.Pending == 0
+
+    @synchronized
+    def stop(self):
+        # the writer sends what is already queued, e.g. the close frame, and exits
+        self.Stop = True
+        self.wakeup()
+
+    def run(self):
+        peer = self.Peer
+        while True:
+            with self:
+                while not self.Queue and not self.Urgent and not self.Stop:
+                    self.Idle = True
+                    self.sleep()
+                    self.Idle = False
+                if not self.Queue and not self.Urgent:
+                    break
+                batch = []
+                n = 0
+                while self.Urgent:
+                    size, buffers = self.Urgent.popleft()
+                    batch += buffers
+                    n += size
+                data = 0
+                while self.Queue and (not data or
+                        len(batch) + len(self.Queue[0][1]) <= self.MaxBatch and data + self.Queue[0][0] <= self.MaxBatchBytes):
+                    size, buffers = self.Queue.popleft()
+                    batch += buffers
+                    data += size
+                n += data
+            try:
+                with peer.SendLock:
+                    peer.send_buffers(batch)
+            except (OSError, AttributeError) as e:          # AttributeError: the peer has been shut down
+                with self:
+                    self.Error = e if isinstance(e, OSError) else ConnectionError("Websocket has been closed")
+                    self.Queue.clear()
+                    self.Urgent.clear()
+                    self.Pending = 0
+                    self.wakeup()
+                break
+            with self:
+                self.Batches += 1
+                self.Buffers += len(batch)
+                self.BytesSent += n
+                self.Pending -= n
+                if self.Paused and self.Pending <= self.LowWatermark:
+                    self.Paused = False
+                if self.Waiters:
+                    self.wakeup()
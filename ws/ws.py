@@ -1,9 +1,17 @@
 from socket import *
 from pythreader import Primitive, synchronized
-from threading import RLock
-import sys, hashlib, base64, struct, random, traceback, os, errno, time
+from threading import RLock, Lock, current_thread
+from collections import deque
+import hashlib, base64, struct, os, time, codecs, select, math, itertools, ssl
 from urllib.parse import urlsplit, urlunsplit
-from socket import timeout as socket_timeout
+from .mask import apply_mask
+from .deflate import client_offer, accept_offer, accept_response
+from .writer import WriteQueue
+from .metrics import PeerStats
+from .text import RawText, UTF8Validator, validate
+from .buffers import DefaultPool, PooledMessage
+from . import codec
+from . import tls
 
 class EOF(Exception):
     def __init__(self, message=""):
@@ -15,6 +23,14 @@ class EOF(Exception):
     
     __repr__ = __str__
 
+class MessageTooBig(EOF):
+    # the peer sent a frame or a message exceeding max_frame_size or max_message_size. The connection was closed with 1009
+    pass
+
+class RateLimited(EOF):
+    # the peer exceeded the rate limit of the connection with the close policy. The connection was closed with 1008
+    pass
+
 class Timeout(Exception):
     def __init__(self, message=""):
         self.Message = message
@@ -40,53 +56,364 @@ class WebsocketHeader(object):
         else:
             # request
             self.Method, self.Path, self.Protocol = words
+            
+    def header(self, name, default=None):
+        # case-insensitive header lookup
+        value = self.Headers.get(name)
+        if value is None:
+            name = name.lower()
+            for k, v in self.Headers.items():
+                if k.lower() == name:
+                    return v
+            return default
+        return value
         
 WebsocketRespone = WebsocketRequest = WebsocketHeader
 
 WebSocketVersion = "13"
 
+GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"           # defined by RFC6455
+
+ConnectionIDs = itertools.count(1)
+
+DefaultPorts = {"ws": 80, "wss": 443}
+
+def parse_url(url):
+    # returns (host, port, uri) of a ws:// or wss:// URL
+    parsed = urlsplit(url, scheme="ws")
+    if parsed.scheme not in DefaultPorts:
+        raise ValueError("Unsupported URL scheme: %s" % (parsed.scheme,))
+    uri = urlunsplit(("", "", parsed.path, parsed.query, parsed.fragment))
+    if not uri or uri[0] != '/':
+        uri = "/" + uri
+    return parsed.hostname, parsed.port or DefaultPorts[parsed.scheme], uri
+
+def secure_url(url):
+    return urlsplit(url, scheme="ws").scheme == "wss"
+
+def format_request(uri, host, port, headers={}):
+    headline = f"GET {uri} HTTP/1.1"
+    key = os.urandom(16)
+    key = base64.b64encode(key).decode("utf-8")
+    hdict = {
+        "Host":                 f"{host}:{port}",
+        "Upgrade":              "websocket",
+        "Connection":           "Upgrade",
+        "Sec-WebSocket-Version": WebSocketVersion
+    }
+    hdict.update(headers)
+    hdict["Sec-WebSocket-Key"] = key
+    request = [headline] + ["%s: %s" % (k, v) for k, v in hdict.items()]
+    return ("\r\n".join(request) + "\r\n\r\n").encode("utf-8")
+
+def format_response(request, headers={}, status="101 Switching Protocols"):
+    headline = f"HTTP/1.1 {status}"
+    h = hashlib.sha1()
+    key = request.Headers["Sec-WebSocket-Key"] + GUID
+    h.update(key.encode("utf-8"))
+    response_headers = {
+            "Upgrade": "websocket",
+            "Connection": "Upgrade",
+            "Sec-WebSocket-Accept": base64.b64encode(h.digest()).decode("utf-8")
+    }
+    response_headers.update(headers)
+    response = [headline] + ["%s: %s" % (k, v) for k, v in response_headers.items()]
+    return ("\r\n".join(response) + "\r\n\r\n").encode("utf-8")
+
+def frame_header(fin, opcode, length, mask=None, rsv1=False):
+    # mask: bytes(4) or None
+    # rsv1: set for the first frame of a compressed message
+    assert opcode < 16
+    b0 = opcode | (0x80 if fin else 0) | (0x40 if rsv1 else 0)
+    mask_bit = 0x80 if mask else 0
+    if length < 126:
+        hdr = struct.pack("!BB", b0, length | mask_bit)
+    elif length < 2**16:
+        hdr = struct.pack("!BBH", b0, 126 | mask_bit, length)
+    else:
+        hdr = struct.pack("!BBQ", b0, 127 | mask_bit, length)
+    if mask:
+        hdr += mask
+    return hdr
+
+SmallFrame = 1024           # frames with shorter payloads are sent as one concatenated buffer
+
+def send_buffers(sock, buffers):
+    # sendall() for a list of buffers using scatter-gather sendmsg(), without concatenating them
+    buffers = [memoryview(b).cast("B") for b in buffers if len(b)]
+    while buffers:
+        n = sock.sendmsg(buffers)
+        while n > 0:
+            first = buffers[0]
+            if n >= len(first):
+                n -= len(first)
+                buffers.pop(0)
+            else:
+                buffers[0] = first[n:]
+                n = 0
+
+def send_nonblocking(sock, data):
+    # send() which does not block, for sockets otherwise used in blocking mode. Raises BlockingIOError
+    # if the socket buffer is full. SSLSocket does not accept send() flags: it is written to only when
+    # poll() reports it writable, and can then block briefly if the data does not fit in the buffer
+    if isinstance(sock, ssl.SSLSocket):
+        if not select.select([], [sock], [], 0)[1]:
+            raise BlockingIOError()
+        return sock.send(data)
+    return sock.send(data, MSG_DONTWAIT)
+
+class RecvBuffer(object):
+    
+    # Per-peer receive buffer. Data is read from the socket in large chunks and the handshake lines
+    # and frames are parsed out of the buffer, so that several small frames arriving together
+    # cost a single recv() call. Chunks are read with recv_into() into a reused bytearray.
+    
+    ChunkSize = 64*1024
+    
+    def __init__(self, sock, chunk_size=None):
+        self.Sock = sock
+        self.Data = bytearray()
+        self.EOF = False
+        self.TLS = isinstance(sock, ssl.SSLSocket)
+        if chunk_size is not None:
+            self.ChunkSize = chunk_size
+        self.Chunk = None               # memoryview of the bytearray chunks are read into
+        self.Poller = None
+        if hasattr(select, "poll"):
+            self.Poller = select.poll()
+            self.Poller.register(sock, select.POLLIN)
+        
+    def __len__(self):
+        return len(self.Data)
+        
+    def ready(self):
+        # True if the next read will not block: there is buffered data or the peer has disconnected
+        return len(self.Data) > 0 or self.EOF
+        
+    def frame_info(self):
+        # returns (opcode, header length, payload length) of the buffered frame or None if its header is incomplete
+        data = self.Data
+        if len(data) < 2:
+            return None
+        length = data[1] & 127
+        header_length = 2
+        if length == 126:
+            header_length = 4
+        elif length == 127:
+            header_length = 10
+        if data[1] & 0x80:
+            header_length += 4
+        if len(data) < header_length:
+            return None
+        if length == 126:
+            length = struct.unpack_from("!H", data, 2)[0]
+        elif length == 127:
+            length = struct.unpack_from("!Q", data, 2)[0]
+        return data[0] & 15, header_length, length
+        
+    def frame_ready(self):
+        # True if a complete frame is buffered, so that recv_fragment() will not block
+        info = self.frame_info()
+        return info is not None and len(self.Data) >= info[1] + info[2]
+        
+    def headers_ready(self):
+        # True if a complete HTTP request or response header is buffered
+        return self.Data.find(b"\r\n\r\n") >= 0
+        
+    def wait(self, timeout):
+        # waits until the socket is readable, returns False on timeout. The socket itself stays in blocking mode
+        if self.TLS and self.Sock.pending():
+            return True             # decrypted data which poll() does not see
+        if self.Poller is not None:
+            return bool(self.Poller.poll(None if timeout is None else math.ceil(timeout*1000)))
+        return bool(select.select([self.Sock], [], [], timeout)[0])
+        
+    def fill(self):
+        # single recv() call, returns number of bytes added to the buffer, 0 on EOF
+        if self.EOF:
+            return 0
+        chunk = self.Chunk
+        if chunk is None or len(chunk) != self.ChunkSize:
+            chunk = self.Chunk = memoryview(bytearray(self.ChunkSize))
+        n = self.Sock.recv_into(chunk)
+        if not n:
+            self.EOF = True
+        else:
+            self.Data += chunk[:n]
+        return n
+        
+    def ensure(self, n, message=""):
+        while len(self.Data) < n:
+            if not self.fill():
+                raise EOF(message)
+                
+    def consume(self, n):
+        del self.Data[:n]
+        
+    def read(self, n, message="", mask=None):
+        # returns bytes-like object of length n. mask: bytes(4) to unmask it with, or None
+        missing = n - len(self.Data)
+        if missing <= self.ChunkSize:
+            self.ensure(n, message)
+            if mask:
+                with memoryview(self.Data) as data:
+                    out = apply_mask(mask, data[:n])        # unmasked straight out of the buffer
+            else:
+                out = bytes(self.Data[:n])
+            del self.Data[:n]
+            return out
+        # large body: receive the rest directly into the output buffer, bypassing the chunk buffer
+        out = bytearray(n)
+        self.read_into(memoryview(out), message, mask)
+        return out
+        
+    def read_into(self, view, message="", mask=None):
+        # fills the writable memoryview with the next len(view) bytes. mask: bytes(4) to unmask them with, or None
+        n = len(view)
+        if n - len(self.Data) <= self.ChunkSize:
+            self.ensure(n, message)
+        k = min(n, len(self.Data))
+        if k:
+            with memoryview(self.Data) as data:
+                if mask:
+                    apply_mask(mask, data[:k], view[:k] if k < n else view)     # unmasked while copied
+                else:
+                    view[:k] = data[:k]
+            del self.Data[:k]
+        if k < n:
+            # large body: receive the rest directly, bypassing the chunk buffer
+            i = k
+            while i < n:
+                nread = self.Sock.recv_into(view[i:], n-i)
+                if not nread:
+                    self.EOF = True
+                    raise EOF(message)
+                i += nread
+            if mask:
+                j = k % 4
+                rest = view[k:]
+                apply_mask(mask[j:] + mask[:j], rest, rest)
+        
+    def read_line(self, message=""):
+        start = 0
+        while True:
+            i = self.Data.find(b"\n", start)
+            if i >= 0:
+                return self.read(i+1)
+            start = len(self.Data)
+            if not self.fill():
+                raise EOF(message)
+
 class WebsocketPeer(Primitive):
     
-    GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"           # defined by RFC6455
+    GUID = GUID
     
-    Debug = False
+    Tracer = None                           # trace.FrameTrace, set by trace.enable()
+    WriterFlushTimeout = 5.0                # seconds shutdown() waits for the WriteQueue to send what is queued
+    InterleaveSize = 256*1024               # messages larger than this are sent as fragments of this size, so that
+                                            # control frames can be sent between them. None: no limit
+
+    #
+    # Locking: the send path takes the SendLock, the receive path the RecvLock, and neither takes the other or the
+    # object lock, so a thread receiving, or closing, never holds up a thread sending. The ControlLock guards
+    # the close state and the control frame queue, and is only held for a few statements.
+    # With the write queue, QueueLock keeps the fragments of a streamed message together in the queue.
+    #
+    # Close handshake state machine, State:
+    #
+    #   open  --send_close-->  close sent      --recv_close-->  closing  --shutdown-->  closed
+    #   open  --recv_close-->  close received  --send_close-->  closing
+    #
+    # shutdown() moves any state to closed. Data frames are sent and received only while open.
+    #
+    OPEN, CLOSE_SENT, CLOSE_RECEIVED, CLOSING, CLOSED = "open", "close sent", "close received", "closing", "closed"
+    Transitions = {
+        (OPEN, "send_close"):           CLOSE_SENT,
+        (OPEN, "recv_close"):           CLOSE_RECEIVED,
+        (CLOSE_SENT, "recv_close"):     CLOSING,
+        (CLOSE_RECEIVED, "send_close"): CLOSING
+    }
         
-    def __init__(self, sock = None, send_masked = False, max_fragment = None):
+    def __init__(self, sock = None, send_masked = False, max_fragment = None, compression = None,
+                max_message_size = None, max_frame_size = None, write_queue = None, raw_text = False, codecs = None):
         Primitive.__init__(self)
         self.Sock = sock
-        self.Closed = False
-        self.CloseReceived = False
-        self.CloseSent = False
+        self.State = self.OPEN
         self.SendMasked = send_masked
         self.ClosedCode = None
         self.ClosedStatus = ""
         self.MaxFragment = max_fragment
         self.SendLock = RLock()
         self.RecvLock = RLock()
-        self.BufferedFragments = []         # [(fin, opcode, data),... ]
+        self.ControlLock = Lock()
+        self.QueueLock = RLock()
+        self.ControlQueue = deque()             # control frames waiting for the end of the current fragment
+        self.DataSending = False                # a thread holding the SendLock is sending a fragmented message
+        self.Buffer = None if sock is None else RecvBuffer(sock)
+        self.Compression = compression          # permessage-deflate options, see deflate.py
+        self.Deflate = None                     # PerMessageDeflate, if negotiated
+        self.Inflating = False                  # receiving a compressed message
+        self.MaxMessageSize = max_message_size
+        self.MaxFrameSize = max_frame_size
+        self.MessageSize = 0                    # received size of the current message
+        self.InflatedSize = 0                   # decompressed size of the current message
+        self.WriteQueueOptions = write_queue    # None, True or dict(high_watermark=..., low_watermark=...), see writer.py
+        self.Writer = None                      # WriteQueue
+        self.Heartbeat = None                   # HeartbeatManager, if registered
+        self.Stats = PeerStats()
+        self.ID = next(ConnectionIDs)           # identifies the connection in frame traces
+        self.LastRecv = time.monotonic()        # when the last data frame was received
+        self.RawTextMode = raw_text             # recv() returns text messages as text.RawText, see text.py
+        self.Codecs = codecs                    # codecs to offer or accept as subprotocols, see codec.py
+        self.Codec = codec.DefaultCodec         # used by send_obj() and recv_obj()
+        self.Partial = None                     # (fragments, binary, validator) of a message interrupted by a recv() timeout
+        self.SkipRest = False                   # discard the continuation fragments of a message interrupted by skip()
+        self.RateLimiter = None                 # ratelimit.RateLimiter, set by WSApp for the route
+        self.ResumeTime = 0                     # the delay policy of the RateLimiter stops reading until then
+        if sock is not None:
+            self.start_writer()
         
+    def transition(self, event):
+        # returns True if the event changed the state, False if it does not apply to it, e.g. a second send_close
+        with self.ControlLock:
+            state = self.Transitions.get((self.State, event))
+            if state is None:
+                return False
+            self.State = state
+            return True
+
+    @property
+    def Closed(self):
+        return self.State == self.CLOSED
+
+    @property
+    def CloseSent(self):
+        # no more frames may be sent
+        return self.State in (self.CLOSE_SENT, self.CLOSING, self.CLOSED)
+
+    @property
+    def CloseReceived(self):
+        # no more frames will be received
+        return self.State in (self.CLOSE_RECEIVED, self.CLOSING, self.CLOSED)
+
     @synchronized
     def set_socket(self, sock):
         if self.Sock is None:
             self.Sock = sock
+            self.Buffer = RecvBuffer(sock)
+            self.start_writer()
+            
+    def start_writer(self):
+        options = self.WriteQueueOptions
+        if options is not None and options is not False and self.Writer is None:
+            self.Writer = WriteQueue(self, **(options if isinstance(options, dict) else {}))
+            self.Writer.start()
     
     def peer_address(self):
         return self.Sock.getpeername()
         
     def read_line(self):
-        l = b""
-        done = False
-        while not done:
-            #print("sock:", self.Sock)
-            c = self.Sock.recv(1, MSG_WAITALL)
-            #print("sock:", self.Sock)
-            #print("c:", c)
-            if not c:
-                raise EOF("Peer disconnected while reading the handshake")
-            l += c
-            done = c == b'\n'
-            #print("done:", done)
-        return l.decode("utf-8")
+        return self.Buffer.read_line("Peer disconnected while reading the handshake").decode("utf-8")
         
     def recv_handshake(self):
         # receive handshake response
@@ -112,193 +439,477 @@ class WebsocketPeer(Primitive):
     recv_response = recv_handshake
 
     def send_response(self, request, headers={}, status="101 Switching Protocols"):
-        headline = f"HTTP/1.1 {status}"
-        h = hashlib.sha1()
-        key = request.Headers["Sec-WebSocket-Key"] + WebsocketPeer.GUID
-        h.update(key.encode("utf-8"))
-        response_headers = {
-                "Upgrade": "websocket",
-                "Connection": "Upgrade",
-                "Sec-WebSocket-Accept": base64.b64encode(h.digest()).decode("utf-8")
-        }
-        response_headers.update(headers)
-        
+        if self.Compression is not None and status.startswith("101"):
+            self.Deflate, extension = accept_offer(request.header("Sec-WebSocket-Extensions"), self.Compression)
+            if self.Deflate is not None:
+                headers = dict(headers, **{"Sec-WebSocket-Extensions": extension})
+        if self.Codecs is not None and status.startswith("101") and "Sec-WebSocket-Protocol" not in headers:
+            self.Codec, protocol = codec.accept_offer(request.header("Sec-WebSocket-Protocol"), self.Codecs)
+            if protocol is not None:
+                headers = dict(headers, **{"Sec-WebSocket-Protocol": protocol})
+        response = format_response(request, headers, status)
         with self.SendLock:
-            response = [headline] + ["%s: %s" % (k, v) for k, v in response_headers.items()]
-            response = "\r\n".join(response) + "\r\n\r\n"
-            self.Sock.sendall(response.encode("utf-8"))
+            self.Sock.sendall(response)
             
     def send_request(self, uri, host, port, headers={}):
-        headline = f"GET {uri} HTTP/1.1"
-        key = os.urandom(16)
-        key = base64.b64encode(key).decode("utf-8")
-        hdict = {
-            "Host":                 f"{host}:{port}",
-            "Upgrade":              "websocket",
-            "Connection":           "Upgrade",
-            "Sec-WebSocket-Version": WebSocketVersion,
-            "Sec-WebSocket-Key":    key
-        }
-        
-        hdict.update(headers)
-
+        if self.Compression is not None:
+            headers = dict(headers, **{"Sec-WebSocket-Extensions": client_offer(self.Compression)})
+        if self.Codecs:
+            headers = dict(headers, **{"Sec-WebSocket-Protocol": codec.client_offer(self.Codecs)})
+        request = format_request(uri, host, port, headers)
         with self.SendLock:
-            request = [headline] + ["%s: %s" % (k, v) for k, v in hdict.items()]
-            request = "\r\n".join(request) + "\r\n\r\n"
-            self.Sock.sendall(request.encode("utf-8"))
+            self.Sock.sendall(request)
             
-    def recv_fragment(self, buffered=None):
-        fin, opcode, data = None, None, None
-        close_received = False
-        with self.RecvLock:
-            if self.CloseReceived:
-                raise EOF("Websocket has been closed")
+    def recv_header(self):
+        # reads the frame header, returns (fin, rsv1, opcode, mask, length). Called with the RecvLock held
+        buf = self.Buffer
+        buf.ensure(2, "Peer disconnected while reading a fragment")
+        b0, b1 = buf.Data[0], buf.Data[1]
+        fin = (b0 >> 7) & 1
+        rsv1 = (b0 >> 6) & 1
+        opcode = b0 & 15
+        mask_flag = (b1 >> 7) & 1
+        length = b1 & 127
         
-            if buffered is not None:
-                b = buffered
-            else:
-                b = self.Sock.recv(1, MSG_WAITALL)
-            if not b:
-                raise EOF("Peer disconnected while reading a fragment")
-            b = b[0]
-            fin = (b >> 7) & 1
-            opcode = b & 15;
-
-            b = self.Sock.recv(1, MSG_WAITALL)
-            if not b:
-                raise EOF("Peer disconnected while reading a fragment")
-            b = b[0]
-            mask_flag = (b >> 7) & 1
-            length = b & 127
-        
-            if length < 126:
-                pass
-            elif length == 126:
-                l = self.Sock.recv(2, MSG_WAITALL)
-                length = struct.unpack("!H", l)[0]
-            else:
-                l = self.Sock.recv(8, MSG_WAITALL)
-                length = struct.unpack("!Q", l)[0]
-
-            if self.Debug:
-                print("recv_fragment: fin:", fin, "   opcode:", opcode, "   mask_flag:", mask_flag, "   length:", length)
+        header_length = 2
+        if length == 126:
+            header_length = 4
+        elif length == 127:
+            header_length = 10
+        if mask_flag:
+            header_length += 4
+        buf.ensure(header_length, "Peer disconnected while reading a fragment")
         
+        if length == 126:
+            length = struct.unpack_from("!H", buf.Data, 2)[0]
+        elif length == 127:
+            length = struct.unpack_from("!Q", buf.Data, 2)[0]
 
+        mask = None
+        if mask_flag:
+            mask = bytes(buf.Data[header_length-4:header_length])
+        buf.consume(header_length)
+        
+        if self.Tracer is not None:
+            self.Tracer.record(self.ID, "in", opcode, fin, length)
+        
+        stats = self.Stats
+        stats.FramesIn[opcode] += 1
+        stats.BytesIn += header_length + length
+        
+        if opcode < 8:
+            self.LastRecv = time.monotonic()
+            # check the limits before the payload is read
+            if opcode != 0:
+                self.MessageSize = 0
+            self.MessageSize += length
+            if self.MaxFrameSize is not None and length > self.MaxFrameSize:
+                self.too_big(f"Frame size {length} exceeds the limit {self.MaxFrameSize}")
+            if self.MaxMessageSize is not None and self.MessageSize > self.MaxMessageSize:
+                self.too_big(f"Message size exceeds the limit {self.MaxMessageSize}")
+        elif length > 125 or not fin:
+            # RFC 6455 5.5: control frames are not fragmented and carry at most 125 bytes
+            self.protocol_error(f"Invalid control frame: opcode {opcode}, length {length}, fin {fin}")
+        return fin, rsv1, opcode, mask, length
+        
+    def too_big(self, message):
+        try:    self.send_close(1009, "Message too big")
+        except OSError:
+            pass
+        raise MessageTooBig(message)
+        
+    def protocol_error(self, message):
+        try:    self.send_close(1002, "Protocol error")
+        except OSError:
+            pass
+        raise EOF(message)
         
-            mask = None
+    def admit(self, nbytes):
+        # applies the rate limit to a received message of nbytes. Returns False if the message is to be dropped,
+        # raises RateLimited if the connection was closed
+        limiter = self.RateLimiter
+        if limiter is None:
+            return True
+        wait = limiter.admit(nbytes)
+        if wait <= 0:
+            return True
+        self.Stats.RateLimited += 1
+        if limiter.Policy == "delay":
+            self.ResumeTime = time.monotonic() + wait
+            return True
+        if limiter.Policy == "drop":
+            return False
+        try:    self.send_close(1008, "Rate limit exceeded")
+        except OSError:
+            pass
+        self.shutdown("Rate limit exceeded")
+        raise RateLimited("Rate limit exceeded")
+
+    def pause(self, deadline):
+        # waits until ResumeTime, set by admit(). Returns False if the deadline passes first
+        now = time.monotonic()
+        if self.ResumeTime > now:
+            if deadline is not None and deadline < self.ResumeTime:
+                time.sleep(max(0.0, deadline - now))
+                return False
+            time.sleep(self.ResumeTime - now)
+        return True
+
+    def exceeds_limits(self, opcode, length):
+        if self.MaxFrameSize is not None and length > self.MaxFrameSize:
+            return True
+        if self.MaxMessageSize is not None:
+            size = length if opcode != 0 else self.MessageSize + length
+            return size > self.MaxMessageSize
+        return False
         
-            if mask_flag:
-                mask = self.Sock.recv(4, MSG_WAITALL)
-                if len(mask) != 4:
-                    raise EOF("Peer disconnected while reading a fragment")
+    def fragment_ready(self):
+        # True if recv_fragment() will not block: a complete frame is buffered, or the header of a frame
+        # exceeding the size limits or of an invalid control frame, in which case recv_fragment() fails without
+        # reading the payload
+        info = self.Buffer.frame_info()
+        if info is None:
+            return False
+        opcode, header_length, length = info
+        if len(self.Buffer) >= header_length + length:
+            return True
+        if opcode < 8:
+            return self.exceeds_limits(opcode, length)
+        return length > 125 or not self.Buffer.Data[0] & 0x80
             
-                if self.Debug:
-                    print("        mask:", mask.hex())
+    def recv_payload(self, mask, length, offset=0):
+        # offset: position of the data in the frame payload, to align the mask
+        if mask:
+            k = offset % 4
+            if k:
+                mask = mask[k:] + mask[:k]
+        return self.Buffer.read(length, f"Peer disconnected while reading fragment body. Expected {length} bytes", mask)
+        
+    def inflate(self, opcode, rsv1, fin, data):
+        # decompresses data if it is a part of a compressed message
+        # fin: the data is the end of the message
+        if opcode in (1, 2):
+            self.Inflating = bool(rsv1)
+            self.InflatedSize = 0
+            if rsv1 and self.Deflate is None:
+                raise EOF("Compressed frame received, but permessage-deflate was not negotiated")
+        if self.Inflating and opcode < 8:
+            limit = 0 if self.MaxMessageSize is None else self.MaxMessageSize - self.InflatedSize + 1
+            data = self.Deflate.decompress(data, fin, limit)
+            self.InflatedSize += len(data)
+            if self.MaxMessageSize is not None and self.InflatedSize > self.MaxMessageSize:
+                self.too_big(f"Decompressed message size exceeds the limit {self.MaxMessageSize}")
+            if fin:
+                self.Inflating = False
+        return data
+        
+    def control_frame(self, opcode, data):
+        # processes close and ping frames, returns True if close was received
+        if opcode == 8: # close
+            self.transition("recv_close")
+            if len(data) >= 2:
+                self.ClosedCode = self.Stats.CloseCode = struct.unpack("!H", data[:2])[0]
+                if len(data) > 2:
+                    self.ClosedReason = bytes(data[2:]).decode("utf-8")
+            return True
+        if opcode == 9: # ping
+            if not self.CloseSent:
+                self.send_control(10, data)
+        elif opcode == 10: # pong
+            heartbeat = self.Heartbeat
+            if heartbeat is not None:
+                heartbeat.pong(self, bytes(data))
+        return False
             
-            fragment = self.Sock.recv(length, MSG_WAITALL)
-            if len(fragment) != length:
-                raise EOF(f"Peer disconnected while reading fragment body. Expected {length}, got {len(fragment)}")
+    def recv_fragment(self):
+        fin, opcode, data = None, None, None
+        close_received = False
+        with self.RecvLock:
+            if self.CloseReceived:
+                raise EOF("Websocket has been closed")
             
-            if mask:
-                fragment = self.mask(mask, fragment)
+            fin, rsv1, opcode, mask, length = self.recv_header()
+            fragment = self.recv_payload(mask, length)
+            fragment = self.inflate(opcode, rsv1, fin, fragment)
 
-            if self.Debug:
-                if fragment:
-                    print("        fragment: [%s]" % (fragment.hex(),))
-            
             data = fragment
-            if opcode == 8: # close
-                self.CloseReceived = True
-                if length >= 2:
-                    self.ClosedCode = struct.unpack("!H", fragment[:2])[0]
-                    if length > 2:
-                        self.ClosedReason = fragment[2:].decode("utf-8")     
-                data = b''
-                close_received = True
-        
-            if opcode == 9: # ping
-                self.Sock.send(b"\x0a\x00")
-                
-            if self.Debug:
-                if opcode == 1:
-                    print('        text: "%s"' % (data.decode("utf-8"),))
-                elif opcode == 2:
-                    print("        data: [%s]" % (data.hex(),))
+            if opcode >= 8:
+                close_received = self.control_frame(opcode, fragment)
+                if close_received:
+                    data = b''
 
         if close_received:      # do this after releasing the RecvLock
             self.send_close()
 
         return fin, opcode, data
         
-    #@synchronized
     def send_close(self, code=None, reason=None):
-        with self.SendLock:
-            if not self.CloseSent:
-                body = b''
-                if code is not None:
-                    body = struct.pack('!H', code)
-                    if reason:
-                        body = body + reason.encode("utf-8")
-                self.send_fragment(True, 8, self.SendMasked, body)
-                #print("close sent")
-                self.CloseSent = True
+        # a fragmented message being sent by another thread is cut short after its current fragment.
+        # With the write queue, the close frame is sent after the messages queued before it
+        if not self.transition("send_close"):
+            return
+        body = b''
+        if code is not None:
+            body = struct.pack('!H', code)
+            if reason:
+                body = body + reason.encode("utf-8")
+        self.send_control(8, body)
         
     def peek(self, timeout=0):
+        # True if there is data to receive, waiting up to timeout seconds for it
         if self.closed():
             raise EOF("Websocket has been closed")
         with self.RecvLock:
-            saved_timeout = self.Sock.gettimeout()
-            self.Sock.settimeout(timeout)
-            try:
-                try:    b = self.Sock.recv(1)
-                except socket_timeout:
-                    return False
-                except OSError as exc:
-                    if exc.errno == errno.EWOULDBLOCK:
-                        return False
-                    else:
-                        raise
-                try:
-                    fragment = self.recv_fragment(buffered=b)
-                    self.BufferedFragments.append(fragment)
-                except EOF:
-                    pass
+            buf = self.Buffer
+            if buf.ready():
                 return True
-            finally:
-                self.Sock.settimeout(saved_timeout)
+            if not buf.wait(timeout):
+                return False
+            buf.fill()
+            return True
+            
+    def wait_fragment(self, deadline):
+        # buffers a complete frame so that recv_fragment() will not block. Returns False if the deadline passes first
+        buf = self.Buffer
+        while not self.fragment_ready():
+            if buf.EOF:
+                return True             # recv_fragment() will raise EOF
+            if not buf.wait(max(0.0, deadline - time.monotonic())):
+                return False
+            buf.fill()
+        return True
+                 
+    def wait_header(self, deadline):
+        buf = self.Buffer
+        while buf.frame_info() is None and not buf.EOF:
+            if not buf.wait(max(0.0, deadline - time.monotonic())):
+                return False
+            buf.fill()
+        return True
                  
-    def recv(self, timeout=None):
-        #print("recv(): Closed=", self.Closed)
+    def recv(self, timeout=None, raw_text=None):
+        # timeout applies to the whole message. If it expires in the middle of a fragmented message,
+        # the fragments received so far are kept for the next recv() call
+        # raw_text: return a text message as RawText, validated but not decoded. None: as set for the peer
+        if raw_text is None:
+            raw_text = self.RawTextMode
         with self.RecvLock:
             if self.closed():
                 raise EOF("Websocket has been closed")
-            fragments = []
+            deadline = None if timeout is None else time.monotonic() + timeout
+            if not self.pause(deadline):
+                raise Timeout()
+            fragments, binary, validator = self.Partial or ([], None, None)
+            self.Partial = None
             final = False
             eof = False
-            binary = None
-            first_fragment = True
-            while not final and not eof:
-                if timeout is not None:
-                    if not self.peek(timeout):
+            while True:
+                while not final and not eof:
+                    if deadline is not None and not self.wait_fragment(deadline):
+                        self.Partial = (fragments, binary, validator)
                         raise Timeout()
-                try:    final, opcode, fragment = self.recv_fragment()
-                except EOF as e:
-                    self.shutdown(str(e))
-                    raise
-                if first_fragment:
-                    assert opcode != 0
-                    binary = opcode == 2
-                    first_fragment = False
-                if fragment:
-                    fragments.append(fragment)
-                eof = opcode == 8
+                    try:    final, opcode, fragment = self.recv_fragment()
+                    except EOF as e:
+                        self.shutdown(str(e))
+                        raise
+                    if opcode in (9, 10):
+                        final = False
+                        continue            # ping/pong, handled by recv_fragment
+                    if self.SkipRest and opcode != 8:
+                        self.SkipRest = opcode == 0 and not final
+                        if opcode == 0:
+                            final = False
+                            continue
+                    if opcode != 8 and binary is None:
+                        assert opcode != 0
+                        binary = opcode == 2
+                        if raw_text and not binary and not final:
+                            validator = UTF8Validator()
+                    if validator is not None and opcode != 8:
+                        try:    validator.feed(fragment, final)
+                        except UnicodeDecodeError:
+                            self.SkipRest = not final
+                            raise
+                    if fragment:
+                        fragments.append(fragment)
+                    eof = opcode == 8
+                if eof or self.admit(sum(len(f) for f in fragments)):
+                    break
+                fragments, binary, validator = [], None, None      # dropped by the rate limit
+                final = False
             data = b''.join(fragments)
-            if not binary:  data = data.decode("utf-8")
+            if not binary:
+                if not raw_text or eof:
+                    data = data.decode("utf-8")
+                else:
+                    data = RawText(data, None if validator is not None else validate(data))
             if eof: 
                 #print("recv: closing")
                 self.close()
             return data
             
+    def recv_payload_into(self, pool, buf, size, mask, length):
+        # appends the frame payload to the pooled buffer holding size bytes and unmasks it in place.
+        # Returns the buffer, a larger one if buf was None or too small
+        buf = pool.acquire(length) if buf is None else pool.grow(buf, size, size + length)
+        self.Buffer.read_into(memoryview(buf)[size:size+length],
+            f"Peer disconnected while reading fragment body. Expected {length} bytes", mask)
+        return buf
+
+    def recv_message(self, timeout=None, pool=None):
+        # Like recv(), but returns the message as a buffers.PooledMessage: the payload is received into a buffer
+        # from the pool, DefaultPool if None, without intermediate copies. The caller releases the message, see
+        # buffers.py. Text messages are validated but not decoded. Returns None if the peer closed the connection
+        pool = pool or DefaultPool
+        close_received = False
+        with self.RecvLock:
+            if self.closed():
+                raise EOF("Websocket has been closed")
+            deadline = None if timeout is None else time.monotonic() + timeout
+            if not self.pause(deadline):
+                raise Timeout()
+            buf = None
+            size = 0
+            binary = validator = None
+            if self.Partial is not None:
+                fragments, binary, validator = self.Partial
+                self.Partial = None
+                size = sum(len(f) for f in fragments)
+                if size:
+                    buf = pool.acquire(size)
+                    buf[:size] = b''.join(fragments)
+            try:
+                if binary is False and validator is None:
+                    # text message interrupted in a recv() without raw_text, not validated so far
+                    validator = UTF8Validator()
+                    if size:
+                        try:
+                            with memoryview(buf) as view:
+                                validator.feed(view[:size], False)
+                        except UnicodeDecodeError:
+                            self.SkipRest = True
+                            raise
+                while True:
+                    if deadline is not None and not self.wait_fragment(deadline):
+                        self.Partial = ([bytes(buf[:size])] if size else [], binary, validator)
+                        raise Timeout()
+                    if self.CloseReceived:
+                        raise EOF("Websocket has been closed")
+                    fin, rsv1, opcode, mask, length = self.recv_header()
+                    if opcode >= 8:
+                        if self.control_frame(opcode, self.recv_payload(mask, length)):
+                            close_received = True
+                            break
+                        continue
+                    if self.SkipRest:
+                        self.SkipRest = opcode == 0 and not fin
+                        if opcode == 0:
+                            self.inflate(opcode, rsv1, fin, self.recv_payload(mask, length))
+                            continue
+                    if binary is None:
+                        assert opcode != 0
+                        binary = opcode == 2
+                        if not binary:
+                            validator = UTF8Validator()
+                    start = size
+                    if rsv1 or self.Inflating:
+                        data = self.inflate(opcode, rsv1, fin, self.recv_payload(mask, length))
+                        buf = pool.acquire(len(data)) if buf is None else pool.grow(buf, size, size + len(data))
+                        buf[size:size+len(data)] = data
+                        size += len(data)
+                    else:
+                        buf = self.recv_payload_into(pool, buf, size, mask, length)
+                        size += length
+                    if validator is not None:
+                        try:
+                            with memoryview(buf) as view:
+                                validator.feed(view[start:size], fin)
+                        except UnicodeDecodeError:
+                            self.SkipRest = not fin
+                            raise
+                    if fin:
+                        if self.admit(size):
+                            break
+                        size = 0                    # dropped by the rate limit, the buffer is reused
+                        binary = validator = None
+            except BaseException as e:
+                if buf is not None:
+                    pool.release(buf)
+                if isinstance(e, EOF):
+                    self.shutdown(str(e))
+                raise
+        if close_received:
+            if buf is not None:
+                pool.release(buf)
+            self.send_close()
+            self.close()
+            return None
+        return PooledMessage(pool, buf if buf is not None else pool.acquire(0), size, binary)
+            
+    def recv_stream(self, timeout=None, chunk_size=64*1024, decode=True):
+        # Generator. Yields the payload of the next message in chunks of up to chunk_size bytes as they arrive,
+        # without assembling the message in memory. Frames larger than chunk_size are read in parts.
+        # Text messages are yielded as str, decoded incrementally, unless decode=False.
+        # timeout applies to waiting for the frame headers, counted from the call.
+        # The RecvLock is held until the generator is exhausted
+        close_received = False
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.RecvLock:
+            if self.closed():
+                raise EOF("Websocket has been closed")
+            decoder = None
+            first_fragment = True
+            fin = False
+            try:
+                while not fin:
+                    if deadline is not None and not self.wait_header(deadline):
+                        raise Timeout()
+                    fin, rsv1, opcode, mask, length = self.recv_header()
+                    if opcode >= 8:
+                        data = self.recv_payload(mask, length)
+                        if self.control_frame(opcode, data):
+                            close_received = True
+                            break
+                        fin = False
+                        continue
+                    if first_fragment:
+                        assert opcode != 0
+                        if opcode == 1 and decode:
+                            decoder = codecs.getincrementaldecoder("utf-8")()
+                        first_fragment = False
+                    offset = 0
+                    while True:
+                        n = min(chunk_size, length - offset)
+                        chunk = self.recv_payload(mask, n, offset)
+                        offset += n
+                        last = fin and offset >= length
+                        chunk = self.inflate(opcode, rsv1, last, chunk)
+                        opcode = 0
+                        if decoder is not None:
+                            chunk = decoder.decode(chunk, last)
+                        if chunk:
+                            yield chunk
+                        if offset >= length:
+                            break
+            except EOF as e:
+                self.shutdown(str(e))
+                raise
+        if close_received:
+            self.send_close()
+            self.close()
+            
+    def recv_file(self, f, timeout=None, chunk_size=64*1024):
+        # Spools the next message into a file. f is a file object open for binary writing or a path.
+        # Returns the number of bytes written
+        if isinstance(f, str):
+            with open(f, "wb") as fo:
+                return self.recv_file(fo, timeout, chunk_size)
+        n = 0
+        for chunk in self.recv_stream(timeout, chunk_size, decode=False):
+            f.write(chunk)
+            n += len(chunk)
+        return n
+            
     def skip_one(self, tmo=None):
         try:    self.recv(timeout=tmo)
         except Timeout:
@@ -307,97 +918,312 @@ class WebsocketPeer(Primitive):
             pass
 
     def skip(self, tmo=None):
-        t0 = time.time()
-        t1 = None if tmo is None else t0 + tmo
-        while True:
-            dt = None if tmo is None else t1 - time.time()
-            if dt is None or dt > 0.0:
-                self.skip_one(dt)
-            elif dt <= 0.0:
-                break
+        # discards incoming messages for tmo seconds or until the connection is closed.
+        # Works on fragments, messages are not assembled or decoded
+        t1 = None if tmo is None else time.monotonic() + tmo
+        close_received = False
+        with self.RecvLock:
+            while not self.closed():
+                if t1 is not None and not self.wait_fragment(t1):
+                    break
+                try:    fin, opcode, data = self.recv_fragment()
+                except EOF as e:
+                    self.shutdown(str(e))
+                    break
+                if opcode == 8:
+                    close_received = True
+                    break
+                if opcode < 8:
+                    self.Partial = None
+                    self.SkipRest = not fin         # deadline may pass in the middle of a message
+        if close_received:
+            self.close()
 
-    def send_pong(self):
-        with self.SendLock:
-            self.Sock.send(b"\x0a\x00")
+    def send_pong(self, payload=b""):
+        self.send_control(10, payload)
+        
+    def send_ping(self, payload=b""):
+        self.send_control(9, payload)
+        
+    def send_control(self, opcode, payload):
+        # sends a control frame without waiting for a fragmented message being sent by another thread:
+        # that thread sends it after its current fragment. Can be called while receiving
+        frame = self.encode_fragment(True, opcode, self.SendMasked, bytes(payload))
+        if self.Writer is not None:
+            self.Writer.put(lambda: [frame], force=True, urgent=opcode != 8)
+            return
+        acquired = self.SendLock.acquire(blocking=False)
+        while not acquired:
+            if self.queue_control(frame):
+                return
+            acquired = self.SendLock.acquire(timeout=0.01)
+        try:    self.send_buffers(frame)
+        finally:
+            self.SendLock.release()
+
+    def queue_control(self, frame):
+        # queues the control frame if a fragmented message is being sent, returns False if not
+        with self.ControlLock:
+            if self.DataSending:
+                self.ControlQueue.append(frame)
+                return True
+        return False
+
+    def take_control(self, done=False):
+        # removes and returns the queued control frames. done: the fragmented message has been sent
+        # or has failed, frames are not queued any more
+        with self.ControlLock:
+            frames = list(self.ControlQueue)
+            self.ControlQueue.clear()
+            if done:
+                self.DataSending = False
+        return frames
+
+    def flush_control(self):
+        # sends the queued control frames. Called with the SendLock held, between two fragments
+        for frame in self.take_control():
+            self.send_buffers(frame)
             
     def mask(self, mask, buf):
         # mask: bytes(4)
-        n = (len(buf)+3)//4
-        l = len(buf)
-        mask = (mask*n)[:len(buf)]
-        return bytes([x^m for x, m in zip(buf, mask)])
+        return apply_mask(mask, buf)
         
-    @synchronized
-    def send_fragment(self, fin, opcode, mask, data):
-        with self.SendLock:
-            assert opcode < 16
-            fin = 2**7 if fin else 0
-            hdr = bytes([opcode | fin])
-            n = len(data)
-            mask = 2**7 if mask else 0
-            if n < 127:
-                hdr = hdr + struct.pack('!B', n+mask)
-            elif n < 2**16:
-                hdr = hdr + struct.pack('!B', 126+mask) + struct.pack('!H', n)
+    def encode_fragment(self, fin, opcode, mask, data, rsv1=False):
+        # returns the frame as a list of buffers. Unmasked payloads are not copied
+        data = data or b''
+        if mask:
+            mask = os.urandom(4)
+            data = self.mask(mask, data)
+        hdr = frame_header(fin, opcode, len(data), mask, rsv1)
+        stats = self.Stats
+        stats.FramesOut[opcode] += 1
+        stats.BytesOut += len(hdr) + len(data)
+        if self.Tracer is not None:
+            self.Tracer.record(self.ID, "out", opcode, fin, len(data))
+        if len(data) < SmallFrame:
+            return [hdr + data]
+        return [hdr, data]
+        
+    def send_buffers(self, buffers):
+        if len(buffers) == 1:
+            self.Sock.sendall(buffers[0])
+        elif self.Buffer.TLS:
+            # SSLSocket has no sendmsg(). Small buffers are joined, so that they go out in one TLS record
+            if sum(len(b) for b in buffers) <= RecvBuffer.ChunkSize:
+                self.Sock.sendall(b"".join(buffers))
             else:
-                hdr = hdr + struct.pack('!B', 127+mask) + struct.pack('!Q', n)
-            if mask:
-                r1 = random.randint(0, 0xFFFF)
-                r2 = random.randint(0, 0xFFFF)
-                mask = struct.pack('!H', r1) + struct.pack('!H', r2)
-                hdr = hdr + mask
-                data = self.mask(mask, data)
-            self.Sock.sendall(hdr + (data or b''))
+                for b in buffers:
+                    self.Sock.sendall(b)
+        else:
+            send_buffers(self.Sock, buffers)
+
+    def send_fragment(self, fin, opcode, mask, data, rsv1=False):
+        if self.Writer is not None:
+            self.Writer.put(lambda: [self.encode_fragment(fin, opcode, mask, data, rsv1)], force=True)
+            return
+        sample = not (self.Stats.FramesOut[opcode] & 7)    # send time is measured for every 8th frame of each type
+        t0 = time.perf_counter() if sample else 0
+        with self.SendLock:
+            self.send_buffers(self.encode_fragment(fin, opcode, mask, data, rsv1))
+        if sample:
+            self.Stats.SendTime.observe(time.perf_counter() - t0)
             
-    @synchronized
     def shutdown(self, status=""):
-        if self.Sock is not None:
-            self.Sock.close()
-            self.Sock = None
+        # closes the socket. A thread blocked receiving from it sees EOF
+        with self.ControlLock:
+            self.State = self.CLOSED
+        if self.Writer is not None:
+            self.Writer.stop()
+            if self.Writer is not current_thread():
+                self.Writer.join(self.WriterFlushTimeout)      # let it flush the queue before the socket is closed
+        with self.ControlLock:
+            sock, self.Sock = self.Sock, None
+        if sock is not None:
+            try:    sock.shutdown(SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
             self.CloseStatus = status
-        self.Closed = True
     
     #
     # Usable methods
     #
     
-    @synchronized
+    def prepare(self, message):
+        # returns (opcode, payload, compressed)
+        binary = isinstance(message, (bytes, bytearray, memoryview))
+        if isinstance(message, RawText):
+            message = message.Data              # already UTF-8
+        elif isinstance(message, PooledMessage):
+            binary = message.Binary
+            message = message.View
+        elif not binary:
+            message = message.encode("utf-8")
+        compressed = self.Deflate is not None and self.Deflate.should_compress(message)
+        if compressed:
+            message = self.Deflate.compress(message)
+        return 2 if binary else 1, message, compressed
+        
+    def encode_message(self, message):
+        # returns the message frames, each a list of buffers
+        opcode, payload, compressed = self.prepare(message)
+        if isinstance(payload, (bytearray, memoryview)) and not self.SendMasked:
+            payload = bytes(payload)            # the caller may reuse the buffer before it is sent
+        if len(payload) <= self.fragment_size(len(payload)):
+            return [self.encode_fragment(True, opcode, self.SendMasked, payload, compressed)]
+        return [self.encode_fragment(fin, opcode, self.SendMasked, fragment, rsv1)
+                    for fin, opcode, fragment, rsv1 in self.fragments(opcode, payload, True, compressed)]
+        
     def send(self, message):
+        # with the write queue enabled, returns once the message is queued, blocking only while
+        # the queue is above the high watermark
+        if self.Writer is not None:
+            self.send_queued(message, True)
+            return
         with self.SendLock:
-            if not self.CloseReceived and not self.Closed and not self.CloseSent:
-                binary = isinstance(message, bytes)
-                if not binary:
-                    message = message.encode("utf-8")
+            if self.State == self.OPEN:
+                opcode, message, compressed = self.prepare(message)
+                self.send_chunk(opcode, message, True, compressed)
+                    
+    def send_nowait(self, message):
+        # queues the message or raises writer.QueueFull if the write queue is above the high watermark.
+        # Without the write queue, same as send()
+        if self.Writer is None:
+            self.send(message)
+        else:
+            self.send_queued(message, False)
+            
+    def send_queued(self, message, block):
+        if self.State != self.OPEN:
+            return
+        with self.QueueLock:
+            # frames are not queued after the close frame
+            self.Writer.put(lambda: self.encode_message(message) if self.State == self.OPEN else [], block=block)
+            
+    def drain(self, timeout=None):
+        # waits until the write queue is empty. Returns False on timeout
+        if self.Writer is None:
+            return True
+        return self.Writer.drain(timeout)
+                        
+    def send_stream(self, buffers, binary=True):
+        # Sends one message as a sequence of fragments, one or more per buffer, without assembling it in memory.
+        # buffers: iterable of bytes-like objects, or str or RawText if binary=False. Streamed messages are not compressed
+        if self.State != self.OPEN:
+            return
+        if self.Writer is not None:
+            with self.QueueLock:
+                self.stream_buffers(buffers, binary)
+        else:
+            with self.SendLock:
+                self.DataSending = True
+                try:    self.stream_buffers(buffers, binary)
+                finally:
+                    frames = self.take_control(done=True)
+                for frame in frames:
+                    self.send_buffers(frame)
                 
-                first_fragment = True
-                while message:
-                    n = len(message) 
-                    if self.MaxFragment is not None:
-                        n = min(n, self.MaxFragment)
-                    fragment = message[:n]
-                    message = message[n:]
-                    opcode = 0 if not first_fragment else (2 if binary else 1)
-                    self.send_fragment(len(message) == 0,    # fin
-                        opcode, self.SendMasked, fragment)
-                first_fragment = False
+    def stream_buffers(self, buffers, binary):
+        opcode = 2 if binary else 1
+        pending = None
+        for buf in buffers:
+            if not binary and isinstance(buf, str):
+                buf = buf.encode("utf-8")
+            elif isinstance(buf, RawText):
+                buf = buf.Data
+            if not len(buf):
+                continue
+            if pending is not None:
+                opcode = self.send_chunk(opcode, pending, False)
+            pending = buf
+        self.send_chunk(opcode, pending if pending is not None else b'', True)
+            
+    def fragment_size(self, n):
+        # size of the fragments a payload of n bytes is sent in
+        return min(self.MaxFragment or n, self.InterleaveSize or n) or 1
+
+    def fragments(self, opcode, buf, last, compressed=False):
+        # splits buf into fragments of fragment_size() bytes, yields (fin, opcode, fragment, rsv1).
+        # Fragments are memoryview slices of buf, no copying
+        view = memoryview(buf).cast("B")
+        n = len(view)
+        step = self.fragment_size(n)
+        i = 0
+        while True:
+            fragment = view[i:i+step]
+            i += len(fragment)
+            yield last and i >= n, opcode, fragment, compressed and opcode != 0
+            opcode = 0
+            if i >= n:
+                break
+
+    def send_chunk(self, opcode, buf, last, compressed=False):
+        # sends buf as one or more fragments, returns the opcode for the next fragment
+        if self.Writer is not None:
+            if isinstance(buf, (bytearray, memoryview)) and not self.SendMasked:
+                buf = bytes(buf)
+            self.Writer.put(lambda: [self.encode_fragment(fin, op, self.SendMasked, fragment, rsv1)
+                                        for fin, op, fragment, rsv1 in self.fragments(opcode, buf, last, compressed)]
+                                    if self.State == self.OPEN else [])
+            return 0
+        # a message sent in several fragments lets queued control frames go out between them
+        outer = not self.DataSending and len(buf) > self.fragment_size(len(buf))
+        if outer:
+            self.DataSending = True
+        try:
+            for fin, opcode, fragment, rsv1 in self.fragments(opcode, buf, last, compressed):
+                if self.CloseSent:
+                    break           # closed by another thread, between two fragments
+                self.send_fragment(fin, opcode, self.SendMasked, fragment, rsv1)
+                if self.ControlQueue:
+                    self.flush_control()
+        finally:
+            frames = self.take_control(done=True) if outer else []
+        for frame in frames:
+            self.send_buffers(frame)
+        return 0
     
-    @synchronized
     def close(self, code=1000, reason=None):
-        #print("call close()")
-        if not self.Closed:
-            self.send_close(code, reason)
-            while not self.CloseReceived:
-                self.recv_fragment()
-            #print("close received")
-            self.shutdown()
-            #print("closed")
-        else:
-            #print("already closed")
-            pass
+        # sends the close frame, waits for the peer's one and closes the socket. Threads sending are not held up.
+        # If another thread is receiving, waits for it to receive the peer's close frame
+        if self.Closed:
+            return
+        self.send_close(code, reason)
+        with self.RecvLock:
+            try:
+                while not self.CloseReceived:
+                    self.recv_fragment()
+            except EOF as e:
+                self.shutdown(str(e))
+                raise
+        self.shutdown()
             
     def closed(self):
         return self.CloseReceived or self.Closed
             
+    def send_obj(self, obj):
+        # obj: object to encode with the connection's codec, or codec.Encoded
+        if isinstance(obj, codec.Encoded):
+            self.send(obj.payload(self.Codec))
+        else:
+            self.send(self.Codec.encode(obj))
+
+    def recv_obj(self, timeout=None):
+        # receives and decodes the next message. Raises EOF if the connection closes instead
+        message = self.recv(timeout, raw_text=True)
+        if not message and self.closed():
+            raise EOF("Websocket has been closed")
+        return self.Codec.decode(message)
+
+    def objects(self):
+        # generator of decoded messages, like messages()
+        while not self.closed():
+            try:    obj = self.recv_obj()
+            except EOF as e:
+                self.ClosedStatus = e.Message
+                break
+            yield obj
+
     def messages(self):
         while not self.closed():
             try:    msg = self.recv()
@@ -422,44 +1248,66 @@ class WebsocketPeer(Primitive):
                 callback_delegate.on_close(self, self.ClosedStatus)      
 
 
-def connect(url, headers = {}, **args):
-        parsed = urlsplit(url, scheme="ws")
-        assert parsed.scheme == "ws"
-        host = parsed.hostname
-        port = parsed.port
-        uri = urlunsplit(("", "", parsed.path, parsed.query, parsed.fragment))
-        if not uri or uri[0] != '/':
-            uri = "/" + uri
-        
-        headline = f"GET {uri} HTTP/1.1"
-
-        key = os.urandom(16)
-        key = base64.b64encode(key).decode("utf-8")
-        hdict = {
-            "Host":                 f"{host}:{port}",
-            "Upgrade":              "websocket",
-            "Connection":           "Upgrade",
-            "Sec-WebSocket-Version": WebSocketVersion
-        }
-        
-        if headers:
-            hdict.update(headers)
-            
-        hdict["Sec-WebSocket-Key"] = key
-        
-        sock = socket(AF_INET, SOCK_STREAM)
-        sock.connect((host, port))
-        ws = WebsocketPeer(sock, send_masked = True, **args)
-        ws.send_request(uri, host, port)
-        
-        response = ws.recv_response()
+def client_socket(host, port, address=None, tcp_nodelay=True, sndbuf=None, rcvbuf=None, timeout=None):
+    # address: (ip, port) resolved earlier, skips the name lookup
+    # timeout: connect timeout. The returned socket is in blocking mode
+    sock = socket(AF_INET, SOCK_STREAM)
+    try:
+        if tcp_nodelay:
+            sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        if sndbuf:
+            sock.setsockopt(SOL_SOCKET, SO_SNDBUF, sndbuf)
+        if rcvbuf:
+            sock.setsockopt(SOL_SOCKET, SO_RCVBUF, rcvbuf)
+        sock.settimeout(timeout)
+        sock.connect(address or (host, port))
+        sock.settimeout(None)
+    except:
+        sock.close()
+        raise
+    return sock
+
+def connect(url, headers = {}, compression = None, address = None, tcp_nodelay = True, sndbuf = None, rcvbuf = None,
+            connect_timeout = None, ssl_context = None, tls_session_cache = tls.DefaultSessionCache, **args):
+        # wss:// URLs: ssl_context defaults to tls.default_client_context(). The TLS session is kept
+        # in tls_session_cache and offered again by the next connection to the same host and port, None: no caching
+        # codecs=["msgpack", "json"]: offer these codecs as subprotocols, ws.Codec is the one selected by the server,
+        # see codec.py
+        host, port, uri = parse_url(url)
+        secure = secure_url(url)
+        sock = client_socket(host, port, address, tcp_nodelay, sndbuf, rcvbuf, connect_timeout)
+        if secure:
+            try:
+                sock.settimeout(connect_timeout)
+                sock = tls.wrap_client(sock, host, port, ssl_context, tls_session_cache)
+                sock.settimeout(None)
+            except:
+                sock.close()
+                raise
+        ws = WebsocketPeer(sock, send_masked = True, compression = compression, **args)
+        try:
+            ws.send_request(uri, host, port, headers)
+            response = ws.recv_response()
+        except:
+            ws.shutdown()
+            raise
+        if secure:
+            tls.save_session(sock, host, port, tls_session_cache)
 
         if response.Status == 101:
+            if compression is not None:
+                ws.Deflate = accept_response(response.header("Sec-WebSocket-Extensions"), compression)
+            if ws.Codecs:
+                try:    ws.Codec = codec.accept_response(response.header("Sec-WebSocket-Protocol"), ws.Codecs)
+                except ValueError:
+                    ws.shutdown()
+                    raise
             ws.Protocol = response.Protocol
             ws.ConnectMessage = response.Message
             ws.ResponseHeaders = response.Headers
             return ws
         else:
-            raise ConnectionError(response.Status, response.Message)
-        
-    
\ No newline at end of file
+            ws.shutdown()
+            error = ConnectionError(response.Status, response.Message)
+            error.Headers = response.Headers
+            raise error